@@ -0,0 +1,445 @@
+"""
+Autoscaler of the analysis services of the compose deployment.
+
+Every AUTOSCALER_INTERVAL seconds it reads the depth of the service queues (all the
+lanes of a service) from the RabbitMQ management API, computes the replicas each
+service needs and starts or stops replicas through the Docker API.
+
+    python autoscaler_service.py                      # scale the deployment
+    python autoscaler_service.py --dry-run            # only log the decisions
+    python autoscaler_service.py record trace.jsonl   # record queue depths
+    python autoscaler_service.py simulate trace.jsonl --target-backlog 5
+
+The simulation replays a recorded trace through the scaling policy without RabbitMQ
+or Docker, to compare policies offline. Like the other services it imports the shared
+helpers as the common package, which the image copies next to it; outside the image
+run it with the repository root on PYTHONPATH.
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+import docker
+import requests
+from dotenv import load_dotenv
+from common.messaging import VISION_SERVICES, VISION_SHARED_QUEUE
+from common.queue_stats import fetch_queue_stats, service_depth
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Seconds between two scaling decisions
+AUTOSCALER_INTERVAL = float(os.getenv("AUTOSCALER_INTERVAL", 15))
+# Queued jobs (waiting or running) a single replica is expected to keep up with
+AUTOSCALER_TARGET_BACKLOG = int(os.getenv("AUTOSCALER_TARGET_BACKLOG", 10))
+AUTOSCALER_MIN_REPLICAS = int(os.getenv("AUTOSCALER_MIN_REPLICAS", 1))
+AUTOSCALER_MAX_REPLICAS = int(os.getenv("AUTOSCALER_MAX_REPLICAS", 4))
+# Per-service bounds overriding the defaults, e.g. "yolo=1:2,ocr=1:6"
+AUTOSCALER_BOUNDS = os.getenv("AUTOSCALER_BOUNDS", "")
+# Seconds to wait after a scale-up before scaling up again, and after any change
+# before scaling down
+AUTOSCALER_SCALE_UP_COOLDOWN = float(os.getenv("AUTOSCALER_SCALE_UP_COOLDOWN", 60))
+AUTOSCALER_SCALE_DOWN_COOLDOWN = float(os.getenv("AUTOSCALER_SCALE_DOWN_COOLDOWN", 300))
+# Replicas are only removed while less than this fraction of them is busy
+AUTOSCALER_SCALE_DOWN_UTILIZATION = float(
+    os.getenv("AUTOSCALER_SCALE_DOWN_UTILIZATION", 0.5)
+)
+# Seconds a stopped replica gets to finish its running jobs (the stop_grace_period
+# of the workers in docker-compose.yml)
+AUTOSCALER_STOP_TIMEOUT = int(os.getenv("AUTOSCALER_STOP_TIMEOUT", 330))
+# Jobs a replica runs at the same time (the WORKER_CONCURRENCY of the workers)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))
+
+# Analysis service -> service name in docker-compose.yml
+SCALED_SERVICES = {
+    "yolo": "yolo-service",
+    "yolo_cls": "yolo-cls-service",
+    "yolo_logo": "yolo-logo-service",
+    "ocr": "ocr-service",
+    "whisper": "whisper-service",
+    "sentiment": "sentiment-service",
+}
+# With the shared vision queue one vision worker replaces the single-model replicas
+if VISION_SHARED_QUEUE:
+    for service in VISION_SERVICES:
+        del SCALED_SERVICES[service]
+    SCALED_SERVICES["vision"] = "vision-service"
+
+COMPOSE_SERVICE_LABEL = "com.docker.compose.service"
+COMPOSE_PROJECT_LABEL = "com.docker.compose.project"
+# Label of the replicas started by the autoscaler (the only ones it stops)
+AUTOSCALER_LABEL = "extraction.autoscaler.service"
+
+
+def parse_bounds(bounds):
+    """Parse "service=min:max,..." into {service: (min, max)}."""
+    parsed = {}
+    for entry in bounds.split(","):
+        if not entry.strip():
+            continue
+        service, limits = entry.split("=")
+        min_replicas, max_replicas = limits.split(":")
+        parsed[service.strip()] = (int(min_replicas), int(max_replicas))
+    return parsed
+
+
+def service_metrics(service, queues, replicas):
+    """Sum the stats of the lanes of a service and estimate how busy its replicas are."""
+    depth = service_depth(service, queues)
+    return {
+        "ready": depth["ready"],
+        "unacked": depth["unacked"],
+        "consumers": depth["consumers"],
+        # Running (unacknowledged) jobs per job slot of the replicas: a busy worker
+        # gives back the jobs it cannot start, so its unacknowledged jobs are the ones
+        # it runs (see common.worker)
+        "utilization": min(
+            depth["unacked"] / max(replicas * WORKER_CONCURRENCY, 1), 1.0
+        ),
+    }
+
+
+class ScalingPolicy:
+    """
+    Replica count of one service from its backlog (waiting plus running jobs):
+    enough replicas for AUTOSCALER_TARGET_BACKLOG jobs each, within the bounds.
+
+    Scale-ups happen at once but not more often than the scale-up cooldown. Replicas
+    are removed one at a time, only once nothing is waiting, the replicas are mostly
+    idle and the scale-down cooldown has passed since the last change.
+    """
+
+    def __init__(
+        self,
+        min_replicas=AUTOSCALER_MIN_REPLICAS,
+        max_replicas=AUTOSCALER_MAX_REPLICAS,
+        target_backlog=AUTOSCALER_TARGET_BACKLOG,
+        scale_up_cooldown=AUTOSCALER_SCALE_UP_COOLDOWN,
+        scale_down_cooldown=AUTOSCALER_SCALE_DOWN_COOLDOWN,
+        scale_down_utilization=AUTOSCALER_SCALE_DOWN_UTILIZATION,
+    ):
+        self.min_replicas = min_replicas
+        self.max_replicas = max(max_replicas, min_replicas)
+        self.target_backlog = max(target_backlog, 1)
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.scale_down_utilization = scale_down_utilization
+        self.last_scale_up = -math.inf
+        self.last_scale_down = -math.inf
+
+    def desired_replicas(self, current, metrics, now):
+        backlog = metrics["ready"] + metrics["unacked"]
+        target = math.ceil(backlog / self.target_backlog)
+        target = min(max(target, self.min_replicas), self.max_replicas)
+
+        if target > current:
+            if now - self.last_scale_up < self.scale_up_cooldown:
+                return current
+            self.last_scale_up = now
+            return target
+
+        if target < current:
+            if current > self.max_replicas:
+                # Bounds lowered: no need to wait for the replicas to be idle
+                self.last_scale_down = now
+                return self.max_replicas
+            if (
+                metrics["ready"]
+                or metrics["utilization"] > self.scale_down_utilization
+                or now - max(self.last_scale_up, self.last_scale_down)
+                < self.scale_down_cooldown
+            ):
+                return current
+            self.last_scale_down = now
+            return current - 1
+
+        return current
+
+
+class DockerScaler:
+    """
+    Scale compose services through the Docker API. Extra replicas are started from
+    the configuration of the container created by docker compose (without its
+    published ports) and labelled so that only they are stopped when scaling down.
+    """
+
+    def __init__(self, client=None, stop_timeout=AUTOSCALER_STOP_TIMEOUT):
+        self.client = client or docker.from_env()
+        self.stop_timeout = stop_timeout
+        # Replicas being stopped (draining their jobs) no longer count
+        self.stopping = set()
+        self.lock = threading.Lock()
+
+    def replicas(self, compose_service):
+        containers = self.client.containers.list(
+            filters={"label": f"{COMPOSE_SERVICE_LABEL}={compose_service}"}
+        )
+        with self.lock:
+            return [
+                container
+                for container in containers
+                if container.id not in self.stopping
+            ]
+
+    def replica_count(self, compose_service):
+        return len(self.replicas(compose_service))
+
+    def scale(self, compose_service, replicas):
+        running = self.replicas(compose_service)
+        if replicas > len(running):
+            templates = [c for c in running if AUTOSCALER_LABEL not in c.labels]
+            if not templates:
+                logging.error(
+                    f"No running {compose_service} container to copy, start it with docker compose first"
+                )
+                return
+            for _ in range(replicas - len(running)):
+                self._start_replica(compose_service, templates[0])
+        elif replicas < len(running):
+            # Newest replicas first, the container of docker compose is never stopped
+            extra = sorted(
+                (c for c in running if AUTOSCALER_LABEL in c.labels),
+                key=lambda container: container.attrs["Created"],
+                reverse=True,
+            )
+            for container in extra[: len(running) - replicas]:
+                self._stop_replica(container)
+
+    def _start_replica(self, compose_service, template):
+        config = template.attrs["Config"]
+        host_config = template.attrs["HostConfig"]
+        labels = {
+            key: value
+            for key, value in (config.get("Labels") or {}).items()
+            if key in (COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL)
+        }
+        labels[AUTOSCALER_LABEL] = compose_service
+        networks = list(template.attrs["NetworkSettings"]["Networks"])
+        # Same volumes as the template (e.g. the vision model cache)
+        volumes = [
+            f"{mount.get('Name') or mount['Source']}:{mount['Destination']}:"
+            f"{'rw' if mount.get('RW', True) else 'ro'}"
+            for mount in template.attrs.get("Mounts", [])
+        ]
+        container = self.client.containers.run(
+            config["Image"],
+            command=config.get("Cmd"),
+            environment=config.get("Env"),
+            labels=labels,
+            network=networks[0] if networks else None,
+            volumes=volumes,
+            restart_policy=host_config.get("RestartPolicy"),
+            stop_signal=config.get("StopSignal"),
+            stop_timeout=config.get("StopTimeout"),
+            detach=True,
+        )
+        logging.info(f"Started replica {container.name} of {compose_service}")
+
+    def _stop_replica(self, container):
+        with self.lock:
+            self.stopping.add(container.id)
+
+        # Stopping waits for the running jobs of the replica (SIGTERM drains the worker)
+        def stop():
+            try:
+                container.stop(timeout=self.stop_timeout)
+                container.remove()
+                logging.info(f"Stopped replica {container.name}")
+            except docker.errors.APIError as e:
+                logging.error(f"Failed to stop replica {container.name}: {str(e)}")
+            finally:
+                with self.lock:
+                    self.stopping.discard(container.id)
+
+        threading.Thread(target=stop, daemon=True).start()
+
+
+class SimulatedScaler:
+    """Replica counts kept in memory, for dry runs and trace replays."""
+
+    def __init__(self, replicas=None):
+        self.replicas = dict(replicas or {})
+
+    def replica_count(self, compose_service):
+        return self.replicas.get(compose_service, 1)
+
+    def scale(self, compose_service, replicas):
+        self.replicas[compose_service] = replicas
+
+
+class Autoscaler:
+    def __init__(self, scaler, policies):
+        self.scaler = scaler
+        self.policies = policies
+
+    def step(self, queues, now):
+        """Scale every service for the given queue stats. Returns {service: decision}."""
+        decisions = {}
+        for service, compose_service in SCALED_SERVICES.items():
+            current = self.scaler.replica_count(compose_service)
+            metrics = service_metrics(service, queues, current)
+            desired = self.policies[service].desired_replicas(current, metrics, now)
+            if desired != current:
+                logging.info(
+                    f"Scaling {compose_service} from {current} to {desired} replicas"
+                    f" ({metrics['ready']} waiting, {metrics['unacked']} running jobs)"
+                )
+                self.scaler.scale(compose_service, desired)
+            decisions[service] = {
+                "replicas": current,
+                "desired": desired,
+                **metrics,
+            }
+        return decisions
+
+
+def build_policies(**overrides):
+    bounds = parse_bounds(AUTOSCALER_BOUNDS)
+    policies = {}
+    for service in SCALED_SERVICES:
+        settings = {}
+        if service in bounds:
+            settings["min_replicas"], settings["max_replicas"] = bounds[service]
+        policies[service] = ScalingPolicy(**{**settings, **overrides})
+    return policies
+
+
+def run_autoscaler(dry_run=False):
+    """Scale the deployment every AUTOSCALER_INTERVAL seconds until interrupted."""
+    scaler = SimulatedScaler() if dry_run else DockerScaler()
+    autoscaler = Autoscaler(scaler, build_policies())
+    logging.info(
+        f"Autoscaling {', '.join(SCALED_SERVICES.values())} every {AUTOSCALER_INTERVAL}s"
+    )
+    while True:
+        try:
+            autoscaler.step(fetch_queue_stats(), time.time())
+        except (requests.exceptions.RequestException, docker.errors.APIError) as e:
+            logging.error(f"Autoscaling step failed: {str(e)}")
+        time.sleep(AUTOSCALER_INTERVAL)
+
+
+def record_trace(path, interval, duration=None):
+    """Append a queue-depth sample to a JSON lines trace every interval seconds."""
+    started = time.time()
+    with open(path, "a") as trace:
+        while duration is None or time.time() - started < duration:
+            try:
+                sample = {"time": time.time(), "queues": fetch_queue_stats()}
+                trace.write(json.dumps(sample) + "\n")
+                trace.flush()
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Failed to read the queue depths: {str(e)}")
+            time.sleep(interval)
+
+
+def simulate_trace(path, **overrides):
+    """
+    Replay a recorded trace through the policies and report, per service, the
+    replica-seconds used (cost), the time spent with more backlog per replica than
+    the target (under-provisioned) and the number of scaling decisions.
+
+    The replay is open loop: the recorded queue depths do not react to the simulated
+    replicas, so compare policies on the same trace rather than reading the numbers as
+    absolute latencies.
+    """
+    with open(path) as trace:
+        samples = [json.loads(line) for line in trace if line.strip()]
+    if not samples:
+        print("Empty trace")
+        return
+
+    policies = build_policies(**overrides)
+    scaler = SimulatedScaler(
+        {
+            compose_service: policies[service].min_replicas
+            for service, compose_service in SCALED_SERVICES.items()
+        }
+    )
+    autoscaler = Autoscaler(scaler, policies)
+    report = {
+        service: {"replica_seconds": 0.0, "under_seconds": 0.0, "changes": 0, "peak": 0}
+        for service in SCALED_SERVICES
+    }
+
+    for sample, following in zip(samples, samples[1:] + [None]):
+        elapsed = following["time"] - sample["time"] if following else 0
+        for service, decision in autoscaler.step(
+            sample["queues"], sample["time"]
+        ).items():
+            service_report = report[service]
+            replicas = decision["desired"]
+            backlog = decision["ready"] + decision["unacked"]
+            service_report["replica_seconds"] += replicas * elapsed
+            if backlog > replicas * policies[service].target_backlog:
+                service_report["under_seconds"] += elapsed
+            service_report["changes"] += decision["desired"] != decision["replicas"]
+            service_report["peak"] = max(service_report["peak"], replicas)
+
+    duration = samples[-1]["time"] - samples[0]["time"]
+    print(f"Replayed {len(samples)} samples ({duration:.0f}s)\n")
+    print(
+        f"{'service':<12} {'replica-s':>10} {'under-provisioned':>18} {'changes':>8} {'peak':>5}"
+    )
+    for service, service_report in report.items():
+        print(
+            f"{service:<12} {service_report['replica_seconds']:>10.0f}"
+            f" {service_report['under_seconds']:>17.0f}s"
+            f" {service_report['changes']:>8} {service_report['peak']:>5}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Log the scaling decisions without touching the containers",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    record = commands.add_parser("record", help="Record queue depths to a trace")
+    record.add_argument("trace")
+    record.add_argument("--interval", type=float, default=AUTOSCALER_INTERVAL)
+    record.add_argument("--duration", type=float, help="Seconds to record")
+
+    simulate = commands.add_parser("simulate", help="Replay a trace offline")
+    simulate.add_argument("trace")
+    simulate.add_argument("--target-backlog", type=int)
+    simulate.add_argument("--min-replicas", type=int)
+    simulate.add_argument("--max-replicas", type=int)
+    simulate.add_argument("--scale-up-cooldown", type=float)
+    simulate.add_argument("--scale-down-cooldown", type=float)
+    simulate.add_argument("--scale-down-utilization", type=float)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_trace(args.trace, args.interval, args.duration)
+    elif args.command == "simulate":
+        overrides = {
+            name: getattr(args, name)
+            for name in (
+                "target_backlog",
+                "min_replicas",
+                "max_replicas",
+                "scale_up_cooldown",
+                "scale_down_cooldown",
+                "scale_down_utilization",
+            )
+            if getattr(args, name) is not None
+        }
+        simulate_trace(args.trace, **overrides)
+    else:
+        run_autoscaler(args.dry_run)
+
+
+# Run the autoscaler
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of RabbitMQ publishing: one connection per message (the way the
+services used to publish) against the shared RabbitMQPublisher.
+
+Run it from the repository root against a local broker, e.g.:
+
+    docker compose up -d rabbitmq
+    RABBITMQ_HOST=localhost python benchmarks/publish_benchmark.py --messages 2000
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import pika
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from common.messaging import RabbitMQPublisher, get_connection_parameters  # noqa: E402
+
+BENCHMARK_QUEUE = "publish_benchmark_queue"
+
+
+def publish_with_new_connection(queue_name, message):
+    """Previous behaviour: connect, declare, publish and close for every message."""
+    connection = pika.BlockingConnection(get_connection_parameters())
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True)
+        channel.basic_publish(
+            exchange="", routing_key=queue_name, body=json.dumps(message)
+        )
+    finally:
+        connection.close()
+
+
+def run(name, publish, messages, fanout):
+    start = time.perf_counter()
+    for i in range(0, messages, fanout):
+        publish([(BENCHMARK_QUEUE, {"item_id": str(i), "n": j}) for j in range(fanout)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {messages / elapsed:>10.1f} msg/s ({elapsed:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        default=5,
+        help="Messages published together, like one coordinator fan-out",
+    )
+    args = parser.parse_args()
+    messages = args.messages - args.messages % args.fanout
+
+    print(f"Publishing {messages} messages in fan-outs of {args.fanout}\n")
+
+    run(
+        "connection per message",
+        lambda batch: [publish_with_new_connection(q, m) for q, m in batch],
+        messages,
+        args.fanout,
+    )
+
+    for confirm in (True, False):
+        publisher = RabbitMQPublisher(confirm=confirm)
+        run(
+            f"shared publisher (confirms={confirm})",
+            publisher.publish_batch,
+            messages,
+            args.fanout,
+        )
+        publisher.close()
+
+    # Clean up the benchmark queue
+    connection = pika.BlockingConnection(get_connection_parameters())
+    connection.channel().queue_delete(queue=BENCHMARK_QUEUE)
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
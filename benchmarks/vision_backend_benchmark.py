@@ -0,0 +1,188 @@
+"""
+Benchmark of the vision model backends: latency of PyTorch, ONNX Runtime, OpenVINO
+and the INT8 models (whatever their validation result) on a fixed set of images, and
+parity of their results with PyTorch (detections matched by class at IoU >= --iou,
+top-1 agreement for classification).
+
+Run it from the repository root with the vision-service requirements installed, e.g.:
+
+    python benchmarks/vision_backend_benchmark.py --images samples/ --runs 3
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "vision-service"))
+
+from common.messaging import VISION_SERVICES  # noqa: E402
+from model_backends import (  # noqa: E402
+    BACKENDS,
+    MODEL_TASKS,
+    QUANTIZED_BACKEND,
+    load_model,
+    load_quantized_model,
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def load_images(images_dir):
+    """Decode the images of a directory (BGR, like the frames the workers run on)."""
+    images = []
+    for name in sorted(os.listdir(images_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(images_dir, name))
+            if image is not None:
+                images.append(image)
+    return images
+
+
+def run_backend(model, images, runs):
+    """Predict every image runs times, returning (latencies in ms, last predictions)."""
+    # Warm-up: the first prediction sets the runtime up
+    model.predict(source=images[0], verbose=False)
+    latencies = []
+    predictions = []
+    for _ in range(runs):
+        predictions = []
+        for image in images:
+            started_at = time.perf_counter()
+            predictions.append(model.predict(source=image, verbose=False)[0])
+            latencies.append((time.perf_counter() - started_at) * 1000)
+    return latencies, predictions
+
+
+def box_iou(box, boxes):
+    """IoU of a box (x1, y1, x2, y2) with each of the given boxes."""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def detection_parity(reference, predictions, iou_threshold):
+    """
+    Share of the boxes matched between the reference and the predictions (greedily,
+    same class and IoU >= iou_threshold, over the larger of the two box counts) and
+    the mean confidence difference of the matched boxes.
+    """
+    matched = 0
+    total = 0
+    confidence_diffs = []
+    for expected, actual in zip(reference, predictions):
+        expected_boxes = expected.boxes.xyxy.cpu().numpy()
+        expected_classes = expected.boxes.cls.cpu().numpy()
+        expected_confs = expected.boxes.conf.cpu().numpy()
+        actual_boxes = actual.boxes.xyxy.cpu().numpy()
+        actual_classes = actual.boxes.cls.cpu().numpy()
+        actual_confs = actual.boxes.conf.cpu().numpy()
+        total += max(len(expected_boxes), len(actual_boxes))
+
+        unmatched = np.ones(len(actual_boxes), dtype=bool)
+        for box, cls, conf in zip(expected_boxes, expected_classes, expected_confs):
+            candidates = unmatched & (actual_classes == cls)
+            if not candidates.any():
+                continue
+            ious = np.where(candidates, box_iou(box, actual_boxes), 0)
+            best = int(ious.argmax())
+            if ious[best] >= iou_threshold:
+                unmatched[best] = False
+                matched += 1
+                confidence_diffs.append(abs(float(conf) - float(actual_confs[best])))
+
+    agreement = matched / total if total else 1.0
+    return agreement, statistics.mean(confidence_diffs) if confidence_diffs else 0.0
+
+
+def classification_parity(reference, predictions):
+    """Top-1 agreement with the reference and the mean top-1 confidence difference."""
+    agreements = [
+        expected.probs.top1 == actual.probs.top1
+        for expected, actual in zip(reference, predictions)
+    ]
+    confidence_diffs = [
+        abs(float(expected.probs.top1conf) - float(actual.probs.top1conf))
+        for expected, actual in zip(reference, predictions)
+    ]
+    return sum(agreements) / len(agreements), statistics.mean(confidence_diffs)
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+    return statistics.mean(latencies), p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", required=True, help="Directory of images")
+    parser.add_argument(
+        "--models",
+        default=",".join(VISION_SERVICES),
+        help="Comma separated vision models to benchmark",
+    )
+    parser.add_argument(
+        "--backends",
+        default=",".join(BACKENDS),
+        help="Comma separated backends, compared with pytorch",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Runs over the images")
+    parser.add_argument(
+        "--iou", type=float, default=0.5, help="IoU of matched detections"
+    )
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        sys.exit(f"No images found in {args.images}")
+    backends = ["pytorch"] + [
+        backend for backend in args.backends.split(",") if backend != "pytorch"
+    ]
+    print(f"{len(images)} images, {args.runs} runs\n")
+
+    for service in args.models.split(","):
+        reference = None
+        reference_mean = None
+        for backend in backends:
+            if backend == QUANTIZED_BACKEND:
+                model = load_quantized_model(service, min_accuracy=0)
+                if model is None:
+                    print(f"{service:<10} {backend:<9} not quantized")
+                    continue
+            else:
+                model = load_model(service, backend)
+            latencies, predictions = run_backend(model, images, args.runs)
+            mean, p95 = summarize(latencies)
+            line = f"{service:<10} {backend:<9} mean {mean:7.1f} ms  p95 {p95:7.1f} ms"
+            if reference is None:
+                reference, reference_mean = predictions, mean
+                print(line)
+                continue
+
+            line += f"  speedup {reference_mean / mean:4.2f}x"
+            if MODEL_TASKS[service] == "classify":
+                agreement, confidence_diff = classification_parity(
+                    reference, predictions
+                )
+                line += f"  top-1 agreement {agreement:.1%}"
+            else:
+                agreement, confidence_diff = detection_parity(
+                    reference, predictions, args.iou
+                )
+                line += f"  boxes matched {agreement:.1%}"
+            print(f"{line}  mean conf diff {confidence_diff:.4f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
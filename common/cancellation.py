@@ -0,0 +1,54 @@
+import os
+import time
+import threading
+from common.pipeline import CANCELLED, PARTIAL
+
+# Fanout exchange the coordinator broadcasts cancelled items on; every worker gets a
+# copy on a private queue (see Worker.add_listener)
+CANCELLATION_EXCHANGE = os.getenv("CANCELLATION_EXCHANGE", "item_cancellations")
+# Seconds a worker remembers a cancelled item
+CANCELLATION_TTL = 24 * 60 * 60
+
+_cancelled_items = {}
+_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """Raised by a handler to drop the job of a cancelled item (it is not retried)."""
+
+
+def declare_cancellation_exchange(channel):
+    channel.exchange_declare(
+        exchange=CANCELLATION_EXCHANGE, exchange_type="fanout", durable=True
+    )
+
+
+def record_cancellation(message):
+    """Remember a cancelled item broadcast by the coordinator."""
+    now = time.time()
+    with _lock:
+        _cancelled_items[message["item_id"]] = now
+        for item_id, cancelled_at in list(_cancelled_items.items()):
+            if now - cancelled_at > CANCELLATION_TTL:
+                del _cancelled_items[item_id]
+
+
+def is_cancelled(item_id):
+    with _lock:
+        return item_id in _cancelled_items
+
+
+def stop_reason(job):
+    """
+    Why a job should stop now: CANCELLED once its item was cancelled, PARTIAL once its
+    deadline (a timestamp in the job) has passed, None otherwise. Workers check it
+    before a job and between frames or segments.
+    """
+    if not job:
+        return None
+    if is_cancelled(job.get("item_id")):
+        return CANCELLED
+    deadline = job.get("deadline")
+    if deadline is not None and time.time() >= deadline:
+        return PARTIAL
+    return None
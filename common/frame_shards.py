@@ -0,0 +1,203 @@
+import json
+import logging
+import threading
+
+# Frames are stored as a few shard objects plus a JSON index:
+#
+#   videos/<item_id>/frames/index.json
+#   videos/<item_id>/frames/shard_00000.bin
+#   videos/<item_id>/frames/shard_00001.bin
+#   ...
+#
+# Each shard is the plain concatenation of the JPEG bytes of its frames. The index
+# maps every frame number to (shard, offset, length), so a single frame can be
+# fetched with a ranged GET and a whole shard with one GET.
+#
+# Optional renditions (e.g. frames resized for detection or OCR) are stored in
+# parallel shards holding the same frames ("shard_00000.<rendition>.bin"), and each
+# index entry lists their location under "renditions". Entries also record the
+# "width" and "height" of the original frame, so coordinates found on a rendition
+# can be mapped back to it.
+
+INDEX_FILENAME = "index.json"
+SHARD_FORMAT_VERSION = 1
+
+
+def shard_filename(shard_number, rendition=None):
+    if rendition:
+        return f"shard_{shard_number:05d}.{rendition}.bin"
+    return f"shard_{shard_number:05d}.bin"
+
+
+def locate_frame(entry, rendition=None):
+    """Return (shard, offset, length) of a frame, falling back to the original frame."""
+    location = entry.get("renditions", {}).get(rendition) if rendition else None
+    location = location or entry
+    return location["shard"], location["offset"], location["length"]
+
+
+class FrameShardWriter:
+    """
+    Thread-safe writer packing encoded frames into shard objects on S3.
+
+    Frames can be added in any order from several threads. A shard is uploaded as soon
+    as it holds frames_per_shard frames; close() uploads the last shard and the index.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket,
+        frames_dir,
+        frames_per_shard=64,
+        content_type="image/jpeg",
+        on_shard=None,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.frames_dir = frames_dir
+        self.frames_per_shard = max(frames_per_shard, 1)
+        self.content_type = content_type
+        # Called with (shard_number, index entries) after each shard is uploaded
+        self.on_shard = on_shard
+        self.lock = threading.Lock()
+        self.pending = []
+        self.next_shard = 0
+        self.index = []
+
+    def add(self, frame_number, data, renditions=None, **metadata):
+        """
+        Add an encoded frame and optionally its renditions ({name: encoded bytes}).
+        Extra metadata (e.g. timestamp) is stored in the index.
+        """
+        with self.lock:
+            self.pending.append((frame_number, data, renditions or {}, metadata))
+            if len(self.pending) < self.frames_per_shard:
+                return
+            frames, self.pending = self.pending, []
+            shard_number = self.next_shard
+            self.next_shard += 1
+        # Upload outside the lock so other threads keep adding frames
+        self._upload_shard(shard_number, frames)
+
+    def close(self):
+        """Upload the remaining frames and the index. Returns the number of frames stored."""
+        with self.lock:
+            frames, self.pending = self.pending, []
+            shard_number = self.next_shard
+            if frames:
+                self.next_shard += 1
+        if frames:
+            self._upload_shard(shard_number, frames)
+
+        with self.lock:
+            self.index.sort(key=lambda entry: entry["frame"])
+            index = {
+                "version": SHARD_FORMAT_VERSION,
+                "content_type": self.content_type,
+                "frames": self.index,
+            }
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.frames_dir}{INDEX_FILENAME}",
+            Body=json.dumps(index).encode("utf-8"),
+            ContentType="application/json",
+        )
+        logging.info(
+            f"Stored {len(index['frames'])} frames in {self.next_shard} shards under '{self.frames_dir}'."
+        )
+        return len(index["frames"])
+
+    @property
+    def shard_count(self):
+        return self.next_shard
+
+    def _upload_shard(self, shard_number, frames):
+        frames.sort(key=lambda frame: frame[0])
+        filename = shard_filename(shard_number)
+        entries = []
+        offset = 0
+        rendition_offsets = {}
+        for frame_number, data, renditions, metadata in frames:
+            entry = {
+                "frame": frame_number,
+                "shard": filename,
+                "offset": offset,
+                "length": len(data),
+                **metadata,
+            }
+            offset += len(data)
+            for name, rendition_data in renditions.items():
+                rendition_offset = rendition_offsets.get(name, 0)
+                entry.setdefault("renditions", {})[name] = {
+                    "shard": shard_filename(shard_number, name),
+                    "offset": rendition_offset,
+                    "length": len(rendition_data),
+                }
+                rendition_offsets[name] = rendition_offset + len(rendition_data)
+            entries.append(entry)
+
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.frames_dir}{filename}",
+            Body=b"".join(frame[1] for frame in frames),
+            ContentType="application/octet-stream",
+        )
+        for name in rendition_offsets:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=f"{self.frames_dir}{shard_filename(shard_number, name)}",
+                Body=b"".join(frame[2][name] for frame in frames if name in frame[2]),
+                ContentType="application/octet-stream",
+            )
+
+        with self.lock:
+            self.index.extend(entries)
+        logging.info(
+            f"Uploaded shard '{self.frames_dir}{filename}' with {len(entries)} frames ({offset} bytes)"
+            f" and {len(rendition_offsets)} renditions."
+        )
+        if self.on_shard:
+            self.on_shard(shard_number, entries)
+
+
+def split_frame_entries(entries, frames_per_job):
+    """Split index entries (in frame order) into consecutive jobs of frames_per_job frames."""
+    frames_per_job = max(frames_per_job, 1)
+    return [
+        entries[start : start + frames_per_job]
+        for start in range(0, len(entries), frames_per_job)
+    ]
+
+
+def load_frame_index(s3, bucket, frames_dir):
+    """Return the shard index of a frames directory, or None for per-frame objects."""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{frames_dir}{INDEX_FILENAME}")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def list_frame_objects(s3, bucket, frames_dir):
+    """List legacy per-frame objects ('frame_<number>.jpg') sorted by frame number."""
+    frames = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=frames_dir):
+        for obj in page.get("Contents", []):
+            filename = obj["Key"].split("/")[-1]
+            if filename.startswith("frame_"):
+                frames.append((int(filename.split("_")[1].split(".")[0]), obj["Key"]))
+    frames.sort()
+    return frames
+
+
+def read_frame(s3, bucket, frames_dir, entry, rendition=None):
+    """Fetch a single frame (or one of its renditions) of a sharded directory with a ranged GET."""
+    shard, start, length = locate_frame(entry, rendition)
+    response = s3.get_object(
+        Bucket=bucket,
+        Key=f"{frames_dir}{shard}",
+        Range=f"bytes={start}-{start + length - 1}",
+    )
+    return response["Body"].read()
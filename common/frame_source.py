@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from common.frame_shards import list_frame_objects, load_frame_index, locate_frame
+
+# S3 GETs running at the same time while the frames of a job are read
+FRAME_FETCH_WORKERS = max(int(os.getenv("FRAME_FETCH_WORKERS", 4)), 1)
+# GETs fetched ahead of the frame being processed (bounds the memory used)
+FRAME_FETCH_AHEAD = max(int(os.getenv("FRAME_FETCH_AHEAD", 8)), 1)
+# Consecutive frames of a shard read with a single ranged GET
+FRAMES_PER_FETCH = max(int(os.getenv("FRAMES_PER_FETCH", 16)), 1)
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """Decode an encoded image (JPEG, WebP, PNG...) into an array, BGR by default."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if image is None:
+        raise ValueError("Could not decode the image")
+    return image
+
+
+def plan_fetches(s3, bucket, frames_dir, entries=None, rendition=None):
+    """
+    Plan the GETs reading the frames of a directory, or only the given index entries
+    (e.g. a frame batch message), using the requested rendition where it exists.
+
+    Returns (fetches, frames): fetches are (key, byte range or None) and frames are
+    (frame_number, fetch, offset in the fetched bytes, length or None for the whole
+    object, whether it is read from the rendition) in frame order. Consecutive frames of a shard are grouped into ranged GETs
+    of up to FRAMES_PER_FETCH frames; legacy directories (listed page by page) take
+    one GET per frame object.
+    """
+    if entries is None:
+        index = load_frame_index(s3, bucket, frames_dir)
+        if index is None:
+            objects = list_frame_objects(s3, bucket, frames_dir)
+            fetches = [(key, None) for _, key in objects]
+            frames = [
+                (frame_number, fetch, 0, None, False)
+                for fetch, (frame_number, _) in enumerate(objects)
+            ]
+            return fetches, frames
+        entries = index["frames"]
+
+    groups = []
+    for entry in entries:
+        shard, offset, length = locate_frame(entry, rendition)
+        from_rendition = bool(rendition and rendition in entry.get("renditions", {}))
+        if (
+            not groups
+            or groups[-1][0] != shard
+            or len(groups[-1][1]) == FRAMES_PER_FETCH
+        ):
+            groups.append((shard, []))
+        groups[-1][1].append((entry["frame"], offset, length, from_rendition))
+
+    fetches = []
+    frames = []
+    for shard, members in groups:
+        start = min(offset for _, offset, _, _ in members)
+        end = max(offset + length for _, offset, length, _ in members)
+        for frame_number, offset, length, from_rendition in members:
+            frames.append(
+                (frame_number, len(fetches), offset - start, length, from_rendition)
+            )
+        fetches.append((f"{frames_dir}{shard}", f"bytes={start}-{end - 1}"))
+    return fetches, frames
+
+
+def fetch_frames(
+    s3,
+    bucket,
+    frames_dir,
+    entries=None,
+    rendition=None,
+    imread_flags=None,
+    rendition_flags=None,
+):
+    """
+    Yield (frame_number, frame) for the frames of a directory, or only the given
+    index entries, in frame order (see plan_fetches).
+
+    The GETs run on a bounded thread pool up to FRAME_FETCH_AHEAD GETs ahead of the
+    frame being yielded, so the next frames download while the caller processes the
+    current ones. Frames stay in memory: they are the encoded bytes, or arrays decoded
+    with cv2.imdecode when imread_flags (e.g. cv2.IMREAD_COLOR) is given. Frames read
+    from the rendition are decoded with rendition_flags instead when it is given (e.g.
+    cv2.IMREAD_GRAYSCALE for a grayscale rendition).
+    """
+    fetches, frames = plan_fetches(s3, bucket, frames_dir, entries, rendition)
+    if not frames:
+        return
+
+    def fetch(key, byte_range):
+        options = {"Range": byte_range} if byte_range else {}
+        return s3.get_object(Bucket=bucket, Key=key, **options)["Body"].read()
+
+    # Frames left to yield from each GET, its bytes are dropped after the last one
+    remaining = [0] * len(fetches)
+    for _, fetch_number, _, _, _ in frames:
+        remaining[fetch_number] += 1
+
+    executor = ThreadPoolExecutor(max_workers=FRAME_FETCH_WORKERS)
+    futures = {}
+    submitted = 0
+    try:
+        for frame_number, fetch_number, offset, length, from_rendition in frames:
+            while submitted < len(fetches) and (
+                submitted <= fetch_number or len(futures) < FRAME_FETCH_AHEAD
+            ):
+                futures[submitted] = executor.submit(fetch, *fetches[submitted])
+                submitted += 1
+            data = futures[fetch_number].result()
+            remaining[fetch_number] -= 1
+            if not remaining[fetch_number]:
+                del futures[fetch_number]
+
+            if length is not None:
+                data = data[offset : offset + length]
+            flags = imread_flags
+            if from_rendition and rendition_flags is not None:
+                flags = rendition_flags
+            if flags is not None:
+                data = decode_image(data, flags)
+            yield frame_number, data
+    finally:
+        # Stopped early or failed: drop the GETs that have not started
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import logging
+import threading
+import pika
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
+RABBITMQ_DEFAULT_USER = os.getenv("RABBITMQ_DEFAULT_USER", "user")
+RABBITMQ_DEFAULT_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "password")
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 60))
+# Wait for the broker to confirm every published message
+RABBITMQ_PUBLISHER_CONFIRMS = (
+    os.getenv("RABBITMQ_PUBLISHER_CONFIRMS", "true").lower() == "true"
+)
+# Topic exchange the coordinator publishes analysis jobs to
+ANALYSIS_EXCHANGE = os.getenv("ANALYSIS_EXCHANGE", "analysis_jobs")
+
+# Queue and binding patterns of every analysis service on the analysis exchange.
+# Jobs are published once with the routing key "<lane>.<item_type>.<service>..."
+# (see job_routing_key) and RabbitMQ copies them to every queue whose pattern
+# matches, so adding a service only needs a new entry here.
+SERVICE_BINDINGS = {
+    "yolo": ("yolo_queue", ["#.yolo.#"]),
+    "yolo_cls": ("yolo_cls_queue", ["#.yolo_cls.#"]),
+    "yolo_logo": ("yolo_logo_queue", ["#.yolo_logo.#"]),
+    "ocr": ("ocr_queue", ["#.ocr.#"]),
+    "whisper": ("whisper_queue", ["*.video.#.whisper.#"]),
+    "sentiment": ("sentiment_queue", ["#.sentiment.#"]),
+}
+# The detection, classification and logo models run in the vision worker
+# (vision-service). By default each model has its own queues and replicas; with
+# VISION_SHARED_QUEUE their jobs are routed to the vision queues instead, so a job
+# requesting several of them is delivered once and its frames are decoded once.
+VISION_SERVICES = ("yolo", "yolo_cls", "yolo_logo")
+VISION_SHARED_QUEUE = os.getenv("VISION_SHARED_QUEUE", "false").lower() == "true"
+VISION_BINDING = ("vision_queue", [f"#.{service}.#" for service in VISION_SERVICES])
+
+# Bindings of earlier versions without a lane (besides the patterns above), removed
+# when the queues are declared
+LEGACY_PATTERNS = {"whisper": ["video.#.whisper.#"]}
+
+# Every service has a queue per lane so short jobs (images, short clips) are not
+# queued behind long videos. Workers consume all the lanes of their service, taking
+# up to <weight> jobs from a lane for every job of a lane of weight 1.
+FAST_LANE = "fast"
+STANDARD_LANE = "standard"
+LANE_WEIGHTS = {
+    FAST_LANE: int(os.getenv("FAST_LANE_WEIGHT", 4)),
+    STANDARD_LANE: 1,
+}
+
+# Unacknowledged messages a worker receives at a time (1 = fair dispatch between replicas)
+RABBITMQ_PREFETCH_COUNT = int(os.getenv("RABBITMQ_PREFETCH_COUNT", 1))
+# Deliveries of a job before it is moved to the dead-letter queue
+MAX_DELIVERY_ATTEMPTS = int(os.getenv("MAX_DELIVERY_ATTEMPTS", 3))
+DEAD_LETTER_QUEUE = "dead_letter_queue"
+ATTEMPT_HEADER = "x-attempt"
+
+# Jobs survive a broker restart on the durable queues
+PERSISTENT = pika.BasicProperties(delivery_mode=2)
+
+# Queue the result service reports finished (completed or failed) stages to
+STAGE_EVENTS_QUEUE = "stage_complete_queue"
+
+# Errors after which the connection is dropped and the publish retried
+RECOVERABLE_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+    pika.exceptions.StreamLostError,
+    ConnectionError,
+)
+
+
+def get_connection_parameters():
+    """Connection parameters for the RabbitMQ broker defined in docker-compose."""
+    credentials = pika.PlainCredentials(RABBITMQ_DEFAULT_USER, RABBITMQ_DEFAULT_PASS)
+    return pika.ConnectionParameters(
+        RABBITMQ_HOST,
+        RABBITMQ_PORT,
+        "/",
+        credentials,
+        heartbeat=RABBITMQ_HEARTBEAT,
+    )
+
+
+def job_routing_key(item_type, services, lane=STANDARD_LANE):
+    """Routing key of an analysis job, e.g. "fast.image.ocr.yolo" or "standard.frame_batch.yolo"."""
+    return ".".join([lane, item_type, *sorted(set(services))])
+
+
+def lane_queue_name(queue_name, lane):
+    """Queue of a lane: the standard lane keeps the service queue, e.g. "yolo_fast_queue"."""
+    if lane == STANDARD_LANE:
+        return queue_name
+    return f"{queue_name[: -len('_queue')]}_{lane}_queue"
+
+
+def service_binding(service):
+    """
+    Queue and binding patterns receiving the jobs of a service: the vision queue for
+    the models sharing it (and for the "vision" service itself).
+    """
+    if service == "vision" or (VISION_SHARED_QUEUE and service in VISION_SERVICES):
+        return VISION_BINDING
+    return SERVICE_BINDINGS[service]
+
+
+def declare_service_queue(channel, service):
+    """
+    Declare the analysis exchange and the queues of a service (one per lane), bind
+    them with the service's patterns and return {lane: queue name}.
+    """
+    queue_name, patterns = service_binding(service)
+    channel.exchange_declare(
+        exchange=ANALYSIS_EXCHANGE, exchange_type="topic", durable=True
+    )
+    queues = {}
+    for lane in LANE_WEIGHTS:
+        queues[lane] = lane_queue_name(queue_name, lane)
+        channel.queue_declare(queue=queues[lane], durable=True)
+        for pattern in patterns:
+            channel.queue_bind(
+                queue=queues[lane],
+                exchange=ANALYSIS_EXCHANGE,
+                routing_key=f"{lane}.{pattern}",
+            )
+
+    # Lane-less patterns would deliver the jobs of every lane to the standard queue
+    # (unbinding a binding that does not exist is a no-op)
+    for pattern in patterns + LEGACY_PATTERNS.get(service, []):
+        channel.queue_unbind(
+            queue=queue_name, exchange=ANALYSIS_EXCHANGE, routing_key=pattern
+        )
+
+    # Models sharing the vision queue stop receiving jobs on their own queues (switch
+    # while those are empty, their jobs are no longer consumed)
+    if VISION_SHARED_QUEUE and service in VISION_SERVICES:
+        own_queue, own_patterns = SERVICE_BINDINGS[service]
+        for lane in LANE_WEIGHTS:
+            lane_queue = lane_queue_name(own_queue, lane)
+            channel.queue_declare(queue=lane_queue, durable=True)
+            for pattern in own_patterns:
+                channel.queue_unbind(
+                    queue=lane_queue,
+                    exchange=ANALYSIS_EXCHANGE,
+                    routing_key=f"{lane}.{pattern}",
+                )
+    return queues
+
+
+class RabbitMQPublisher:
+    """
+    Long-lived, thread-safe RabbitMQ publisher.
+
+    A single connection and channel are opened lazily and reused for every message,
+    queue declarations are cached, and the connection is re-established transparently
+    when the broker drops it. pika connections are not thread-safe, so publishing is
+    serialised with a lock. A background thread serves heartbeats while no message is
+    published, so the broker does not drop an idle connection.
+    """
+
+    def __init__(self, parameters=None, confirm=RABBITMQ_PUBLISHER_CONFIRMS, retries=3):
+        self.parameters = parameters or get_connection_parameters()
+        self.confirm = confirm
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+        self.declared_queues = set()
+        self.heartbeat_thread = None
+        self.closed = False
+
+    def _ensure_channel(self):
+        if self.connection is not None and self.connection.is_open:
+            # Serve heartbeats that came in while the publisher was idle
+            self.connection.process_data_events(time_limit=0)
+            if self.channel is not None and self.channel.is_open:
+                return self.channel
+
+        if self.connection is None or not self.connection.is_open:
+            self.connection = pika.BlockingConnection(self.parameters)
+            self.declared_queues.clear()
+            self._start_heartbeats()
+            logging.info("Publisher connected to RabbitMQ")
+
+        self.channel = self.connection.channel()
+        if self.confirm:
+            self.channel.confirm_delivery()
+        return self.channel
+
+    def _start_heartbeats(self):
+        heartbeat = self.parameters.heartbeat
+        if not isinstance(heartbeat, int):
+            heartbeat = RABBITMQ_HEARTBEAT
+        self.closed = False
+        if heartbeat <= 0 or (
+            self.heartbeat_thread is not None and self.heartbeat_thread.is_alive()
+        ):
+            return
+        self.heartbeat_thread = threading.Thread(
+            target=self._serve_heartbeats,
+            args=(max(heartbeat / 2, 1),),
+            name="publisher-heartbeats",
+            daemon=True,
+        )
+        self.heartbeat_thread.start()
+
+    def _serve_heartbeats(self, interval):
+        """Process the I/O of the idle connection (heartbeats) every interval seconds."""
+        while not self.closed:
+            time.sleep(interval)
+            with self.lock:
+                if self.connection is None or not self.connection.is_open:
+                    continue
+                try:
+                    self.connection.process_data_events(time_limit=0)
+                except RECOVERABLE_ERRORS as e:
+                    # Reconnected on the next publish
+                    logging.warning(f"Idle publisher connection lost: {str(e)}")
+                    self._reset()
+
+    def _reset(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+        self.declared_queues.clear()
+
+    def _declare_queue(self, channel, queue_name):
+        if queue_name not in self.declared_queues:
+            channel.queue_declare(queue=queue_name, durable=True)
+            self.declared_queues.add(queue_name)
+
+    def publish_batch(self, messages, exchange=""):
+        """
+        Publish several (routing_key, message) pairs back to back over the shared channel,
+        e.g. all the messages of a fan-out. With the default exchange the routing key is
+        the queue name and the queue is declared (once) before publishing.
+
+        After a connection error the batch resumes from the first message that was not
+        published (confirmed by the broker with publisher confirms), so the messages
+        before it are not sent twice.
+        """
+        messages = list(messages)
+        published = 0
+        for attempt in range(1, self.retries + 1):
+            with self.lock:
+                try:
+                    channel = self._ensure_channel()
+                    for routing_key, message in messages[published:]:
+                        if not exchange:
+                            self._declare_queue(channel, routing_key)
+                        channel.basic_publish(
+                            exchange=exchange,
+                            routing_key=routing_key,
+                            body=json.dumps(message),
+                            properties=PERSISTENT,
+                        )
+                        published += 1
+                    return
+                except RECOVERABLE_ERRORS as e:
+                    self._reset()
+                    if attempt == self.retries:
+                        raise
+                    logging.warning(
+                        f"Publishing to RabbitMQ failed (attempt {attempt}), reconnecting: {str(e)}"
+                    )
+            time.sleep(min(2 ** (attempt - 1), 5))
+
+    def publish(self, routing_key, message, exchange=""):
+        """Publish a single JSON message."""
+        self.publish_batch([(routing_key, message)], exchange=exchange)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._reset()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return the process-wide publisher, creating it on first use."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = RabbitMQPublisher()
+        return _publisher
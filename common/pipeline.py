@@ -0,0 +1,153 @@
+import os
+
+# Stages of the analysis pipeline and their dependencies. A stage is dispatched as
+# soon as all of its planned inputs ("after") have finished, so stages without
+# pending inputs run in parallel.
+#
+#   whisper ──┐
+#             ├──> sentiment
+#   ocr ──────┘
+#   yolo_cls ───> yolo_logo (gated: only runs if yolo_cls saw a logo-bearing class)
+#   yolo
+#
+# "follows" stages are not requested on their own: they are added to the plan of
+# every item that runs at least one of their inputs.
+PIPELINE_STAGES = {
+    "whisper": {"after": [], "item_types": ["video"]},
+    "ocr": {"after": []},
+    "yolo": {"after": []},
+    "yolo_cls": {"after": []},
+    "yolo_logo": {"after": ["yolo_cls"], "gate": "logo"},
+    "sentiment": {"after": ["whisper", "ocr"], "follows": True},
+}
+
+# yolo_cls classes after which yolo_logo is worth running (empty disables the gate)
+YOLO_LOGO_GATE_CLASSES = {
+    name.strip()
+    for name in os.getenv(
+        "YOLO_LOGO_GATE_CLASSES",
+        "jersey,sweatshirt,pop_bottle,beer_bottle,water_bottle,wine_bottle,carton,"
+        "packet,web_site,scoreboard,street_sign,book_jacket,running_shoe,sports_car,racer",
+    ).split(",")
+    if name.strip()
+}
+YOLO_LOGO_GATE_MIN_CONFIDENCE = float(os.getenv("YOLO_LOGO_GATE_MIN_CONFIDENCE", 0.1))
+
+# Stage statuses
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+SKIPPED = "skipped"
+# Stopped at the deadline of the item: the result covers part of the input
+PARTIAL = "partial"
+CANCELLED = "cancelled"
+TERMINAL_STATUSES = {COMPLETED, FAILED, SKIPPED, PARTIAL, CANCELLED}
+# Statuses whose result can be used by the stages that follow
+USABLE_STATUSES = {COMPLETED, PARTIAL}
+
+
+def stage_inputs(stage):
+    """Inputs of a stage, ignoring the input of a disabled gate."""
+    definition = PIPELINE_STAGES[stage]
+    if definition.get("gate") == "logo" and not YOLO_LOGO_GATE_CLASSES:
+        return []
+    return definition["after"]
+
+
+def plan_stages(services, item_type):
+    """
+    Return {stage: [planned inputs]} for the services requested for an item, adding
+    the stages that follow them and dropping the ones that do not apply.
+    """
+    planned = {
+        service
+        for service in services
+        if service in PIPELINE_STAGES
+        and not PIPELINE_STAGES[service].get("follows")
+        and item_type in PIPELINE_STAGES[service].get("item_types", [item_type])
+    }
+    for stage, definition in PIPELINE_STAGES.items():
+        if definition.get("follows") and planned.intersection(definition["after"]):
+            planned.add(stage)
+    return {
+        stage: [
+            dependency for dependency in stage_inputs(stage) if dependency in planned
+        ]
+        for stage in PIPELINE_STAGES
+        if stage in planned
+    }
+
+
+def iter_classifications(result):
+    """Flatten yolo_cls results of an image or of all the frames of a video."""
+    for entry in result or []:
+        if isinstance(entry, list):
+            yield from iter_classifications(entry)
+        elif isinstance(entry, dict):
+            yield entry
+
+
+def logo_gate(yolo_cls_result):
+    """True if any frame has a logo-bearing class among its top-5 classes."""
+    for classification in iter_classifications(yolo_cls_result):
+        for name, confidence in zip(
+            classification.get("top5_class_names", []),
+            classification.get("top5_confidences", []),
+        ):
+            if (
+                name in YOLO_LOGO_GATE_CLASSES
+                and confidence >= YOLO_LOGO_GATE_MIN_CONFIDENCE
+            ):
+                return True
+    return False
+
+
+# Gate name -> (input stage, predicate on the input's result)
+STAGE_GATES = {"logo": ("yolo_cls", logo_gate)}
+
+
+def critical_path(pipeline):
+    """
+    Return the chain of stages that determined the latency of an item: starting from
+    the stage that finished last, follow the input that finished last.
+    """
+    stages = pipeline["stages"]
+    finished = {
+        stage: state
+        for stage, state in stages.items()
+        if state.get("completed_at") is not None
+    }
+    if not finished:
+        return None
+
+    path = []
+    stage = max(finished, key=lambda name: finished[name]["completed_at"])
+    while stage:
+        state = finished[stage]
+        path.append(
+            {
+                "stage": stage,
+                "dispatched_after": round(
+                    state.get("dispatched_at", pipeline["created_at"])
+                    - pipeline["created_at"],
+                    3,
+                ),
+                "duration": round(
+                    state["completed_at"]
+                    - state.get("dispatched_at", pipeline["created_at"]),
+                    3,
+                ),
+            }
+        )
+        inputs = [name for name in state.get("after", []) if name in finished]
+        stage = max(
+            inputs, key=lambda name: finished[name]["completed_at"], default=None
+        )
+
+    path.reverse()
+    end = finished[path[-1]["stage"]]["completed_at"]
+    return {
+        "stages": path,
+        "latency": round(end - pipeline["created_at"], 3),
+    }
@@ -0,0 +1,56 @@
+import os
+from urllib.parse import quote
+import requests
+from common.messaging import (
+    LANE_WEIGHTS,
+    RABBITMQ_DEFAULT_PASS,
+    RABBITMQ_DEFAULT_USER,
+    lane_queue_name,
+    service_binding,
+)
+
+# RabbitMQ management API (queue depths and consumers)
+RABBITMQ_MANAGEMENT_URL = os.getenv(
+    "RABBITMQ_MANAGEMENT_URL", "http://rabbitmq:15672"
+).rstrip("/")
+RABBITMQ_VHOST = os.getenv("RABBITMQ_VHOST", "/")
+
+
+def service_queues(service):
+    """Queues (one per lane) consumed by the replicas of a service."""
+    queue_name, _ = service_binding(service)
+    return [lane_queue_name(queue_name, lane) for lane in LANE_WEIGHTS]
+
+
+def fetch_queue_stats(timeout=10):
+    """Return {queue: stats} for every queue of the vhost from the management API."""
+    response = requests.get(
+        f"{RABBITMQ_MANAGEMENT_URL}/api/queues/{quote(RABBITMQ_VHOST, safe='')}",
+        params={"columns": "name,messages_ready,messages_unacknowledged,consumers"},
+        auth=(RABBITMQ_DEFAULT_USER, RABBITMQ_DEFAULT_PASS),
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return {
+        queue["name"]: {
+            "ready": queue.get("messages_ready", 0),
+            "unacked": queue.get("messages_unacknowledged", 0),
+            "consumers": queue.get("consumers", 0),
+        }
+        for queue in response.json()
+    }
+
+
+def service_depth(service, queues):
+    """
+    Sum the stats of the lanes of a service. Every replica consumes all the lanes, so
+    the replicas are the consumers of one lane.
+    """
+    stats = [queues.get(name, {}) for name in service_queues(service)]
+    consumers = sum(queue.get("consumers", 0) for queue in stats)
+    return {
+        "ready": sum(queue.get("ready", 0) for queue in stats),
+        "unacked": sum(queue.get("unacked", 0) for queue in stats),
+        "consumers": consumers,
+        "replicas": consumers // len(stats),
+    }
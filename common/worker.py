@@ -0,0 +1,438 @@
+import os
+import json
+import time
+import signal
+import hashlib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pika
+import requests
+from common.cancellation import (
+    CANCELLATION_EXCHANGE,
+    JobCancelled,
+    declare_cancellation_exchange,
+    record_cancellation,
+)
+from common.messaging import (
+    ATTEMPT_HEADER,
+    DEAD_LETTER_QUEUE,
+    MAX_DELIVERY_ATTEMPTS,
+    LANE_WEIGHTS,
+    RABBITMQ_PREFETCH_COUNT,
+    declare_service_queue,
+    get_connection_parameters,
+    lane_queue_name,
+    service_binding,
+)
+
+# Jobs a worker process runs at the same time (each on its own thread)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))
+# Seconds to wait for running jobs to finish after SIGTERM before exiting anyway
+# (keep it below the stop_grace_period of the containers in docker-compose.yml)
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", 300))
+RECONNECT_DELAY = 5
+RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
+
+
+def record_job_start(body):
+    """
+    Count a start of a job in the result service and return how many times it started,
+    this one included (None when the result service cannot be reached).
+    """
+    job_id = hashlib.sha256(body).hexdigest()
+    try:
+        response = requests.post(
+            f"{RESULT_SERVICE_URL}/jobs/started", json={"job_id": job_id}, timeout=5
+        )
+        response.raise_for_status()
+        return response.json()["starts"]
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to record the start of job {job_id}: {str(e)}")
+        return None
+
+
+class Worker:
+    """
+    RabbitMQ consumer runtime for long-running jobs.
+
+    pika connections are not thread-safe and only send heartbeats while their thread
+    is serving I/O, so jobs (model inference can take minutes) run on a thread pool
+    while the main thread keeps serving the connection. Acknowledgements, retries and
+    dead-lettering are handed back to the connection thread with
+    add_callback_threadsafe.
+
+    Jobs are acknowledged only once their handler returns. A failed job is re-queued
+    with the next attempt number and, after MAX_DELIVERY_ATTEMPTS, moved to the
+    dead-letter queue; on_give_up(message, error) is then called so the failure can be
+    recorded. Starts are counted in the result service (record_job_start): a job that
+    started before without finishing (its worker died or lost the connection) counts
+    as a failed attempt, while a job redelivered before it ever started does not.
+    Handlers must therefore be idempotent.
+
+    Several queues (e.g. the lanes of a service) can be consumed. Their deliveries wait
+    in a local queue per consumer and the connection thread starts them on the free
+    threads by smooth weighted round-robin, so a consumer of weight 4 gets up to 4 jobs
+    for every job of a consumer of weight 1 while both have work, and all of them
+    while the other is idle. While a thread is free each consumer prefetches weight
+    times the prefetch count, so the pick sees the jobs of every consumer. Once every
+    thread is busy the channel is limited to the prefetch count and the jobs it holds
+    beyond it are given back, so jobs do not wait behind a long job while other
+    replicas are free.
+
+    A handler raising JobCancelled drops its job: it is acknowledged without a retry.
+
+    On SIGTERM (or SIGINT) the worker stops taking jobs, gives the jobs it has not
+    started back to the queue, waits for the running ones and exits.
+    """
+
+    def __init__(self, setup=None, prefetch_count=None, concurrency=WORKER_CONCURRENCY):
+        # setup(channel) declares the queues, exchanges and bindings to consume
+        self.setup = setup
+        self.concurrency = max(concurrency, 1)
+        self.prefetch_count = max(
+            prefetch_count or RABBITMQ_PREFETCH_COUNT, self.concurrency
+        )
+        self.consumers = []
+        self.listeners = []
+        self.pending = {}
+        self.current_weights = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.connection = None
+        self.channel = None
+        self.consumer_tags = []
+        # Jobs received and not finished (running or waiting to start)
+        self.in_flight = 0
+        self.running = 0
+        # Running jobs received on the current channel
+        self.channel_running = 0
+        # Whether the channel is limited to the prefetch count (every thread busy)
+        self.throttled = False
+        self.lock = threading.Lock()
+        self.draining = False
+
+    def add_consumer(self, queue_name, handler, on_give_up=None, weight=1):
+        """
+        Consume queue_name with handler(ch, method, properties, body), a regular pika
+        callback that raises on failure.
+        """
+        self.consumers.append((queue_name, handler, on_give_up, weight))
+        self.pending[queue_name] = deque()
+        self.current_weights[queue_name] = 0
+
+    def add_listener(self, exchange, callback, setup=None):
+        """
+        Call callback(message) for every message broadcast on a fanout exchange while
+        connected. Listeners run on the connection thread, so they must return quickly.
+        setup(channel) declares the exchange.
+        """
+        self.listeners.append((exchange, callback, setup))
+
+    def run(self):
+        """Consume until SIGTERM, reconnecting whenever the connection is lost."""
+        signal.signal(signal.SIGTERM, self._request_drain)
+        signal.signal(signal.SIGINT, self._request_drain)
+
+        while not self.draining:
+            try:
+                logging.info("Connecting to RabbitMQ...")
+                self._connect()
+                logging.info("Connected to RabbitMQ")
+                self._serve()
+            except pika.exceptions.AMQPError as e:
+                if self.draining:
+                    break
+                logging.error(
+                    f"Connection to RabbitMQ failed, retrying in {RECONNECT_DELAY} seconds: {str(e)}"
+                )
+                time.sleep(RECONNECT_DELAY)
+
+        self._drain()
+
+    def _connect(self):
+        # Jobs received but not started on the previous connection are redelivered by
+        # the broker, running them as well would run them twice
+        with self.lock:
+            for queue_name, jobs in self.pending.items():
+                self.in_flight -= len(jobs)
+                jobs.clear()
+        self.connection = pika.BlockingConnection(get_connection_parameters())
+        self.channel = self.connection.channel()
+        self.channel_running = 0
+        self.throttled = False
+        if self.setup:
+            self.setup(self.channel)
+        self.channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+        self.consumer_tags = []
+        for queue_name, handler, on_give_up, weight in self.consumers:
+            # The prefetch limit applies per consumer: a consumer of weight w holds up
+            # to w jobs per thread while a thread is free, so the weighted pick sees
+            # enough of its jobs to apply the weight (see _dispatch for the limit of the
+            # channel once every thread is busy)
+            self.channel.basic_qos(prefetch_count=self.prefetch_count * weight)
+            self.consumer_tags.append(
+                self.channel.basic_consume(
+                    queue=queue_name,
+                    on_message_callback=self._on_message(
+                        queue_name, handler, on_give_up
+                    ),
+                )
+            )
+            logging.info(f"Waiting for messages in '{queue_name}'...")
+        for exchange, callback, setup in self.listeners:
+            if setup:
+                setup(self.channel)
+            # A private queue per worker, so every worker gets every broadcast
+            queue_name = self.channel.queue_declare(
+                queue="", exclusive=True
+            ).method.queue
+            self.channel.queue_bind(queue=queue_name, exchange=exchange)
+            self.consumer_tags.append(
+                self.channel.basic_consume(
+                    queue=queue_name,
+                    on_message_callback=self._on_broadcast(exchange, callback),
+                    auto_ack=True,
+                )
+            )
+            logging.info(f"Listening to broadcasts on '{exchange}'...")
+
+    def _serve(self):
+        # Serving the connection in short slices keeps heartbeats flowing and lets a
+        # drain request be noticed between them
+        while not self.draining:
+            self.connection.process_data_events(time_limit=1)
+            self._dispatch()
+
+    def _request_drain(self, signum, frame):
+        if not self.draining:
+            logging.info(
+                f"Received signal {signum}, finishing {self.in_flight} running jobs"
+            )
+        self.draining = True
+
+    def _drain(self):
+        """Stop consuming, wait for the running jobs and close the connection."""
+        connection_open = self.connection is not None and self.connection.is_open
+        try:
+            if connection_open:
+                for consumer_tag in self.consumer_tags:
+                    self.channel.basic_cancel(consumer_tag)
+                deadline = time.time() + WORKER_DRAIN_TIMEOUT
+                self._give_back(self._pending_count())
+                while self.in_flight and time.time() < deadline:
+                    # Keep serving heartbeats and the acks of finishing jobs
+                    self.connection.process_data_events(time_limit=1)
+                    # Jobs delivered before the consumers were cancelled
+                    self._give_back(self._pending_count())
+        except pika.exceptions.AMQPError as e:
+            logging.error(f"Connection lost while draining: {str(e)}")
+        finally:
+            self.executor.shutdown(wait=False)
+            if connection_open and self.connection.is_open:
+                self.connection.close()
+        logging.info(f"Worker stopped ({self.in_flight} jobs left unfinished)")
+
+    def _on_message(self, queue_name, handler, on_give_up):
+        def on_message(ch, method, properties, body):
+            # Started by _dispatch once the deliveries received with it are in too
+            with self.lock:
+                self.in_flight += 1
+                self.pending[queue_name].append(
+                    (ch, method, properties, body, queue_name, handler, on_give_up)
+                )
+
+        return on_message
+
+    @staticmethod
+    def _on_broadcast(exchange, callback):
+        def on_broadcast(ch, method, properties, body):
+            try:
+                callback(json.loads(body))
+            except Exception as e:
+                logging.error(f"Failed to handle a broadcast on {exchange}: {str(e)}")
+
+        return on_broadcast
+
+    def _dispatch(self):
+        """
+        Start the received jobs on the free threads (on the connection thread). Once
+        every thread is busy the unacknowledged jobs of the channel are limited to the
+        prefetch count, and the jobs it holds beyond that are given back to their queue.
+        """
+        while self.running < self.concurrency:
+            job = self._next_job()
+            if job is None:
+                break
+            with self.lock:
+                self.running += 1
+                self.channel_running += 1
+            self.executor.submit(self._run_job, *job)
+
+        busy = self.running >= self.concurrency
+        if busy != self.throttled:
+            # A limit of 0 lifts the channel limit, leaving the limit of each consumer
+            self.channel.basic_qos(
+                prefetch_count=self.prefetch_count if busy else 0, global_qos=True
+            )
+            self.throttled = busy
+        if busy:
+            self._give_back(
+                self._pending_count()
+                - max(self.prefetch_count - self.channel_running, 0)
+            )
+
+    def _next_job(self):
+        """Take the next received job by smooth weighted round-robin (None if none)."""
+        with self.lock:
+            candidates = [
+                (queue_name, weight)
+                for queue_name, _, _, weight in self.consumers
+                if self.pending[queue_name]
+            ]
+            if not candidates:
+                return None
+            total = sum(weight for _, weight in candidates)
+            for queue_name, weight in candidates:
+                self.current_weights[queue_name] += weight
+            queue_name = max(
+                (queue_name for queue_name, _ in candidates),
+                key=lambda name: self.current_weights[name],
+            )
+            self.current_weights[queue_name] -= total
+            return self.pending[queue_name].popleft()
+
+    def _pending_count(self):
+        with self.lock:
+            return sum(len(jobs) for jobs in self.pending.values())
+
+    def _give_back(self, count):
+        """Requeue up to count received jobs, the last ones of the lightest consumers first."""
+        by_weight = sorted(self.consumers, key=lambda consumer: consumer[3])
+        for queue_name, _, _, _ in by_weight:
+            jobs = self.pending[queue_name]
+            while count > 0 and jobs:
+                with self.lock:
+                    ch, method = jobs.pop()[:2]
+                    self.in_flight -= 1
+                count -= 1
+                try:
+                    ch.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+                except pika.exceptions.AMQPError as e:
+                    # The broker redelivers it with the lost connection anyway
+                    logging.error(f"Could not give a job back: {str(e)}")
+
+    def _run_job(self, ch, method, properties, body, queue_name, handler, on_give_up):
+        """Run a job on a pool thread and hand the outcome back to the connection thread."""
+        ack = lambda: ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        if not ch.is_open:
+            # Its connection was lost before it started: the broker redelivers it
+            self._job_done(ch)
+            return
+
+        headers = dict(properties.headers or {})
+        attempt = headers.get(ATTEMPT_HEADER, 1)
+        starts = record_job_start(body)
+        if starts is not None and starts > attempt:
+            # Earlier starts never finished (the worker died or lost its connection)
+            attempt = starts
+
+        error = None
+        if attempt > MAX_DELIVERY_ATTEMPTS:
+            error = "started before but never finished"
+            attempt = MAX_DELIVERY_ATTEMPTS
+        else:
+            try:
+                handler(ch, method, properties, body)
+            except JobCancelled as e:
+                logging.info(f"Job from {queue_name} dropped, item {e} was cancelled")
+            except Exception as e:
+                error = e
+
+        if error is None:
+            self._finish(ch, ack)
+            return
+
+        if attempt < MAX_DELIVERY_ATTEMPTS:
+            logging.warning(
+                f"Job from {queue_name} failed (attempt {attempt}/{MAX_DELIVERY_ATTEMPTS}), retrying: {error}"
+            )
+            headers[ATTEMPT_HEADER] = attempt + 1
+            routing_key = queue_name
+        else:
+            logging.error(
+                f"Job from {queue_name} failed {attempt} times, moving it to {DEAD_LETTER_QUEUE}: {error}"
+            )
+            headers.update(
+                {"x-original-queue": queue_name, "x-error": str(error)[:1000]}
+            )
+            routing_key = DEAD_LETTER_QUEUE
+            if on_give_up:
+                try:
+                    on_give_up(json.loads(body), error)
+                except Exception as e:
+                    logging.error(f"Failed to report the dead-lettered job: {str(e)}")
+
+        self._finish(ch, lambda: self._publish(ch, routing_key, body, headers), ack)
+
+    @staticmethod
+    def _publish(channel, queue_name, body, headers):
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue_name,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2, headers=headers),
+        )
+
+    def _finish(self, channel, *callbacks):
+        """
+        Run the callbacks of a finished job in order on the connection thread (channels
+        are not thread-safe); the job only stops counting as running once they ran.
+        """
+
+        def run():
+            try:
+                for callback in callbacks:
+                    callback()
+            except pika.exceptions.AMQPError as e:
+                logging.error(f"Could not acknowledge the job: {str(e)}")
+            finally:
+                self._job_done(channel)
+
+        try:
+            channel.connection.add_callback_threadsafe(run)
+        except Exception as e:
+            # The delivery died with its connection, the broker will redeliver the job
+            logging.error(f"Could not acknowledge the job, connection lost: {str(e)}")
+            self._job_done(channel)
+
+    def _job_done(self, channel):
+        with self.lock:
+            self.in_flight -= 1
+            self.running -= 1
+            if channel is self.channel:
+                self.channel_running -= 1
+
+
+def run_service_worker(service, handler, on_give_up=None, prefetch_count=None):
+    """
+    Consume every lane of an analysis service, weighted by LANE_WEIGHTS, until SIGTERM.
+
+    The handler runs on a worker thread (see Worker), so the connection keeps sending
+    heartbeats during long inference.
+    """
+    worker = Worker(
+        setup=lambda channel: declare_service_queue(channel, service),
+        prefetch_count=prefetch_count,
+    )
+    queue_name, _ = service_binding(service)
+    for lane, weight in LANE_WEIGHTS.items():
+        worker.add_consumer(
+            lane_queue_name(queue_name, lane), handler, on_give_up, weight=weight
+        )
+    # Cancelled items are broadcast so running and queued jobs can stop (stop_reason)
+    worker.add_listener(
+        CANCELLATION_EXCHANGE, record_cancellation, declare_cancellation_exchange
+    )
+    worker.run()
@@ -1,179 +1,509 @@
-import pika
 import json
 import logging
+import os
 import time
+import boto3
+import requests
+from common.cancellation import CANCELLATION_EXCHANGE, declare_cancellation_exchange
+from common.messaging import (
+    ANALYSIS_EXCHANGE,
+    FAST_LANE,
+    SERVICE_BINDINGS,
+    STANDARD_LANE,
+    STAGE_EVENTS_QUEUE,
+    declare_service_queue,
+    get_publisher,
+    job_routing_key,
+)
+from common.pipeline import (
+    CANCELLED,
+    FAILED,
+    PENDING,
+    PIPELINE_STAGES,
+    RUNNING,
+    SKIPPED,
+    STAGE_GATES,
+    TERMINAL_STATUSES,
+    USABLE_STATUSES,
+    critical_path,
+    plan_stages,
+)
+from common.frame_shards import load_frame_index, split_frame_entries
+from common.worker import Worker
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO)
 
+RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
+BUCKET_NAME = os.getenv("BUCKET_NAME", "data-extraction-file-storage-thesis")
+# Unacknowledged messages the coordinator receives at a time
+COORDINATOR_PREFETCH_COUNT = int(os.getenv("COORDINATOR_PREFETCH_COUNT", 10))
+# Items with at most this much estimated work (frames x services) use the fast lane
+FAST_LANE_MAX_WORK = int(os.getenv("FAST_LANE_MAX_WORK", 20))
+# Frames per job when the frames of a video are split across service replicas
+# (0 sends every frame of the video to a single replica)
+FRAMES_PER_JOB = int(os.getenv("FRAMES_PER_JOB", 32))
 
-# Publish message to the appropriate service queue
-def publish_to_queue(queue_name, message):
-    credentials = pika.PlainCredentials("user", "password")
+# Services that analyse video frames (and accept frame batches)
+FRAME_SERVICES = {"yolo", "yolo_cls", "yolo_logo", "ocr"}
+
+# Pipeline state of the items in progress, also persisted in the result service
+pipelines = {}
+
+# Initialize an S3 client (to read the frame index of videos)
+s3 = boto3.client("s3")
+
+
+def publish_job(item_type, services, message, lane=STANDARD_LANE):
+    """
+    Publish a job once to the analysis exchange. The routing key lists the lane and
+    the requested services, and each service queue of the lane receives a copy
+    through its binding.
+    """
+    publish_jobs(item_type, services, [message], lane)
+
+
+def publish_jobs(item_type, services, messages, lane=STANDARD_LANE):
+    """Publish several jobs for the same services back to back (see publish_job)."""
+    services = [service for service in services if service in SERVICE_BINDINGS]
+    if not services or not messages:
+        return
+    routing_key = job_routing_key(item_type, services, lane)
+    # Jobs list their services, so a worker running several models (the shared vision
+    # queue) knows which ones a job requested
+    messages = [{**message, "services": services} for message in messages]
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
+        get_publisher().publish_batch(
+            [(routing_key, message) for message in messages],
+            exchange=ANALYSIS_EXCHANGE,
         )
-        channel = connection.channel()
-        channel.queue_declare(queue=queue_name, durable=True)
-        channel.basic_publish(
-            exchange="", routing_key=queue_name, body=json.dumps(message)
+        logging.info(
+            f"Published {len(messages)} jobs to {ANALYSIS_EXCHANGE} ({routing_key}): {messages[0]}"
         )
-        logging.info(f"Published to {queue_name}: {message}")
     except Exception as e:
-        logging.error(f"Failed to publish to {queue_name}. Error: {str(e)}")
-    finally:
-        connection.close()
+        logging.error(
+            f"Failed to publish to {ANALYSIS_EXCHANGE} ({routing_key}). Error: {str(e)}"
+        )
+        raise
 
 
-def process_message(ch, method, properties, body):
+def assign_lane(item_type, services, estimated_frames, priority=None):
+    """
+    Pick the lane of an item: a client priority of "high" or "low" decides, otherwise
+    images and items with little estimated work (frames x services) use the fast lane.
+    """
+    if priority == "high":
+        return FAST_LANE
+    if priority == "low":
+        return STANDARD_LANE
+    if item_type == "image":
+        return FAST_LANE
+    work = max(estimated_frames or 0, 1) * max(len(services), 1)
+    return FAST_LANE if work <= FAST_LANE_MAX_WORK else STANDARD_LANE
+
+
+def create_pipeline(
+    item_id,
+    item_type,
+    services,
+    estimated_frames=None,
+    priority=None,
+    deadline=None,
+):
+    """Plan the stages of an item; every stage starts pending."""
+    stages = plan_stages(services, item_type)
+    pipeline = {
+        "item_id": item_id,
+        "item_type": item_type,
+        "lane": assign_lane(item_type, stages, estimated_frames, priority),
+        # Timestamp after which no stage is started (running ones save partial results)
+        "deadline": deadline,
+        "created_at": time.time(),
+        "job": None,
+        "stages": {
+            stage: {"status": PENDING, "after": inputs}
+            for stage, inputs in stages.items()
+        },
+        "critical_path": None,
+    }
+    pipelines[item_id] = pipeline
+    logging.info(
+        f"Planned item {item_id} on the {pipeline['lane']} lane with stages: {stages}"
+    )
+    return pipeline
+
+
+def load_pipeline(item_id):
+    """Return the pipeline of an item, restoring it from the result service if needed."""
+    if item_id in pipelines:
+        return pipelines[item_id]
     try:
-        message = json.loads(body)
-        logging.info(f"Parsed message: {message}")
-        item_id = message["item_id"]
-        item_type = message["item_type"]
-        services = message["services"]
-        paths = message["paths"]  # Get the paths for video, frames, or image
-        languages = message["languages"]
+        response = requests.get(f"{RESULT_SERVICE_URL}/pipeline/{item_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        pipelines[item_id] = response.json()["pipeline"]
+        return pipelines[item_id]
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to load the pipeline of item {item_id}: {str(e)}")
+        raise
 
-        logging.info(
-            f"Received message to process item {item_id} with services: {services} and paths: {paths}"
+
+def save_pipeline(pipeline):
+    """Persist the stage state of an item in the result service."""
+    try:
+        response = requests.post(
+            f"{RESULT_SERVICE_URL}/pipeline/state",
+            json={"item_id": pipeline["item_id"], "pipeline": pipeline},
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(
+            f"Failed to save the pipeline of item {pipeline['item_id']}: {str(e)}"
         )
 
-        # Send messages to specific service queues
-        if "whisper" in services and item_type == "video":
-            publish_to_queue(
-                "whisper_queue",
-                {
-                    "item_id": item_id,
-                    "video_path": paths.get("video_path"),
-                    "languages": languages,
-                },
-            )
 
-        if "yolo_cls" in services:
-            if item_type == "video":
-                publish_to_queue(
-                    "yolo_cls_queue",
-                    {"item_id": item_id, "frames_path": paths.get("frames_path")},
-                )
-            else:
-                publish_to_queue(
-                    "yolo_cls_queue",
-                    {"item_id": item_id, "image_path": paths.get("image_path")},
-                )
-
-        if "yolo_logo" in services:
-            if item_type == "video":
-                publish_to_queue(
-                    "yolo_logo_queue",
-                    {"item_id": item_id, "frames_path": paths.get("frames_path")},
-                )
-            else:
-                publish_to_queue(
-                    "yolo_logo_queue",
-                    {"item_id": item_id, "image_path": paths.get("image_path")},
-                )
-
-        if "yolo" in services:
-            if item_type == "video":
-                publish_to_queue(
-                    "yolo_queue",
-                    {"item_id": item_id, "frames_path": paths.get("frames_path")},
-                )
-            else:
-                publish_to_queue(
-                    "yolo_queue",
-                    {"item_id": item_id, "image_path": paths.get("image_path")},
-                )
-
-        if "ocr" in services:
-            if item_type == "video":
-                publish_to_queue(
-                    "ocr_queue",
-                    {
-                        "item_id": item_id,
-                        "frames_path": paths.get("frames_path"),
-                        "languages": languages,
-                    },
-                )
-            else:
-                publish_to_queue(
-                    "ocr_queue",
-                    {
-                        "item_id": item_id,
-                        "image_path": paths.get("image_path"),
-                        "languages": languages,
-                    },
-                )
+def save_shard_plan(item_id, services, batches):
+    """Tell the result service how many frame batches to merge for each service."""
+    try:
+        response = requests.post(
+            f"{RESULT_SERVICE_URL}/results/shards",
+            json={"item_id": item_id, "services": services, "batches": batches},
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to save the shard plan of item {item_id}: {str(e)}")
+        raise
 
-        logging.info(f"Processed item {item_id} with services: {services}")
 
-    except Exception as e:
-        logging.error(f"Error processing message: {str(e)}")
+def publish_frame_jobs(pipeline, services):
+    """
+    Split the frames of a video into jobs of FRAMES_PER_JOB frames, published as
+    independent frame batches so every replica of a service can take a share. The
+    result service merges the batch results in frame order (like the frame batches
+    dispatched during extraction) before marking each service completed.
+    """
+    job = pipeline["job"]
+    lane = pipeline.get("lane", STANDARD_LANE)
+    index = None
+    if FRAMES_PER_JOB > 0:
+        index = load_frame_index(s3, BUCKET_NAME, job["frames_path"])
+    # Frames stored as single objects have no index to split, they go as one job
+    if index is None:
+        publish_job(pipeline["item_type"], services, job, lane)
+        return
 
+    shards = split_frame_entries(index["frames"], FRAMES_PER_JOB)
+    # The batch count is recorded first, so no batch result can arrive before it
+    save_shard_plan(pipeline["item_id"], services, len(shards))
+    publish_jobs(
+        "frame_batch",
+        services,
+        [
+            {
+                "item_id": pipeline["item_id"],
+                "frames_path": job["frames_path"],
+                "batch": batch,
+                "frames": entries,
+                "languages": job["languages"],
+                "deadline": job.get("deadline"),
+            }
+            for batch, entries in enumerate(shards)
+        ],
+        lane,
+    )
+    logging.info(
+        f"Split the frames of item {pipeline['item_id']} into {len(shards)} jobs for {services}"
+    )
 
-# New function to process Whisper completion and notify Sentiment service
-def process_whisper_completion(ch, method, properties, body):
+
+def get_stage_result(item_id, stage):
+    """Fetch the result of a finished stage from the result service."""
+    response = requests.get(f"{RESULT_SERVICE_URL}/results/{item_id}")
+    response.raise_for_status()
+    return response.json().get(f"{stage}_result")
+
+
+def gate_allows(pipeline, stage):
+    """Evaluate the gate of a stage on the result of its input."""
+    gate = PIPELINE_STAGES[stage].get("gate")
+    if not gate:
+        return True
+    input_stage, predicate = STAGE_GATES[gate]
+    input_state = pipeline["stages"].get(input_stage)
+    # Without a usable input result the stage runs ungated
+    if not input_state or input_state["status"] not in USABLE_STATUSES:
+        return True
     try:
-        message = json.loads(body)
-        logging.info(f"Whisper completion message received: {message}")
-        item_id = message["item_id"]
-        whisper_result = message["whisper_result"]
-
-        # After Whisper is done, trigger Sentiment service
-        logging.info(f"Triggering Sentiment service for item {item_id}")
-        publish_to_queue(
-            "sentiment_queue", {"item_id": item_id, "whisper_result": whisper_result}
-        )
-        logging.info(f"Sentiment processing triggered for item {item_id}")
+        return predicate(get_stage_result(pipeline["item_id"], input_stage))
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to evaluate the gate of {stage}: {str(e)}")
+        return True
 
-    except Exception as e:
-        logging.error(f"Error processing Whisper completion message: {str(e)}")
 
+def advance_pipeline(pipeline):
+    """
+    Dispatch every pending stage whose inputs have all finished (in one publish) and
+    report the critical path once all the stages are done.
+    """
+    # The job (paths of the item) is only known once ingestion has completed
+    if pipeline["job"] is None:
+        save_pipeline(pipeline)
+        return
 
-# Start the coordinator to consume messages from RabbitMQ
-def start_coordinator():
-    credentials = pika.PlainCredentials("user", "password")
+    stages = pipeline["stages"]
+    deadline = pipeline.get("deadline")
+    ready = []
+    # Skipping a stage can unblock the stages that follow it, so repeat until stable
+    skipped = True
+    while skipped:
+        skipped = False
+        for stage, state in stages.items():
+            if state["status"] != PENDING or stage in ready:
+                continue
+            inputs = [stages[name]["status"] for name in state["after"]]
+            if any(status not in TERMINAL_STATUSES for status in inputs):
+                continue
 
-    while True:
-        try:
-            logging.info("Attempting to connect to RabbitMQ...")
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
-            )
-            logging.info("Connected to RabbitMQ")
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                reason = "deadline passed"
+            elif PIPELINE_STAGES[stage].get(
+                "follows"
+            ) and not USABLE_STATUSES.intersection(inputs):
+                reason = "no input completed"
+            elif not gate_allows(pipeline, stage):
+                reason = "gate closed"
+            else:
+                ready.append(stage)
+                continue
+            state.update({"status": SKIPPED, "completed_at": now})
+            logging.info(f"Skipping {stage} of item {pipeline['item_id']}: {reason}")
+            skipped = True
 
-            channel = connection.channel()
+    # Stages are only marked running once published, so a retry dispatches them again
+    frame_stages = []
+    if pipeline["job"].get("frames_path"):
+        frame_stages = [stage for stage in ready if stage in FRAME_SERVICES]
+    publish_job(
+        pipeline["item_type"],
+        [stage for stage in ready if stage not in frame_stages],
+        pipeline["job"],
+        pipeline.get("lane", STANDARD_LANE),
+    )
+    if frame_stages:
+        publish_frame_jobs(pipeline, frame_stages)
+    now = time.time()
+    for stage in ready:
+        stages[stage].update({"status": RUNNING, "dispatched_at": now})
 
-            # Declare the main coordinator queue
-            channel.queue_declare(queue="coordinator_queue", durable=True)
-            logging.info("Waiting for messages in coordinator_queue...")
-            channel.basic_consume(
-                queue="coordinator_queue",
-                on_message_callback=process_message,
-                auto_ack=True,
+    if pipeline["critical_path"] is None and all(
+        state["status"] in TERMINAL_STATUSES for state in stages.values()
+    ):
+        pipeline["critical_path"] = critical_path(pipeline)
+        path = pipeline["critical_path"]
+        if path:
+            chain = " -> ".join(
+                f"{step['stage']} ({step['duration']}s)" for step in path["stages"]
             )
-
-            # Declare the whisper completion queue
-            channel.queue_declare(queue="whisper_complete_queue", durable=True)
             logging.info(
-                "Waiting for Whisper completion messages in whisper_complete_queue..."
-            )
-            channel.basic_consume(
-                queue="whisper_complete_queue",
-                on_message_callback=process_whisper_completion,
-                auto_ack=True,
+                f"Item {pipeline['item_id']} finished in {path['latency']}s, critical path: {chain}"
             )
+    save_pipeline(pipeline)
 
-            # Start consuming messages for both queues
-            channel.start_consuming()
+    if pipeline["critical_path"] is not None:
+        pipelines.pop(pipeline["item_id"], None)
 
-        except pika.exceptions.AMQPConnectionError as e:
-            logging.error(
-                f"Connection to RabbitMQ failed, retrying in 5 seconds: {str(e)}"
-            )
-            time.sleep(5)
+
+def process_frame_batch(message):
+    """Send a batch of extracted frames to the frame services that can start now."""
+    item_id = message["item_id"]
+    batch = message["batch"]
+
+    pipeline = load_pipeline(item_id) or create_pipeline(
+        item_id,
+        "video",
+        message["services"],
+        message.get("estimated_frames"),
+        message.get("priority"),
+        message.get("deadline"),
+    )
+    if pipeline.get("cancelled"):
+        logging.info(f"Item {item_id} was cancelled, ignoring frame batch {batch}")
+        return
+    # Frame services that wait for another stage get the frames (split into jobs)
+    # once they are dispatched
+    services = []
+    started = False
+    for stage, state in pipeline["stages"].items():
+        if stage not in FRAME_SERVICES or state["after"]:
+            continue
+        if state["status"] == PENDING:
+            state.update({"status": RUNNING, "dispatched_at": time.time()})
+            started = True
+        if state["status"] == RUNNING:
+            services.append(stage)
+    if started:
+        save_pipeline(pipeline)
+
+    publish_job(
+        "frame_batch",
+        services,
+        {
+            "item_id": item_id,
+            "frames_path": message["frames_path"],
+            "batch": batch,
+            "frames": message["frames"],
+            "languages": message["languages"],
+            "deadline": pipeline.get("deadline"),
+        },
+        pipeline.get("lane", STANDARD_LANE),
+    )
+    logging.info(f"Dispatched frame batch {batch} of item {item_id}")
+
+
+def process_message(ch, method, properties, body):
+    """Plan and dispatch an ingested item (errors are raised so the message is retried)."""
+    message = json.loads(body)
+    logging.info(f"Parsed message: {message}")
+
+    if message.get("event") == "frame_batch":
+        process_frame_batch(message)
+        return
+    if message.get("event") == "cancel":
+        cancel_item(message["item_id"])
+        return
+
+    item_id = message["item_id"]
+    item_type = message["item_type"]
+    services = message["services"]
+    paths = message["paths"]  # Get the paths for video, frames, or image
+    languages = message["languages"]
+
+    logging.info(
+        f"Received message to process item {item_id} with services: {services} and paths: {paths}"
+    )
+
+    # A single job carries the paths needed by every service: frame services read
+    # frames_path (videos) or image_path (images), whisper reads video_path and
+    # audio_path, and OCR reads the languages
+    job = {
+        "item_id": item_id,
+        "languages": languages,
+        "deadline": message.get("deadline"),
+    }
+    if item_type == "video":
+        job["frames_path"] = paths.get("frames_path")
+        job["video_path"] = paths.get("video_path")
+        job["audio_path"] = paths.get("audio_path")
+    else:
+        job["image_path"] = paths.get("image_path")
+
+    # Pipelined videos already created their pipeline (and started the frame
+    # services) when the first frame batch was dispatched, and items cancelled
+    # during ingestion left a cancelled pipeline
+    pipeline = load_pipeline(item_id)
+    if pipeline is not None and pipeline.get("cancelled"):
+        logging.info(f"Item {item_id} was cancelled, not dispatching it")
+        return
+    if pipeline is None:
+        pipeline = create_pipeline(
+            item_id,
+            item_type,
+            services,
+            message.get("estimated_frames", 1 if item_type == "image" else None),
+            message.get("priority"),
+            message.get("deadline"),
+        )
+    pipeline["job"] = job
+
+    advance_pipeline(pipeline)
+    logging.info(f"Processed item {item_id} with services: {services}")
+
+
+def cancel_item(item_id):
+    """
+    Cancel the unfinished stages of an item and broadcast the cancellation, so the
+    workers drop its queued jobs and stop the running ones between frames.
+    """
+    get_publisher().publish("", {"item_id": item_id}, exchange=CANCELLATION_EXCHANGE)
+
+    pipeline = load_pipeline(item_id)
+    if pipeline is None:
+        # Still being ingested: keep a cancelled pipeline so it is never dispatched
+        pipeline = {
+            "item_id": item_id,
+            "created_at": time.time(),
+            "job": None,
+            "stages": {},
+            "critical_path": None,
+        }
+    pipeline["cancelled"] = True
+    now = time.time()
+    for state in pipeline["stages"].values():
+        if state["status"] not in TERMINAL_STATUSES:
+            state.update({"status": CANCELLED, "completed_at": now})
+    save_pipeline(pipeline)
+    pipelines.pop(item_id, None)
+    logging.info(f"Cancelled item {item_id}")
+
+
+def process_stage_event(ch, method, properties, body):
+    """Record a finished stage and dispatch the stages waiting for it."""
+    message = json.loads(body)
+    item_id = message["item_id"]
+    stage = message["service"]
+    logging.info(f"Stage {stage} of item {item_id} {message['status']}")
+
+    pipeline = load_pipeline(item_id)
+    if pipeline is None or stage not in pipeline["stages"]:
+        logging.info(f"No pipeline stage {stage} for item {item_id}, ignoring")
+        return
+
+    state = pipeline["stages"][stage]
+    if state["status"] in TERMINAL_STATUSES:
+        # Duplicate event, or a retry after the dependent stages failed to publish
+        if not any(s["status"] == PENDING for s in pipeline["stages"].values()):
+            return
+    else:
+        state.update(
+            {
+                "status": (
+                    message["status"]
+                    if message["status"] in USABLE_STATUSES
+                    else FAILED
+                ),
+                "completed_at": time.time(),
+            }
+        )
+    advance_pipeline(pipeline)
+
+
+def declare_queues(channel):
+    # Declare the analysis exchange and bind every service queue, so jobs are
+    # kept even if a service has not started yet
+    for service in SERVICE_BINDINGS:
+        declare_service_queue(channel, service)
+
+    # Declare the main coordinator queue and the queue of finished stages reported
+    # by the result service
+    channel.queue_declare(queue="coordinator_queue", durable=True)
+    channel.queue_declare(queue=STAGE_EVENTS_QUEUE, durable=True)
+
+    # Declare the exchange cancelled items are broadcast on to the workers
+    declare_cancellation_exchange(channel)
+
+
+# Start the coordinator to consume messages from RabbitMQ
+def start_coordinator():
+    # The pipeline state is not shared between threads, so messages are handled one
+    # at a time (off the connection thread, which keeps serving heartbeats)
+    worker = Worker(
+        setup=declare_queues, prefetch_count=COORDINATOR_PREFETCH_COUNT, concurrency=1
+    )
+    worker.add_consumer("coordinator_queue", process_message)
+    worker.add_consumer(STAGE_EVENTS_QUEUE, process_stage_event)
+    worker.run()
 
 
 # Run the coordinator
@@ -0,0 +1,91 @@
+import os
+import logging
+import cv2
+from common.frame_source import decode_image, fetch_frames
+
+# Image loading and preparation shared by the OCR services (ocr_service.py and
+# ocr_service_v2.py), which only differ in how they enhance the grayscale image.
+
+# Frame rendition generated at ingestion to use instead of the full-resolution frames
+FRAME_RENDITION = os.getenv("FRAME_RENDITION", "ocr")
+# Largest image OCR runs on (the rendition is generated at most this large)
+OCR_MAX_SIZE = (1024, 1024)
+OCR_MIN_SIZE = (300, 300)
+
+
+def download_image_from_s3(s3, bucket, file_key, imread_flags=cv2.IMREAD_COLOR):
+    """Download an image from S3 and decode it in memory."""
+    logging.info(f"Downloading {file_key} from S3...")
+    data = s3.get_object(Bucket=bucket, Key=file_key)["Body"].read()
+    logging.info(f"Downloaded {file_key} ({len(data)} bytes)")
+    return decode_image(data, imread_flags)
+
+
+def fetch_ocr_frames(s3, bucket, frames_dir_key, batch_frames, imread_flags):
+    """
+    Yield (frame_number, image) for the frames of a directory, or of a frame batch,
+    downloaded ahead while OCR runs (see fetch_frames). Frames of FRAME_RENDITION are
+    decoded straight to grayscale, the original frames with imread_flags.
+    """
+    return fetch_frames(
+        s3,
+        bucket,
+        frames_dir_key,
+        batch_frames or None,
+        FRAME_RENDITION,
+        imread_flags,
+        rendition_flags=cv2.IMREAD_GRAYSCALE,
+    )
+
+
+def resize_image(img, max_size=OCR_MAX_SIZE, min_size=OCR_MIN_SIZE):
+    """
+    Resize the image to reduce memory usage while keeping the aspect ratio.
+    Only images larger than max_size are resized, images smaller than min_size are kept.
+
+    :param img: Image to be resized (array).
+    :param max_size: Maximum dimensions for the resized image (default is 1024x1024).
+    :param min_size: Minimum dimensions below which resizing will not be applied (default is 300x300).
+    :return: The resized image.
+    """
+    # Get the original dimensions of the image
+    original_height, original_width = img.shape[:2]
+
+    # If the image is already small enough (e.g. a rendition), don't resize
+    if (
+        original_width < min_size[0]
+        or original_height < min_size[1]
+        or (original_width <= max_size[0] and original_height <= max_size[1])
+    ):
+        logging.info("Image is small enough, skipping resizing.")
+        return img
+
+    # Calculate the aspect ratio of the image
+    aspect_ratio = original_width / original_height
+
+    # Determine the new width and height while maintaining the aspect ratio
+    if original_width > original_height:
+        new_width = min(max_size[0], original_width)
+        new_height = int(new_width / aspect_ratio)
+    else:
+        new_height = min(max_size[1], original_height)
+        new_width = int(new_height * aspect_ratio)
+
+    # Resize the image
+    resized_img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+    logging.info(f"Resized image to {new_width}x{new_height}")
+
+    return resized_img
+
+
+def prepare_image(img):
+    """
+    Return the grayscale image OCR runs on: large images are resized and color images
+    converted. Rendition frames were resized at ingestion and decoded in grayscale, so
+    they are returned as they are.
+    """
+    img = resize_image(img)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
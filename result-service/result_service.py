@@ -1,11 +1,15 @@
 from fastapi import FastAPI, HTTPException, Query
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
 from pydantic import BaseModel, model_validator
 import os
+import logging
+from itertools import zip_longest
 from dotenv import load_dotenv
-from typing import Union, List, Dict
+from typing import Any, Union, List, Dict, Optional
 import boto3
 from fastapi.responses import StreamingResponse
+from common.messaging import STAGE_EVENTS_QUEUE, get_publisher
+from common.pipeline import PIPELINE_STAGES, SKIPPED
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,6 +28,21 @@ mongo_uri = f"mongodb://{mongo_user}:{mongo_password}@{mongo_host}:{mongo_port}/
 client = MongoClient(mongo_uri)
 db = client[mongo_db]
 collection = db["processing_results"]
+# Index used to find earlier uploads of the same content with the same settings
+collection.create_index("dedup_key")
+# Index used to find the uploads held by admission control
+collection.create_index("ingestion_status")
+# Starts of every analysis job, so a redelivered job only counts as a failed attempt if
+# it had started (see common.worker); forgotten after JOB_STARTS_TTL seconds
+JOB_STARTS_TTL = int(os.getenv("JOB_STARTS_TTL", 7 * 24 * 60 * 60))
+job_starts = db["job_starts"]
+job_starts.create_index("job_id", unique=True)
+job_starts.create_index("updated_at", expireAfterSeconds=JOB_STARTS_TTL)
+
+# Services whose video results can arrive in frame batches
+FRAME_SERVICES = ["yolo", "yolo_cls", "yolo_logo", "ocr"]
+# Statuses after which a service result is final
+FINAL_STATUSES = ("completed", "partial", "failed", "cancelled")
 
 # Initialize S3 client
 s3_client = boto3.client("s3")
@@ -38,11 +57,39 @@ class ResultModel(BaseModel):
 
     @model_validator(mode="after")
     def check_status(self):
-        if self.status not in {"pending", "completed", "failed"}:
-            raise ValueError("Status must be 'pending', 'completed', or 'failed'")
+        if self.status not in {"pending", "completed", "partial", "failed"}:
+            raise ValueError(
+                "Status must be 'pending', 'completed', 'partial', or 'failed'"
+            )
+        return self
+
+
+class BatchResultModel(BaseModel):
+    item_id: str
+    service: str
+    batch: int
+    frames: List[int]
+    result: List[Any]
+    status: str
+
+    @model_validator(mode="after")
+    def check_status(self):
+        if self.status not in {"completed", "partial", "failed"}:
+            raise ValueError("Status must be 'completed', 'partial', or 'failed'")
+        # Results of the first frames only when the batch stopped early
+        if len(self.result) > len(self.frames) or (
+            self.status == "completed" and len(self.result) != len(self.frames)
+        ):
+            raise ValueError("A batch needs one result per processed frame")
         return self
 
 
+class ShardPlanModel(BaseModel):
+    item_id: str
+    services: List[str]
+    batches: int
+
+
 class UploadModel(BaseModel):
     item_id: str
     services: List[str]
@@ -50,6 +97,125 @@ class UploadModel(BaseModel):
     s3_file_key: str
     video_length: float
     languages: List[str]
+    ingestion_status: str = "completed"
+    content_hash: Optional[str] = None
+    reused_from: Optional[str] = None
+    sampling_mode: str = "interval"
+    # Settings needed to dispatch an upload held by admission control
+    held_request: Optional[Dict[str, Any]] = None
+
+
+class ReleaseModel(BaseModel):
+    item_id: str
+
+
+class JobStartModel(BaseModel):
+    job_id: str
+
+
+class PipelineModel(BaseModel):
+    item_id: str
+    pipeline: Dict[str, Any]
+
+
+class LookupModel(BaseModel):
+    content_hash: str
+    services: List[str]
+    languages: List[str]
+    frame_second: int = 0
+    sampling_mode: str = "interval"
+
+
+class IngestionModel(BaseModel):
+    item_id: str
+    ingestion_status: str
+    video_length: Optional[float] = None
+    frames_extracted: Optional[int] = None
+    frame_timestamps: Optional[List[float]] = None
+    frame_batches: Optional[int] = None
+    ingestion_error: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_status(self):
+        if self.ingestion_status not in {
+            "ingesting",
+            "extracting",
+            "completed",
+            "failed",
+            "cancelled",
+        }:
+            raise ValueError(
+                "Ingestion status must be 'ingesting', 'extracting', 'completed', 'failed', or 'cancelled'"
+            )
+        return self
+
+
+def normalize_services(services):
+    """Return the services that will run for a request (e.g. sentiment follows whisper and OCR)."""
+    services = set(services)
+    for stage, definition in PIPELINE_STAGES.items():
+        if definition.get("follows") and services.intersection(definition["after"]):
+            services.add(stage)
+    return sorted(services)
+
+
+def publish_stage_event(item_id, service, status):
+    """Tell the coordinator that a service finished, so it can start the next stages."""
+    try:
+        get_publisher().publish(
+            STAGE_EVENTS_QUEUE,
+            {"item_id": item_id, "service": service, "status": status},
+        )
+    except Exception as e:
+        logging.error(
+            f"Failed to publish the {service} stage event of item {item_id}: {str(e)}"
+        )
+
+
+def build_dedup_key(content_hash, services, languages, frame_second, sampling_mode):
+    """Key identifying the same content processed with the same settings."""
+    return ":".join(
+        [
+            content_hash,
+            ",".join(normalize_services(services)),
+            ",".join(sorted(set(languages))),
+            str(frame_second or 0),
+            sampling_mode,
+        ]
+    )
+
+
+def resolve_reused_results(documents, include_results=True):
+    """
+    Fill the service results and statuses of items created from a duplicate upload
+    with the ones of the item they reuse, so they look like regular items.
+    """
+    source_ids = {doc["reused_from"] for doc in documents if doc.get("reused_from")}
+    if not source_ids:
+        return documents
+
+    sources = {
+        source["item_id"]: source
+        for source in collection.find(
+            {"item_id": {"$in": list(source_ids)}}, {"_id": 0}
+        )
+    }
+    for doc in documents:
+        source = sources.get(doc.get("reused_from"))
+        if not source:
+            continue
+        for service in doc.get("services", []):
+            fields = [f"{service}_status"]
+            if include_results:
+                fields.append(f"{service}_result")
+            for field in fields:
+                if field in source:
+                    doc[field] = source[field]
+        if include_results and "frame_timestamps" in source:
+            doc["frame_timestamps"] = source["frame_timestamps"]
+        if "updated_at" in source:
+            doc["updated_at"] = source["updated_at"]
+    return documents
 
 
 @app.get("/results/{item_id}")
@@ -58,17 +224,33 @@ async def get_results(item_id: str):
     try:
         result = collection.find_one({"item_id": item_id}, {"_id": 0})
         if result:
-            return result
+            return resolve_reused_results([result])[0]
         else:
             raise HTTPException(status_code=404, detail="Item not found")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/results/save")
 async def save_result(result_data: ResultModel):
-    """Save the results for a specific service."""
+    """
+    Save the results for a specific service. Jobs can be delivered more than once, so
+    a completed result is never replaced by a later failed or pending one, and results
+    of cancelled services are dropped.
+    """
     try:
+        existing = collection.find_one(
+            {"item_id": result_data.item_id},
+            {"_id": 0, f"{result_data.service}_status": 1},
+        )
+        existing_status = (existing or {}).get(f"{result_data.service}_status")
+        if existing_status == "cancelled":
+            return {"message": "Service cancelled, update ignored"}
+        if existing_status == "completed" and result_data.status != "completed":
+            return {"message": "Result already completed, update ignored"}
+
         # Update the result of the service in MongoDB
         collection.update_one(
             {"item_id": result_data.item_id},
@@ -81,27 +263,252 @@ async def save_result(result_data: ResultModel):
             },
             upsert=True,
         )
+        if result_data.status in FINAL_STATUSES:
+            publish_stage_event(
+                result_data.item_id, result_data.service, result_data.status
+            )
         return {"message": "Result saved successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def merge_batch_results(item_id, service):
+    """
+    Once every frame batch of a service has reported, merge the batch results in frame
+    order into the service result and mark it completed (partial if a batch stopped at
+    the deadline of the item, failed if a batch failed).
+
+    The result keeps one entry per frame, matching frame_timestamps by position:
+    frames a batch did not process (it stopped early or failed) are None.
+    """
+    document = collection.find_one(
+        {"item_id": item_id},
+        {
+            "_id": 0,
+            "services": 1,
+            "frame_batches": 1,
+            f"{service}_batch_count": 1,
+            f"{service}_batches": 1,
+            f"{service}_status": 1,
+        },
+    )
+    if not document:
+        return False
+    # Jobs split by the coordinator record their own batch count, frame batches
+    # dispatched during extraction use the batch count of the item
+    batch_count = document.get(f"{service}_batch_count", document.get("frame_batches"))
+    if batch_count is None:
+        return False
+    if service not in document.get("services", []):
+        return False
+    if document.get(f"{service}_status") in FINAL_STATUSES:
+        return True
+
+    batches = document.get(f"{service}_batches", {})
+    if len(batches) < batch_count:
+        return False
+
+    statuses = {batch["status"] for batch in batches.values()}
+    status = "completed"
+    if "failed" in statuses:
+        status = "failed"
+    elif "partial" in statuses:
+        status = "partial"
+    merged = sorted(
+        (
+            (frame, result)
+            for batch in batches.values()
+            for frame, result in zip_longest(batch["frames"], batch["result"])
+        ),
+        key=lambda frame_result: frame_result[0],
+    )
+    collection.update_one(
+        {"item_id": item_id},
+        {
+            "$set": {
+                f"{service}_result": [result for _, result in merged],
+                f"{service}_status": status,
+            },
+            "$unset": {f"{service}_batches": ""},
+            "$currentDate": {"updated_at": True},
+        },
+    )
+    publish_stage_event(item_id, service, status)
+    return True
+
+
+@app.post("/results/batch")
+async def save_batch_result(batch_data: BatchResultModel):
+    """
+    Save the results of one frame batch and merge them when all batches are in.
+    Redelivered batches do not replace a completed batch or an already merged result.
+    """
+    try:
+        existing = collection.find_one(
+            {"item_id": batch_data.item_id},
+            {
+                "_id": 0,
+                f"{batch_data.service}_status": 1,
+                f"{batch_data.service}_batches.{batch_data.batch}.status": 1,
+            },
+        )
+        if existing:
+            stored_batch = existing.get(f"{batch_data.service}_batches", {}).get(
+                str(batch_data.batch), {}
+            )
+            if existing.get(f"{batch_data.service}_status") in FINAL_STATUSES or (
+                stored_batch.get("status") == "completed"
+                and batch_data.status != "completed"
+            ):
+                return {"message": "Batch result already recorded", "merged": False}
+
+        collection.update_one(
+            {"item_id": batch_data.item_id},
+            {
+                "$set": {
+                    f"{batch_data.service}_batches.{batch_data.batch}": {
+                        "frames": batch_data.frames,
+                        "result": batch_data.result,
+                        "status": batch_data.status,
+                    }
+                },
+                "$currentDate": {"updated_at": True},
+            },
+            upsert=True,
+        )
+        merged = merge_batch_results(batch_data.item_id, batch_data.service)
+        return {"message": "Batch result saved successfully", "merged": merged}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/results/shards")
+async def save_shard_plan(plan_data: ShardPlanModel):
+    """
+    Record how many frame batches the jobs of the given services were split into, so
+    their batch results can be merged once all of them are in.
+    """
+    try:
+        collection.update_one(
+            {"item_id": plan_data.item_id},
+            {
+                "$set": {
+                    f"{service}_batch_count": plan_data.batches
+                    for service in plan_data.services
+                },
+                "$currentDate": {"updated_at": True},
+            },
+            upsert=True,
+        )
+        # Batches can all be in before the batch count is known
+        for service in plan_data.services:
+            merge_batch_results(plan_data.item_id, service)
+        return {"message": "Shard plan saved successfully"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/items/{item_id}/cancel")
+async def cancel_item(item_id: str):
+    """
+    Cancel an item: its unfinished services are marked cancelled (later results are
+    dropped), a held upload is never dispatched, and the coordinator is told to skip
+    the remaining stages and broadcast the cancellation to the running workers.
+    """
+    try:
+        item = collection.find_one({"item_id": item_id}, {"_id": 0})
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+
+        cancelled = {
+            f"{service}_status": "cancelled"
+            for service in item.get("services", [])
+            if item.get(f"{service}_status") not in FINAL_STATUSES
+        }
+        if item.get("ingestion_status") in ("held", "ingesting", "extracting"):
+            cancelled["ingestion_status"] = "cancelled"
+        collection.update_one(
+            {"item_id": item_id},
+            {
+                "$set": cancelled,
+                "$currentDate": {"cancelled_at": True, "updated_at": True},
+            },
+        )
+        get_publisher().publish(
+            "coordinator_queue", {"event": "cancel", "item_id": item_id}
+        )
+        return {
+            "message": f"Item {item_id} cancelled.",
+            "cancelled": sorted(cancelled),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/jobs/started")
+async def record_job_start(job: JobStartModel):
+    """Count a start of an analysis job and return how many times it started."""
+    try:
+        document = job_starts.find_one_and_update(
+            {"job_id": job.job_id},
+            {"$inc": {"starts": 1}, "$currentDate": {"updated_at": True}},
+            projection={"_id": 0, "starts": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return {"job_id": job.job_id, "starts": document["starts"]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/items/{item_id}/ingestion")
+async def get_ingestion(item_id: str):
+    """Fetch the ingestion status of an item (e.g. to notice a cancellation)."""
+    try:
+        document = collection.find_one(
+            {"item_id": item_id}, {"_id": 0, "ingestion_status": 1}
+        )
+        if not document:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return {
+            "item_id": item_id,
+            "ingestion_status": document.get("ingestion_status"),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/upload/save")
 async def save_upload(upload_data: UploadModel):
     """Save the item_id with uploaded_at timestamp, requested services, and frame_second."""
     try:
-        # Check if whisper is requested and add sentiment automatically
-        if (
-            "whisper" in upload_data.services
-            and "sentiment" not in upload_data.services
-        ):
-            upload_data.services.append("sentiment")
+        # Add the stages that follow the requested services (e.g. sentiment)
+        upload_data.services = normalize_services(upload_data.services)
 
         # Prepare status for each requested service (set to "pending")
         service_statuses = {
             f"{service}_status": "pending" for service in upload_data.services
         }
 
+        dedup_fields = {}
+        if upload_data.content_hash:
+            dedup_fields["content_hash"] = upload_data.content_hash
+            dedup_fields["dedup_key"] = build_dedup_key(
+                upload_data.content_hash,
+                upload_data.services,
+                upload_data.languages,
+                upload_data.frame_second,
+                upload_data.sampling_mode,
+            )
+        if upload_data.reused_from:
+            dedup_fields["reused_from"] = upload_data.reused_from
+        if upload_data.held_request:
+            dedup_fields["held_request"] = upload_data.held_request
+
         # Insert or update the item_id with uploaded_at timestamp, services, and frame_second
         collection.update_one(
             {"item_id": upload_data.item_id},
@@ -113,7 +520,10 @@ async def save_upload(upload_data: UploadModel):
                     "s3_file_key": upload_data.s3_file_key,
                     "video_length": upload_data.video_length,
                     "languages": upload_data.languages,
+                    "ingestion_status": upload_data.ingestion_status,
+                    "sampling_mode": upload_data.sampling_mode,
                     **service_statuses,  # Add status for each service
+                    **dedup_fields,
                 },
                 "$currentDate": {"uploaded_at": True},
             },
@@ -126,6 +536,188 @@ async def save_upload(upload_data: UploadModel):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/upload/lookup")
+async def lookup_upload(lookup_data: LookupModel):
+    """
+    Find an earlier item with the same content hash and settings whose ingestion and
+    services all completed. Failed, cancelled, partial, skipped, held or unfinished
+    items are never reused, their results are incomplete.
+    """
+    try:
+        dedup_key = build_dedup_key(
+            lookup_data.content_hash,
+            lookup_data.services,
+            lookup_data.languages,
+            lookup_data.frame_second,
+            lookup_data.sampling_mode,
+        )
+        candidates = collection.find(
+            {
+                "dedup_key": dedup_key,
+                "reused_from": None,
+                "ingestion_status": "completed",
+            },
+            {"_id": 0},
+        ).sort("uploaded_at", DESCENDING)
+
+        for candidate in candidates:
+            statuses = [
+                candidate.get(f"{service}_status")
+                for service in candidate.get("services", [])
+            ]
+            if statuses and all(status == "completed" for status in statuses):
+                return {
+                    "item_id": candidate["item_id"],
+                    "s3_file_key": candidate.get("s3_file_key"),
+                    "video_length": candidate.get("video_length", 0),
+                }
+        raise HTTPException(status_code=404, detail="No matching item found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/upload/held")
+async def get_held_upload():
+    """Return the oldest upload held by admission control."""
+    try:
+        item = collection.find_one(
+            {"ingestion_status": "held"},
+            {
+                "_id": 0,
+                "item_id": 1,
+                "services": 1,
+                "frame_second": 1,
+                "s3_file_key": 1,
+                "languages": 1,
+                "sampling_mode": 1,
+                "held_request": 1,
+            },
+            sort=[("uploaded_at", ASCENDING)],
+        )
+        if not item:
+            raise HTTPException(status_code=404, detail="No held upload")
+        return item
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/upload/release")
+async def release_upload(release_data: ReleaseModel):
+    """Claim a held upload for dispatch; only the first caller succeeds."""
+    try:
+        result = collection.update_one(
+            {"item_id": release_data.item_id, "ingestion_status": "held"},
+            {
+                "$set": {"ingestion_status": "ingesting"},
+                "$currentDate": {"ingestion_updated_at": True},
+            },
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=409, detail="Upload is not held")
+        return {"message": f"Upload {release_data.item_id} released."}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def fail_unfinished_services(item_id):
+    """
+    Mark the services of an item that can no longer finish (its ingestion failed) as
+    failed: e.g. frame services that got some batches will never get the batch count.
+    """
+    document = collection.find_one({"item_id": item_id}, {"_id": 0, "services": 1})
+    for service in (document or {}).get("services", []):
+        updated = collection.update_one(
+            {
+                "item_id": item_id,
+                f"{service}_status": {"$nin": [*FINAL_STATUSES, SKIPPED]},
+            },
+            {
+                "$set": {f"{service}_status": "failed"},
+                "$unset": {f"{service}_batches": ""},
+                "$currentDate": {"updated_at": True},
+            },
+        )
+        if updated.modified_count:
+            publish_stage_event(item_id, service, "failed")
+
+
+@app.post("/upload/ingestion")
+async def save_ingestion(ingestion_data: IngestionModel):
+    """Update the ingestion (upload and frame extraction) status of an item."""
+    try:
+        fields = ingestion_data.model_dump(exclude_none=True)
+        # A cancelled item stays cancelled while its ingestion winds down
+        existing = collection.find_one(
+            {"item_id": ingestion_data.item_id}, {"_id": 0, "ingestion_status": 1}
+        )
+        if existing and existing.get("ingestion_status") == "cancelled":
+            fields.pop("ingestion_status")
+        collection.update_one(
+            {"item_id": ingestion_data.item_id},
+            {"$set": fields, "$currentDate": {"ingestion_updated_at": True}},
+            upsert=True,
+        )
+
+        if fields.get("ingestion_status") == "failed":
+            fail_unfinished_services(ingestion_data.item_id)
+
+        # Batches can all be in before the batch count is known
+        if ingestion_data.frame_batches is not None:
+            for service in FRAME_SERVICES:
+                merge_batch_results(ingestion_data.item_id, service)
+        return {
+            "message": f"Ingestion status of item {ingestion_data.item_id} set to {ingestion_data.ingestion_status}."
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/pipeline/state")
+async def save_pipeline(pipeline_data: PipelineModel):
+    """Save the stage state of an item, as tracked by the coordinator."""
+    try:
+        # Stages the coordinator decided not to run will never report a result
+        skipped = {
+            f"{stage}_status": SKIPPED
+            for stage, state in pipeline_data.pipeline.get("stages", {}).items()
+            if state.get("status") == SKIPPED
+        }
+        collection.update_one(
+            {"item_id": pipeline_data.item_id},
+            {
+                "$set": {"pipeline": pipeline_data.pipeline, **skipped},
+                "$currentDate": {"pipeline_updated_at": True},
+            },
+            upsert=True,
+        )
+        return {"message": f"Pipeline of item {pipeline_data.item_id} saved."}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/pipeline/{item_id}")
+async def get_pipeline(item_id: str):
+    """Fetch the stage state and critical path of an item."""
+    try:
+        document = collection.find_one(
+            {"item_id": item_id, "pipeline": {"$exists": True}},
+            {"_id": 0, "pipeline": 1},
+        )
+        if not document:
+            raise HTTPException(status_code=404, detail="Pipeline not found")
+        return {"item_id": item_id, "pipeline": document["pipeline"]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/items/")
 async def get_paginated_items(
     skip: int = Query(0, description="Number of items to skip"),
@@ -145,6 +737,9 @@ async def get_paginated_items(
                     "ocr_result": 0,  # Exclude OCR results
                     "whisper_result": 0,  # Exclude Whisper results
                     "sentiment_result": 0,  # Exclude Sentiment results
+                    "frame_timestamps": 0,  # Exclude the frame index
+                    "pipeline": 0,  # Exclude the stage state
+                    **{f"{service}_batches": 0 for service in FRAME_SERVICES},
                 },
             )
             .sort("uploaded_at", DESCENDING)
@@ -152,6 +747,8 @@ async def get_paginated_items(
             .limit(limit)
         )
 
+        items = resolve_reused_results(items, include_results=False)
+
         return {"items": items, "total_items": total_items}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
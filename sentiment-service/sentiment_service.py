@@ -1,11 +1,12 @@
 import os
 import json
-import pika
 import logging
 from transformers import pipeline
 from dotenv import load_dotenv
-import time
 import requests
+from common.cancellation import JobCancelled, stop_reason
+from common.pipeline import CANCELLED, COMPLETED
+from common.worker import run_service_worker
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -13,8 +14,6 @@ logging.basicConfig(level=logging.INFO)
 # Load environment variables from .env file
 load_dotenv()
 
-RABBITMQ_DEFAULT_USER = os.getenv("RABBITMQ_DEFAULT_USER", "user")
-RABBITMQ_DEFAULT_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "password")
 RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
 SENTIMENT_MODEL = os.getenv(
     "SENTIMENT_MODEL", "distilbert/distilbert-base-uncased-finetuned-sst-2-english"
@@ -47,78 +46,90 @@ def send_results_to_result_service(item_id, results, status):
         )
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to save results to result service: {str(e)}")
+        raise
 
 
-def process_message(ch, method, properties, body):
-    """Process messages received from RabbitMQ sentiment_queue."""
-    try:
-        message = json.loads(body)
-        item_id = message["item_id"]
-        segments = message["whisper_result"]
+def get_item_results(item_id):
+    """Fetch the results of the services sentiment analysis follows."""
+    response = requests.get(f"{RESULT_SERVICE_URL}/results/{item_id}")
+    response.raise_for_status()
+    return response.json()
+
 
-        logging.info(f"Received message for sentiment analysis on item {item_id}")
+def collect_texts(whisper_segments, ocr_result):
+    """
+    Return the texts to analyse as (source, text, extra fields): every Whisper segment,
+    then the OCR text of the image or of each frame (in frame order).
+    """
+    # Results saved before failed transcriptions were retried hold an error dict
+    if not isinstance(whisper_segments, list):
+        whisper_segments = []
+    texts = [("whisper", segment["text"], {}) for segment in whisper_segments]
 
-        sentiment_results = []
+    if ocr_result and isinstance(ocr_result[0], dict):
+        # OCR of an image: a single list of detections
+        ocr_result = [ocr_result]
+    for frame, detections in enumerate(ocr_result or []):
+        # Frames left unprocessed (the item stopped early) have no detections
+        text = " ".join(detection["text"] for detection in detections or []).strip()
+        if text:
+            texts.append(("ocr", text, {"frame": frame}))
+    return texts
 
-        # Check if transcription is inside a dictionary
-        if segments:
-            # Process each segment
-            for segment in segments:
-                text = segment["text"]  # Get the text of the segment
-                sentiment_result = analyze_sentiment(text)[
-                    0
-                ]  # Perform sentiment analysis on the segment
 
-                # Add the sentiment information back into the segment
-                segment["sentiment"] = {
+def process_message(ch, method, properties, body):
+    """
+    Process messages received from RabbitMQ sentiment_queue. Errors are raised so the
+    job is retried, the result is only recorded as failed once the retries run out.
+    """
+    message = json.loads(body)
+    item_id = message["item_id"]
+
+    logging.info(f"Received message for sentiment analysis on item {item_id}")
+
+    # Jobs dispatched by the coordinator only carry the item, the inputs are the
+    # results of the stages sentiment analysis follows (Whisper and OCR)
+    if "whisper_result" in message:
+        texts = collect_texts(message["whisper_result"], None)
+    else:
+        results = get_item_results(item_id)
+        texts = collect_texts(results.get("whisper_result"), results.get("ocr_result"))
+
+    # Whisper segments keep their order, so they can be matched with the transcript.
+    # Analysis stops between texts once the item is cancelled or its deadline passes
+    sentiment_results = []
+    status = COMPLETED
+    for source, text, extra in texts:
+        status = stop_reason(message) or COMPLETED
+        if status == CANCELLED:
+            raise JobCancelled(item_id)
+        if status != COMPLETED:
+            break
+        sentiment_result = analyze_sentiment(text)[0]
+        sentiment_results.append(
+            {
+                "segment_text": text,
+                "sentiment": {
                     "label": sentiment_result["label"],
                     "score": sentiment_result["score"],
-                }
-
-                # Collect the result for MongoDB
-                sentiment_results.append(
-                    {"segment_text": text, "sentiment": segment["sentiment"]}
-                )
+                },
+                "source": source,
+                **extra,
+            }
+        )
 
-        else:
-            raise ValueError(f"Invalid transcription format: {segments}")
+    # Update MongoDB with the sentiment result
+    send_results_to_result_service(item_id, sentiment_results, status)
 
-        # Update MongoDB with the sentiment result
-        send_results_to_result_service(item_id, sentiment_results, "completed")
 
-    except Exception as e:
-        send_results_to_result_service(item_id, sentiment_results, "failed")
-        logging.error(f"Error processing message from RabbitMQ. Error: {str(e)}")
+def report_failure(message, error):
+    """Record a job that was moved to the dead-letter queue as failed."""
+    send_results_to_result_service(message["item_id"], [], "failed")
 
 
 def start_sentiment_service():
     """Start the Sentiment service and listen to RabbitMQ sentiment_queue."""
-    credentials = pika.PlainCredentials(RABBITMQ_DEFAULT_USER, RABBITMQ_DEFAULT_PASS)
-
-    while True:
-        try:
-            logging.info("Connecting to RabbitMQ...")
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
-            )
-            logging.info("Connected to RabbitMQ")
-
-            channel = connection.channel()
-            channel.queue_declare(queue="sentiment_queue", durable=True)
-
-            logging.info("Waiting for messages in sentiment_queue...")
-            channel.basic_consume(
-                queue="sentiment_queue",
-                on_message_callback=process_message,
-                auto_ack=True,
-            )
-            channel.start_consuming()
-
-        except pika.exceptions.AMQPConnectionError as e:
-            logging.error(
-                f"Connection to RabbitMQ failed, retrying in 5 seconds: {str(e)}"
-            )
-            time.sleep(5)
+    run_service_worker("sentiment", process_message, on_give_up=report_failure)
 
 
 # Run the sentiment service
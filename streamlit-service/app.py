@@ -46,18 +46,47 @@ def get_status_display(status, service_requested):
         return "✅ Completed"
     elif status == "failed":
         return "❌ Failed"
+    elif status == "partial":
+        return "⚠️ Partial"
+    elif status == "cancelled":
+        return "🚫 Cancelled"
+    elif status == "held":
+        return "⏸️ Waiting for capacity"
     else:
         return "⏳ Processing..."
 
 
+# Helper function to display the ingestion (upload and frame extraction) status
+def get_ingestion_display(row):
+    status = row.get("ingestion_status")
+    if status in (None, "completed") or pd.isna(status):
+        return "✅ Ingested"
+    elif status == "failed":
+        return "❌ Failed"
+    elif status == "cancelled":
+        return "🚫 Cancelled"
+    elif status == "held":
+        return "⏸️ Waiting for capacity"
+    elif status == "extracting":
+        frames = row.get("frames_extracted")
+        if frames is not None and not pd.isna(frames):
+            return f"🎞️ Extracting ({int(frames)} frames)"
+        return "🎞️ Extracting frames..."
+    else:
+        return "⏳ Uploading..."
+
+
 def update_status_columns(df):
     """Update the status columns dynamically based on available services."""
+    if "ingestion_status" not in df.columns:
+        df["ingestion_status"] = None  # Items uploaded before ingestion tracking
     for i, row in df.iterrows():
         for service in SERVICES_COLUMNS:
             service_status_column = f"{service}_status"
             df.at[i, service_status_column] = get_status_display(
                 row.get(service_status_column), service in row.get("services", [])
             )
+        df.at[i, "ingestion_status"] = get_ingestion_display(row)
     return df
 
 
@@ -90,8 +119,8 @@ if uploaded_file is not None:
             "Select services to run", AVAILABLE_VIDEO_SERVICES
         )
 
-        # Ensure that sentiment is automatically included if whisper is selected
-        if "whisper" in services and "sentiment" not in services:
+        # Ensure that sentiment is automatically included if whisper or OCR is selected
+        if ("whisper" in services or "ocr" in services) and "sentiment" not in services:
             services.append("sentiment")
 
         video = VideoFileClip(tfile.name)
@@ -115,6 +144,14 @@ if uploaded_file is not None:
         "Select language(s) for the file:", AVAILABLE_LANGUAGES
     )
 
+    # Short items go through the fast lane anyway, "high" forces it for long videos
+    priority = st.sidebar.selectbox("Priority:", ["normal", "high", "low"])
+
+    # Past the deadline no analysis starts and running ones keep partial results
+    deadline_minutes = st.sidebar.number_input(
+        "Deadline in minutes (0 for none):", min_value=0, value=0
+    )
+
     if st.sidebar.button("Upload and Process"):
         files = {
             "file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)
@@ -123,12 +160,32 @@ if uploaded_file is not None:
             "services": services,
             "frame_second": frame_second if "frame_second" in locals() else 0,
             "languages": languages,
+            "priority": priority,
         }
+        if deadline_minutes:
+            data["deadline_seconds"] = int(deadline_minutes * 60)
         response = requests.post(
             "http://upload-service:5000/upload", files=files, data=data
         )
 
-        if response.status_code == 200:
+        if (
+            response.status_code == 202
+            and response.json().get("ingestion_status") == "held"
+        ):
+            st.sidebar.info(
+                f"File uploaded successfully: {uploaded_file.name}. The services are busy, processing starts once they have capacity."
+            )
+            st.session_state.uploaded = True  # Mark as uploaded
+        elif response.status_code == 202:
+            st.sidebar.success(
+                f"File uploaded successfully: {uploaded_file.name}. Frame extraction is running in the background."
+            )
+            st.session_state.uploaded = True  # Mark as uploaded
+        elif response.status_code == 429:
+            st.sidebar.warning(
+                f"The services are busy, please retry in {response.headers.get('Retry-After', 60)} seconds."
+            )
+        elif response.status_code == 200:
             st.sidebar.success(f"File uploaded successfully: {uploaded_file.name}")
             st.session_state.uploaded = True  # Mark as uploaded
         else:
@@ -195,6 +252,7 @@ if uploaded_files:
             "languages",
             "frame_second",
             "video_length",
+            "ingestion_status",
             *status_columns,  # Dynamically include all service status columns
         ]
     ]
@@ -208,6 +266,16 @@ if uploaded_files:
         selected_index = selection["selection"]["rows"][0]
         st.session_state.selected_item_id = df.iloc[selected_index]["item_id"]
         st.info(f"Item {st.session_state.selected_item_id} selected.")
+
+        # Stop the analysis of the selected item (finished results are kept)
+        if st.button("Cancel processing"):
+            cancel_response = requests.post(
+                f"http://upload-service:5000/upload/{st.session_state.selected_item_id}/cancel"
+            )
+            if cancel_response.status_code == 200:
+                st.success(f"Item {st.session_state.selected_item_id} cancelled.")
+            else:
+                st.error(f"Failed to cancel item: {cancel_response.content}")
     else:
         # No row selected, clear the session state for selected_item_id
         if "selected_item_id" in st.session_state:
@@ -323,7 +391,10 @@ if "selected_item_id" in st.session_state:
             video_length_seconds = int(result.get("video_length", 0))
             frame_second = result.get("frame_second", 5)
 
-            if frame_second >= video_length_seconds:
+            if result.get("frame_timestamps"):
+                # Real timestamps of the stored frames (sampling may be non-uniform)
+                timestamps = [round(t, 1) for t in result["frame_timestamps"]]
+            elif frame_second >= video_length_seconds:
                 timestamps = [0]  # Only include the 0 frame if interval >= video length
             else:
                 for i in range(0, video_length_seconds, frame_second):
@@ -349,9 +420,8 @@ if "selected_item_id" in st.session_state:
                             f"{service}_result", []
                         )
                         if len(yolo_results) > idx:
-                            item[service] = yolo_results[
-                                idx
-                            ]  # Align with timestamp by index
+                            # Align with timestamp by index (None: frame not processed)
+                            item[service] = yolo_results[idx] or []
                         else:
                             item[service] = []  # No result for this timestamp
                     elif service == "yolo_cls":
@@ -360,9 +430,8 @@ if "selected_item_id" in st.session_state:
                             f"{service}_result", []
                         )
                         if len(yolo_cls_results) > idx:
-                            item[service] = yolo_cls_results[
-                                idx
-                            ]  # Align with timestamp by index
+                            # Align with timestamp by index (None: frame not processed)
+                            item[service] = yolo_cls_results[idx] or []
                         else:
                             item[service] = []  # No result for this timestamp
                     elif service == "yolo_logo":
@@ -371,9 +440,8 @@ if "selected_item_id" in st.session_state:
                             f"{service}_result", []
                         )
                         if len(yolo_logo_results) > idx:
-                            item[service] = yolo_logo_results[
-                                idx
-                            ]  # Align with timestamp by index
+                            # Align with timestamp by index (None: frame not processed)
+                            item[service] = yolo_logo_results[idx] or []
                         else:
                             item[service] = []  # No result for this timestamp
                     elif service == "whisper":
@@ -388,16 +456,20 @@ if "selected_item_id" in st.session_state:
                             f"{service}_result", []
                         )
                         if len(ocr_results) > idx:
-                            item[service] = ocr_results[
-                                idx
-                            ]  # Align with timestamp by index
+                            # Align with timestamp by index (None: frame not processed)
+                            item[service] = ocr_results[idx] or []
                         else:
                             item[service] = []  # No result for this timestamp
                     elif service == "sentiment":
                         # Get Sentiment results and merge them into the Whisper results
-                        sentiment_results = st.session_state.result.get(
-                            f"{service}_result", []
-                        )
+                        # Only the Whisper sentiments line up with the transcript segments
+                        sentiment_results = [
+                            sentiment
+                            for sentiment in st.session_state.result.get(
+                                f"{service}_result", []
+                            )
+                            if sentiment.get("source", "whisper") == "whisper"
+                        ]
                         whisper_results = st.session_state.result.get(
                             "whisper_result", []
                         )
@@ -451,7 +523,8 @@ if "selected_item_id" in st.session_state:
                     tfile.write(video_response.content)
                     tfile.flush()
                     st.video(
-                        tfile.name, start_time=st.session_state.selected_frame_timestamp
+                        tfile.name,
+                        start_time=int(st.session_state.selected_frame_timestamp),
                     )
                 else:
                     st.error(f"Failed to load video from {media_url}")
@@ -0,0 +1,208 @@
+import io
+import os
+import queue
+import sys
+from unittest import mock
+import pytest
+
+# The services are run from their own directory with the repository root on the
+# path (for common/), so the tests import them the same way
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+for path in (
+    ROOT,
+    os.path.join(ROOT, "autoscaler-service"),
+    os.path.join(ROOT, "ocr-service"),
+    os.path.join(ROOT, "result-service"),
+    os.path.join(ROOT, "upload-service"),
+    os.path.join(ROOT, "vision-service"),
+):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+class FakeS3:
+    """In-memory S3 client with the calls the services make on frames."""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.gets = []
+        self.uploads = {}
+        self.aborted = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = bytes(Body)
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        self.gets.append((Key, Range))
+        data = self.objects[Key]
+        if Range:
+            start, end = Range[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": io.BytesIO(data)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+        )
+        self.completed_parts = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+        self.aborted.append(Key)
+
+    def get_paginator(self, operation):
+        objects = self.objects
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(key for key in objects if key.startswith(Prefix))
+                return [{"Contents": [{"Key": key} for key in keys]}]
+
+        return Paginator()
+
+
+class FakeConnection:
+    """
+    Runs the callbacks handed to the connection thread at once or, when deferred, once
+    the test serves the connection with process_data_events.
+    """
+
+    def __init__(self, deferred=False):
+        self.is_open = True
+        self.deferred = deferred
+        self.callbacks = queue.Queue()
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise RuntimeError("connection closed")
+        if self.deferred:
+            self.callbacks.put(callback)
+        else:
+            callback()
+
+    def process_data_events(self, time_limit=0):
+        try:
+            self.callbacks.get(timeout=min(time_limit, 0.05))()
+        except queue.Empty:
+            pass
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeChannel:
+    """Records the acknowledgements, rejections and publishes of a worker."""
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.is_open = True
+        self.acked = []
+        self.requeued = []
+        self.published = []
+        self.qos = []
+        self.cancelled = []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.requeued.append(delivery_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties.headers))
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        self.qos.append((prefetch_count, global_qos))
+
+    def queue_declare(self, queue, durable=False, exclusive=False):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        return f"consumer-{queue}"
+
+    def basic_cancel(self, consumer_tag):
+        self.cancelled.append(consumer_tag)
+
+    def close(self):
+        self.is_open = False
+        self.connection.is_open = False
+
+
+class FakeCollection:
+    """In-memory MongoDB collection of item documents, matched on equal fields."""
+
+    def __init__(self):
+        self.documents = []
+        self.updates = []
+
+    def insert_one(self, document):
+        self.documents.append(dict(document))
+
+    def _match(self, query):
+        for document in self.documents:
+            if all(document.get(field) == value for field, value in query.items()):
+                return document
+        return None
+
+    def find_one(self, query, projection=None):
+        document = self._match(query)
+        return dict(document) if document else None
+
+    def update_one(self, query, update):
+        self.updates.append(update)
+        document = self._match(query)
+        if document:
+            document.update(update.get("$set", {}))
+            for field in update.get("$unset", {}):
+                document.pop(field, None)
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def channel():
+    return FakeChannel()
+
+
+@pytest.fixture
+def upload_app():
+    """The upload service module (upload-service/app.py)."""
+    import app
+
+    return app
+
+
+@pytest.fixture
+def result_app():
+    """The result service module, imported without reaching MongoDB or S3."""
+    with mock.patch("pymongo.MongoClient"), mock.patch("boto3.client"):
+        import result_service
+
+    return result_service
+
+
+@pytest.fixture
+def collection(result_app, monkeypatch):
+    """An empty items collection installed in the result service."""
+    collection = FakeCollection()
+    monkeypatch.setattr(result_app, "collection", collection)
+    return collection
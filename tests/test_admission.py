@@ -0,0 +1,117 @@
+import pytest
+import admission
+from common.queue_stats import service_queues
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_BACKLOG_SECONDS", 600)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_QUEUE_DEPTH", 1000)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_FRAME_SECOND", 30)
+    monkeypatch.setattr(admission, "JOB_SECONDS", dict(admission.DEFAULT_JOB_SECONDS))
+
+
+def use_queues(monkeypatch, queues):
+    monkeypatch.setattr(admission, "get_queue_stats", lambda: queues)
+
+
+def depth(service, ready, replicas=1):
+    """Stats of the queues of a service with ready jobs waiting on its first lane."""
+    first, *others = service_queues(service)
+    queues = {first: {"ready": ready, "unacked": 0, "consumers": replicas}}
+    for name in others:
+        queues[name] = {"ready": 0, "unacked": 0, "consumers": replicas}
+    return queues
+
+
+def test_admits_without_policy(monkeypatch):
+    monkeypatch.setattr(admission, "get_queue_stats", pytest.fail)
+    decision = admission.check_admission(["ocr"], "image", policy="off")
+    assert decision["action"] == admission.ADMIT
+
+
+def test_admits_when_queue_depths_are_unavailable(monkeypatch):
+    use_queues(monkeypatch, None)
+    decision = admission.check_admission(["ocr"], "image", policy=admission.REJECT)
+    assert decision["action"] == admission.ADMIT
+
+
+def test_admits_below_the_limits(monkeypatch):
+    use_queues(monkeypatch, depth("ocr", 10))
+    decision = admission.check_admission(["ocr"], "image", policy=admission.REJECT)
+    assert decision == {
+        "action": admission.ADMIT,
+        "retry_after": 0,
+        "frame_second": None,
+    }
+
+
+def test_rejects_when_the_backlog_takes_too_long(monkeypatch):
+    # 50 OCR jobs of 15 s on one replica: 150 s over the limit
+    use_queues(monkeypatch, depth("ocr", 50))
+    decision = admission.check_admission(["ocr"], "image", policy=admission.REJECT)
+    assert decision["action"] == admission.REJECT
+    assert decision["retry_after"] == 150
+    assert decision["overloaded"] == ["ocr"]
+
+
+def test_backlog_is_shared_by_the_replicas(monkeypatch):
+    use_queues(monkeypatch, depth("ocr", 50, replicas=2))
+    decision = admission.check_admission(["ocr"], "image", policy=admission.REJECT)
+    assert decision["action"] == admission.ADMIT
+
+
+def test_rejects_when_too_many_jobs_wait(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_BACKLOG_SECONDS", 10000)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_QUEUE_DEPTH", 100)
+    use_queues(monkeypatch, depth("ocr", 150))
+    decision = admission.check_admission(["ocr"], "image", policy=admission.REJECT)
+    assert decision["action"] == admission.REJECT
+    # The 50 jobs over the depth limit, at 15 s each
+    assert decision["retry_after"] == 750
+
+
+def test_holds_with_the_hold_policy(monkeypatch):
+    use_queues(monkeypatch, depth("ocr", 50))
+    decision = admission.check_admission(["ocr"], "image", policy=admission.HOLD)
+    assert decision["action"] == admission.HOLD
+
+
+def test_ignores_services_that_are_not_requested(monkeypatch):
+    use_queues(monkeypatch, depth("ocr", 500))
+    decision = admission.check_admission(["yolo"], "image", policy=admission.REJECT)
+    assert decision["action"] == admission.ADMIT
+
+
+def test_downgrades_videos_when_frame_services_are_overloaded(monkeypatch):
+    # 240 detection jobs of 5 s: twice the backlog limit, so frames are spread twice as far
+    use_queues(monkeypatch, depth("yolo", 240))
+    decision = admission.check_admission(
+        ["yolo"], "video", frame_second=2, policy=admission.DOWNGRADE
+    )
+    assert decision["action"] == admission.DOWNGRADE
+    assert decision["frame_second"] == 4
+
+
+def test_downgrade_is_bounded_by_the_max_frame_second(monkeypatch):
+    use_queues(monkeypatch, depth("yolo", 2400))
+    decision = admission.check_admission(
+        ["yolo"], "video", frame_second=5, policy=admission.DOWNGRADE
+    )
+    assert decision["action"] == admission.DOWNGRADE
+    assert decision["frame_second"] == 30
+
+
+def test_rejects_instead_of_downgrading_when_whisper_is_overloaded(monkeypatch):
+    use_queues(monkeypatch, {**depth("yolo", 240), **depth("whisper", 10)})
+    decision = admission.check_admission(
+        ["yolo", "whisper"], "video", frame_second=2, policy=admission.DOWNGRADE
+    )
+    assert decision["action"] == admission.REJECT
+    assert decision["overloaded"] == ["whisper", "yolo"]
+
+
+def test_rejects_images_instead_of_downgrading(monkeypatch):
+    use_queues(monkeypatch, depth("yolo", 240))
+    decision = admission.check_admission(["yolo"], "image", policy=admission.DOWNGRADE)
+    assert decision["action"] == admission.REJECT
@@ -0,0 +1,66 @@
+from autoscaler_service import ScalingPolicy
+
+
+def make_policy(**overrides):
+    settings = {
+        "min_replicas": 1,
+        "max_replicas": 5,
+        "target_backlog": 10,
+        "scale_up_cooldown": 30,
+        "scale_down_cooldown": 120,
+        "scale_down_utilization": 0.5,
+    }
+    settings.update(overrides)
+    return ScalingPolicy(**settings)
+
+
+def metrics(ready=0, unacked=0, utilization=0.0):
+    return {"ready": ready, "unacked": unacked, "utilization": utilization}
+
+
+def test_scales_up_to_the_backlog_at_once():
+    policy = make_policy()
+    assert policy.desired_replicas(1, metrics(ready=25, unacked=5), now=0) == 3
+
+
+def test_scale_up_is_bounded_by_max_replicas():
+    policy = make_policy()
+    assert policy.desired_replicas(1, metrics(ready=500), now=0) == 5
+
+
+def test_keeps_min_replicas_without_backlog():
+    policy = make_policy(min_replicas=2)
+    assert policy.desired_replicas(1, metrics(), now=0) == 2
+
+
+def test_scale_up_cooldown():
+    policy = make_policy()
+    assert policy.desired_replicas(1, metrics(ready=20), now=0) == 2
+    assert policy.desired_replicas(2, metrics(ready=40), now=10) == 2
+    assert policy.desired_replicas(2, metrics(ready=40), now=30) == 4
+
+
+def test_scales_down_one_replica_at_a_time_once_idle():
+    policy = make_policy()
+    assert policy.desired_replicas(4, metrics(unacked=1), now=0) == 3
+    # Within the scale-down cooldown of the last change
+    assert policy.desired_replicas(3, metrics(unacked=1), now=60) == 3
+    assert policy.desired_replicas(3, metrics(unacked=1), now=120) == 2
+
+
+def test_no_scale_down_while_jobs_wait_or_replicas_are_busy():
+    policy = make_policy()
+    assert policy.desired_replicas(4, metrics(ready=1), now=0) == 4
+    assert policy.desired_replicas(4, metrics(utilization=0.9), now=0) == 4
+
+
+def test_no_scale_down_within_cooldown_of_a_scale_up():
+    policy = make_policy()
+    assert policy.desired_replicas(1, metrics(ready=30), now=0) == 3
+    assert policy.desired_replicas(3, metrics(), now=60) == 3
+    assert policy.desired_replicas(3, metrics(), now=120) == 2
+
+
+def test_lowered_bounds_scale_down_at_once():
+    policy = make_policy(max_replicas=2)
+    assert policy.desired_replicas(5, metrics(ready=100, utilization=1.0), now=0) == 2
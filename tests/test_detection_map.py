@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from quantize_models import detection_map
+
+
+def frame(boxes, classes, confidences=None):
+    boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+    if confidences is None:
+        confidences = [1.0] * len(boxes)
+    return (
+        boxes,
+        np.array(classes, dtype=np.float32),
+        np.array(confidences, dtype=np.float32),
+    )
+
+
+REFERENCE = [frame([[0, 0, 10, 10], [20, 20, 40, 40]], [0, 1])]
+
+
+def test_identical_predictions():
+    assert detection_map(REFERENCE, REFERENCE) == pytest.approx(1.0)
+
+
+def test_missed_class():
+    predictions = [frame([[0, 0, 10, 10]], [0])]
+    assert detection_map(REFERENCE, predictions) == pytest.approx(0.5)
+
+
+def test_box_below_the_iou_threshold():
+    # IoU of 25 / 175 with the reference box of class 1
+    predictions = [frame([[0, 0, 10, 10], [30, 30, 45, 45]], [0, 1])]
+    assert detection_map(REFERENCE, predictions) == pytest.approx(0.5)
+
+
+def test_wrong_class_does_not_match():
+    predictions = [frame([[0, 0, 10, 10], [20, 20, 40, 40]], [0, 0])]
+    assert detection_map(REFERENCE, predictions) == pytest.approx(0.5)
+
+
+def test_false_positive_ranked_above_the_hit():
+    references = [frame([[0, 0, 10, 10]], [0])]
+    predictions = [frame([[50, 50, 60, 60], [0, 0, 10, 10]], [0, 0], [0.9, 0.8])]
+    assert detection_map(references, predictions) == pytest.approx(0.5)
+
+
+def test_false_positive_ranked_below_the_hit():
+    references = [frame([[0, 0, 10, 10]], [0])]
+    predictions = [frame([[50, 50, 60, 60], [0, 0, 10, 10]], [0, 0], [0.8, 0.9])]
+    assert detection_map(references, predictions) == pytest.approx(1.0)
+
+
+def test_over_several_frames():
+    references = [frame([[0, 0, 10, 10]], [0]), frame([[0, 0, 10, 10]], [0])]
+    predictions = [frame([[0, 0, 10, 10]], [0]), frame([], [])]
+    assert detection_map(references, predictions) == pytest.approx(0.5)
+
+
+def test_empty_frames():
+    empty = [frame([], [])]
+    assert detection_map(empty, empty) == 1.0
+    assert detection_map(empty, [frame([[0, 0, 10, 10]], [0])]) == 0.0
@@ -0,0 +1,179 @@
+import cv2
+import numpy as np
+import pytest
+import frame_sampling
+from fastapi.testclient import TestClient
+
+FPS = 10
+
+
+def write_video(path, frames):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), FPS, (64, 48))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    return str(path)
+
+
+@pytest.fixture
+def video(tmp_path):
+    """A 3.5 second video whose brightness grows with the frame number."""
+    frames = [np.full((48, 64, 3), i * 7, np.uint8) for i in range(35)]
+    return write_video(tmp_path / "video.mp4", frames)
+
+
+class NoFrameRate:
+    """Capture of a file that reports no frame rate."""
+
+    def __init__(self, video_capture):
+        self.video_capture = video_capture
+
+    def get(self, prop):
+        return 0 if prop == cv2.CAP_PROP_FPS else self.video_capture.get(prop)
+
+    def __getattr__(self, name):
+        return getattr(self.video_capture, name)
+
+
+def sample(video, strategy, frame_interval=10, capture=lambda c: c):
+    video_capture = cv2.VideoCapture(video)
+    stats = {"strategy": strategy, "seeks": 0, "decoded": 0, "retrieved": 0}
+    try:
+        frames = frame_sampling.sample_video_frames(
+            capture(video_capture), frame_interval, strategy, stats
+        )
+        return [frame_number for frame_number, _ in frames], stats
+    finally:
+        video_capture.release()
+
+
+@pytest.mark.parametrize("strategy", ["seek", "grab", "read"])
+def test_strategies_sample_the_same_frames(video, strategy):
+    frame_numbers, stats = sample(video, strategy)
+    assert frame_numbers == [0, 10, 20, 30]
+    assert stats["retrieved"] == 4
+
+
+def test_grab_decodes_every_frame_and_seek_only_the_samples(video):
+    assert sample(video, "grab")[1]["decoded"] == 35
+    assert sample(video, "seek")[1]["decoded"] <= 5
+
+
+def test_seek_without_frame_rate_samples_sequentially(video):
+    frame_numbers, stats = sample(video, "seek", capture=NoFrameRate)
+    assert frame_numbers == [0, 10, 20, 30]
+    assert stats["strategy"] == "grab"
+    assert stats["seeks"] == 0
+
+
+def test_forced_strategy_is_used(monkeypatch):
+    monkeypatch.setattr(frame_sampling, "FRAME_SAMPLING_STRATEGY", "read")
+    assert frame_sampling.choose_sampling_strategy("a.mp4", "mjpg", 25, 50) == "read"
+
+
+@pytest.mark.parametrize(
+    "path, codec, fps, frame_interval, strategy",
+    [
+        ("a.mp4", "mjpg", 25, 25, "seek"),  # Intra-only codec
+        ("a.mp4", "avc1", 25, 250, "seek"),  # Interval longer than the GOP
+        ("a.mp4", "avc1", 25, 25, "grab"),  # Interval shorter than the GOP
+        ("a.avi", "mjpg", 25, 250, "grab"),  # No index for random access
+        ("a.mp4", "mjpg", 0, 1, "grab"),  # Every frame is sampled
+    ],
+)
+def test_auto_strategy(monkeypatch, path, codec, fps, frame_interval, strategy):
+    monkeypatch.setattr(frame_sampling, "FRAME_SAMPLING_STRATEGY", "auto")
+    assert (
+        frame_sampling.choose_sampling_strategy(path, codec, fps, frame_interval)
+        == strategy
+    )
+
+
+@pytest.mark.parametrize("frame_second", [0, -1])
+def test_upload_rejects_a_non_positive_frame_second(upload_app, frame_second):
+    response = TestClient(upload_app.app).post(
+        "/upload",
+        files={"file": ("video.mp4", b"video")},
+        data={"frame_second": frame_second, "services": ["ocr"], "languages": ["en"]},
+    )
+    assert response.json() == {
+        "error": "frame_second must be a positive number of seconds."
+    }
+
+
+def scenes_video(tmp_path, scenes, seconds_per_scene=2):
+    """A video of textured scenes (one per seed) with a little noise on every frame."""
+    random = np.random.default_rng(0)
+    frames = []
+    for seed in scenes:
+        texture = np.random.default_rng(seed).integers(0, 256, (6, 8, 3))
+        scene = cv2.resize(texture.astype(np.uint8), (64, 48))
+        for _ in range(seconds_per_scene * FPS):
+            noise = random.integers(-2, 3, scene.shape)
+            frames.append(np.clip(scene + noise, 0, 255).astype(np.uint8))
+    return write_video(tmp_path / "scenes.mp4", frames)
+
+
+def sample_adaptive(video, frame_second=1):
+    video_capture, _, frames, stats = frame_sampling.open_sampler(
+        video, frame_second, "adaptive"
+    )
+    try:
+        return [frame_number for frame_number, _ in frames], stats
+    finally:
+        video_capture.release()
+
+
+def test_adaptive_sampling_keeps_scene_changes(tmp_path):
+    frame_numbers, stats = sample_adaptive(scenes_video(tmp_path, [1, 2, 2, 3]))
+    assert frame_numbers == [0, 20, 60]
+    assert stats["candidates"] == 8
+
+
+def test_adaptive_sampling_keeps_a_frame_every_max_gap(tmp_path, monkeypatch):
+    monkeypatch.setattr(frame_sampling, "FRAME_ADAPTIVE_MAX_GAP_SECONDS", 3)
+    frame_numbers, _ = sample_adaptive(scenes_video(tmp_path, [1] * 4))
+    assert frame_numbers == [0, 30, 60]
+
+
+def test_interval_sampling_keeps_every_candidate(tmp_path):
+    video_capture, _, frames, _ = frame_sampling.open_sampler(
+        scenes_video(tmp_path, [1] * 2), 1, "interval"
+    )
+    assert [frame_number for frame_number, _ in frames] == [0, 10, 20, 30]
+    video_capture.release()
+
+
+def test_change_score_ignores_noise_and_detects_cuts():
+    random = np.random.default_rng(0)
+    frame = random.integers(0, 256, (48, 64, 3)).astype(np.uint8)
+    noisy = np.clip(frame.astype(int) + random.integers(-2, 3, frame.shape), 0, 255)
+    signature = frame_sampling.frame_signature(frame)
+    assert (
+        frame_sampling.change_score(
+            frame_sampling.frame_signature(noisy.astype(np.uint8)), signature
+        )
+        < frame_sampling.FRAME_SCENE_THRESHOLD
+    )
+    assert (
+        frame_sampling.change_score(
+            frame_sampling.frame_signature(255 - frame), signature
+        )
+        > frame_sampling.FRAME_SCENE_THRESHOLD
+    )
+
+
+def test_upload_rejects_unknown_sampling_modes(upload_app):
+    response = TestClient(upload_app.app).post(
+        "/upload",
+        files={"file": ("video.mp4", b"video")},
+        data={
+            "frame_second": 1,
+            "services": ["ocr"],
+            "languages": ["en"],
+            "sampling_mode": "scenes",
+        },
+    )
+    assert response.json() == {
+        "error": "sampling_mode must be one of interval, adaptive."
+    }
@@ -0,0 +1,112 @@
+import threading
+from common.frame_shards import (
+    FrameShardWriter,
+    list_frame_objects,
+    load_frame_index,
+    read_frame,
+    split_frame_entries,
+)
+
+BUCKET = "bucket"
+FRAMES_DIR = "videos/item/frames/"
+
+
+def frame_bytes(frame_number):
+    return f"frame {frame_number}".encode() * (frame_number + 1)
+
+
+def write_frames(s3, frame_numbers, frames_per_shard=3, **kwargs):
+    writer = FrameShardWriter(s3, BUCKET, FRAMES_DIR, frames_per_shard, **kwargs)
+    for frame_number in frame_numbers:
+        writer.add(frame_number, frame_bytes(frame_number), timestamp=frame_number / 2)
+    return writer, writer.close()
+
+
+def test_frames_are_read_back_with_ranged_gets(s3):
+    writer, stored = write_frames(s3, range(7))
+    assert stored == 7 and writer.shard_count == 3
+
+    index = load_frame_index(s3, BUCKET, FRAMES_DIR)
+    assert [entry["frame"] for entry in index["frames"]] == list(range(7))
+    for entry in index["frames"]:
+        assert read_frame(s3, BUCKET, FRAMES_DIR, entry) == frame_bytes(entry["frame"])
+        assert entry["timestamp"] == entry["frame"] / 2
+    assert all(frame_range is not None for _, frame_range in s3.gets[1:])
+
+
+def test_shards_hold_consecutive_frames_in_order(s3):
+    write_frames(s3, [2, 0, 1, 5, 4, 3])
+    assert s3.objects[f"{FRAMES_DIR}shard_00000.bin"] == b"".join(
+        frame_bytes(frame_number) for frame_number in (0, 1, 2)
+    )
+
+
+def test_frames_can_be_added_from_several_threads(s3):
+    writer = FrameShardWriter(s3, BUCKET, FRAMES_DIR, frames_per_shard=4)
+    threads = [
+        threading.Thread(
+            target=lambda start=start: [
+                writer.add(frame_number, frame_bytes(frame_number))
+                for frame_number in range(start, 40, 4)
+            ]
+        )
+        for start in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.close() == 40
+
+    index = load_frame_index(s3, BUCKET, FRAMES_DIR)
+    assert [entry["frame"] for entry in index["frames"]] == list(range(40))
+    for entry in index["frames"]:
+        assert read_frame(s3, BUCKET, FRAMES_DIR, entry) == frame_bytes(entry["frame"])
+
+
+def test_uploaded_shards_are_reported(s3):
+    shards = []
+    write_frames(
+        s3,
+        range(7),
+        on_shard=lambda number, entries: shards.append(
+            (number, [entry["frame"] for entry in entries])
+        ),
+    )
+    assert sorted(shards) == [(0, [0, 1, 2]), (1, [3, 4, 5]), (2, [6])]
+
+
+def test_per_frame_directories_have_no_index(s3):
+    for frame_number in (10, 2, 1):
+        s3.put_object(BUCKET, f"{FRAMES_DIR}frame_{frame_number}.jpg", b"jpeg")
+    assert load_frame_index(s3, BUCKET, FRAMES_DIR) is None
+    assert [number for number, _ in list_frame_objects(s3, BUCKET, FRAMES_DIR)] == [
+        1,
+        2,
+        10,
+    ]
+
+
+def entries(count):
+    return [{"frame": number} for number in range(count)]
+
+
+def test_split_frame_entries_keeps_frame_order():
+    jobs = split_frame_entries(entries(7), 3)
+    assert [[entry["frame"] for entry in job] for job in jobs] == [
+        [0, 1, 2],
+        [3, 4, 5],
+        [6],
+    ]
+
+
+def test_split_frame_entries_exact_multiple():
+    assert [len(job) for job in split_frame_entries(entries(6), 3)] == [3, 3]
+
+
+def test_split_frame_entries_at_least_one_frame_per_job():
+    assert len(split_frame_entries(entries(3), 0)) == 3
+
+
+def test_split_frame_entries_without_frames():
+    assert split_frame_entries([], 4) == []
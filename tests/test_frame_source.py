@@ -0,0 +1,117 @@
+import cv2
+import numpy as np
+import pytest
+from common import frame_source
+from common.frame_shards import FrameShardWriter, load_frame_index
+from common.frame_source import decode_image, fetch_frames, plan_fetches
+
+BUCKET = "bucket"
+FRAMES_DIR = "videos/item/frames/"
+
+
+def frame_bytes(frame_number, rendition=""):
+    return f"{rendition}frame {frame_number};".encode()
+
+
+def store_frames(s3, count, frames_per_shard=5, rendition_frames=()):
+    writer = FrameShardWriter(s3, BUCKET, FRAMES_DIR, frames_per_shard)
+    for frame_number in range(count):
+        renditions = None
+        if frame_number in rendition_frames:
+            renditions = {"small": frame_bytes(frame_number, "small ")}
+        writer.add(frame_number, frame_bytes(frame_number), renditions)
+    writer.close()
+
+
+def frame_gets(s3):
+    return [get for get in s3.gets if not get[0].endswith("index.json")]
+
+
+def test_frames_are_fetched_in_order(s3):
+    store_frames(s3, 12)
+    assert list(fetch_frames(s3, BUCKET, FRAMES_DIR)) == [
+        (frame_number, frame_bytes(frame_number)) for frame_number in range(12)
+    ]
+
+
+def test_consecutive_frames_of_a_shard_share_a_ranged_get(s3, monkeypatch):
+    monkeypatch.setattr(frame_source, "FRAMES_PER_FETCH", 2)
+    store_frames(s3, 7)
+    list(fetch_frames(s3, BUCKET, FRAMES_DIR))
+    # Shards of 5 and 2 frames, read 2 frames at a time
+    assert [key.split("/")[-1] for key, _ in frame_gets(s3)] == [
+        "shard_00000.bin",
+        "shard_00000.bin",
+        "shard_00000.bin",
+        "shard_00001.bin",
+    ]
+    assert all(byte_range.startswith("bytes=") for _, byte_range in frame_gets(s3))
+
+
+def test_only_the_given_entries_are_fetched(s3):
+    store_frames(s3, 12)
+    entries = load_frame_index(s3, BUCKET, FRAMES_DIR)["frames"][6:9]
+    s3.gets.clear()
+    assert [frame for frame, _ in fetch_frames(s3, BUCKET, FRAMES_DIR, entries)] == [
+        6,
+        7,
+        8,
+    ]
+    assert len(frame_gets(s3)) == 1 and len(s3.gets) == 1
+
+
+def test_renditions_fall_back_to_the_original_frame(s3):
+    store_frames(s3, 4, rendition_frames=(0, 1))
+    frames = list(fetch_frames(s3, BUCKET, FRAMES_DIR, rendition="small"))
+    assert frames == [
+        (0, frame_bytes(0, "small ")),
+        (1, frame_bytes(1, "small ")),
+        (2, frame_bytes(2)),
+        (3, frame_bytes(3)),
+    ]
+    _, planned = plan_fetches(s3, BUCKET, FRAMES_DIR, rendition="small")
+    assert [from_rendition for *_, from_rendition in planned] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_per_frame_objects_take_one_get_each(s3):
+    for frame_number in (10, 2, 1):
+        s3.put_object(
+            BUCKET, f"{FRAMES_DIR}frame_{frame_number}.jpg", b"%d" % frame_number
+        )
+    frames = list(fetch_frames(s3, BUCKET, FRAMES_DIR))
+    assert frames == [(1, b"1"), (2, b"2"), (10, b"10")]
+    assert [byte_range for _, byte_range in frame_gets(s3)] == [None] * 3
+
+
+def test_frames_are_decoded_with_the_flags(s3):
+    image = np.zeros((8, 12, 3), dtype=np.uint8)
+    writer = FrameShardWriter(s3, BUCKET, FRAMES_DIR)
+    writer.add(0, cv2.imencode(".png", image)[1].tobytes())
+    writer.close()
+    [(_, color)] = fetch_frames(s3, BUCKET, FRAMES_DIR, imread_flags=cv2.IMREAD_COLOR)
+    [(_, gray)] = fetch_frames(
+        s3, BUCKET, FRAMES_DIR, imread_flags=cv2.IMREAD_GRAYSCALE
+    )
+    assert color.shape == (8, 12, 3) and gray.shape == (8, 12)
+
+
+def test_undecodable_frames_raise():
+    with pytest.raises(ValueError):
+        decode_image(b"not an image")
+
+
+def test_gets_are_bounded_by_the_fetch_ahead(s3, monkeypatch):
+    monkeypatch.setattr(frame_source, "FRAMES_PER_FETCH", 1)
+    monkeypatch.setattr(frame_source, "FRAME_FETCH_AHEAD", 2)
+    store_frames(s3, 20)
+    s3.gets.clear()
+    frames = fetch_frames(s3, BUCKET, FRAMES_DIR)
+    next(frames)
+    frames.close()
+    # At most the two GETs fetched ahead of the first frame
+    assert len(frame_gets(s3)) <= 2
@@ -0,0 +1,117 @@
+import pytest
+
+
+@pytest.fixture
+def events(result_app, monkeypatch):
+    published = []
+    monkeypatch.setattr(
+        result_app,
+        "publish_stage_event",
+        lambda item_id, service, status: published.append((item_id, service, status)),
+    )
+    return published
+
+
+def use_document(collection, batches, batch_count=None, **fields):
+    collection.insert_one(
+        {
+            "item_id": "item",
+            "services": ["yolo"],
+            "frame_batches": len(batches) if batch_count is None else batch_count,
+            "yolo_batches": batches,
+            **fields,
+        }
+    )
+
+
+def document(collection):
+    return collection.find_one({"item_id": "item"})
+
+
+def batch(frames, result, status="completed"):
+    return {"frames": frames, "result": result, "status": status}
+
+
+def test_merges_batches_in_frame_order(result_app, collection, events):
+    use_document(
+        collection,
+        {
+            "1": batch([3, 4, 5], ["d", "e", "f"]),
+            "0": batch([0, 1, 2], ["a", "b", "c"]),
+        },
+    )
+    assert result_app.merge_batch_results("item", "yolo") is True
+    assert document(collection)["yolo_result"] == ["a", "b", "c", "d", "e", "f"]
+    assert document(collection)["yolo_status"] == "completed"
+    assert "yolo_batches" not in document(collection)
+    assert events == [("item", "yolo", "completed")]
+
+
+def test_orders_by_frame_number_not_batch_key(result_app, collection, events):
+    use_document(
+        collection,
+        {
+            "10": batch([20, 21], ["k", "l"]),
+            "2": batch([4, 5], ["c", "d"]),
+        },
+    )
+    result_app.merge_batch_results("item", "yolo")
+    assert document(collection)["yolo_result"] == ["c", "d", "k", "l"]
+
+
+def test_waits_for_every_batch(result_app, collection, events):
+    use_document(collection, {"0": batch([0, 1], ["a", "b"])}, batch_count=2)
+    assert result_app.merge_batch_results("item", "yolo") is False
+    assert collection.updates == []
+    assert events == []
+
+
+def test_partial_batch_keeps_the_positions_of_later_frames(
+    result_app, collection, events
+):
+    # The first batch stopped at the deadline after one of its three frames
+    use_document(
+        collection,
+        {
+            "0": batch([0, 1, 2], ["a"], status="partial"),
+            "1": batch([3, 4], ["d", "e"]),
+        },
+    )
+    result_app.merge_batch_results("item", "yolo")
+    assert document(collection)["yolo_result"] == ["a", None, None, "d", "e"]
+    assert document(collection)["yolo_status"] == "partial"
+    assert events == [("item", "yolo", "partial")]
+
+
+def test_failed_batch_fails_the_service(result_app, collection, events):
+    use_document(
+        collection,
+        {
+            "0": batch([0, 1], ["a", "b"]),
+            "1": batch([2, 3], [], status="failed"),
+            "2": batch([4], ["e"], status="partial"),
+        },
+    )
+    result_app.merge_batch_results("item", "yolo")
+    assert document(collection)["yolo_result"] == ["a", "b", None, None, "e"]
+    assert document(collection)["yolo_status"] == "failed"
+
+
+def test_merged_service_is_not_merged_again(result_app, collection, events):
+    use_document(collection, {"0": batch([0], ["a"])}, yolo_status="completed")
+    assert result_app.merge_batch_results("item", "yolo") is True
+    assert collection.updates == []
+    assert events == []
+
+
+def test_service_batch_count_overrides_the_item_batch_count(
+    result_app, collection, events
+):
+    use_document(
+        collection,
+        {"0": batch([0], ["a"])},
+        batch_count=1,
+        yolo_batch_count=2,
+    )
+    assert result_app.merge_batch_results("item", "yolo") is False
+    assert collection.updates == []
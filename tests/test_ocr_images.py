@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+from common.frame_shards import FrameShardWriter
+from ocr_images import fetch_ocr_frames, prepare_image
+
+
+def encode(image, extension=".jpg"):
+    return cv2.imencode(extension, image)[1].tobytes()
+
+
+def color_frame(width, height):
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, : width // 2] = (0, 0, 255)
+    return frame
+
+
+def store_frames(s3):
+    """Store two 1920x1080 frames, with an OCR rendition for the first one only."""
+    writer = FrameShardWriter(s3, "bucket", "videos/item/frames/")
+    original = encode(color_frame(1920, 1080))
+    gray = cv2.cvtColor(
+        cv2.resize(color_frame(1920, 1080), (1024, 576)), cv2.COLOR_BGR2GRAY
+    )
+    writer.add(0, original, renditions={"ocr": encode(gray)})
+    writer.add(1, original)
+    writer.close()
+
+
+def test_rendition_frames_are_decoded_in_grayscale(s3):
+    store_frames(s3)
+    frames = dict(
+        fetch_ocr_frames(s3, "bucket", "videos/item/frames/", None, cv2.IMREAD_COLOR)
+    )
+    assert frames[0].shape == (576, 1024)
+    # Frames without the rendition fall back to the original, decoded as asked
+    assert frames[1].shape == (1080, 1920, 3)
+
+
+def test_rendition_frames_are_not_prepared_again(s3):
+    store_frames(s3)
+    frames = dict(
+        fetch_ocr_frames(s3, "bucket", "videos/item/frames/", None, cv2.IMREAD_COLOR)
+    )
+    assert prepare_image(frames[0]) is frames[0]
+
+
+def test_original_frames_are_resized_and_converted():
+    prepared = prepare_image(color_frame(1920, 1080))
+    assert prepared.shape == (576, 1024)
+
+
+def test_grayscale_originals_are_only_resized():
+    prepared = prepare_image(np.zeros((2048, 1024), dtype=np.uint8))
+    assert prepared.shape == (1024, 512)
+
+
+def test_small_images_are_kept():
+    image = np.zeros((200, 200), dtype=np.uint8)
+    assert prepare_image(image) is image
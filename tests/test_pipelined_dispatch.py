@@ -0,0 +1,64 @@
+import pytest
+
+
+class FakeClip:
+    duration = 10.0
+
+    def __init__(self, path):
+        pass
+
+    def close(self):
+        pass
+
+
+class FailingPublisher:
+    def publish(self, routing_key, message, exchange=""):
+        raise ConnectionError("broker unreachable")
+
+
+@pytest.fixture
+def ingestion(upload_app, monkeypatch, tmp_path):
+    """Run ingest_video on a spooled file, recording the ingestion updates."""
+    updates = []
+    monkeypatch.setattr(upload_app, "VideoFileClip", FakeClip)
+    monkeypatch.setattr(upload_app, "PIPELINED_DISPATCH", True)
+    monkeypatch.setattr(upload_app, "FRAME_STORAGE", "shards")
+    monkeypatch.setattr(
+        upload_app,
+        "update_ingestion",
+        lambda item_id, status, **fields: updates.append((status, fields)),
+    )
+    monkeypatch.setattr(upload_app, "get_publisher", lambda: FailingPublisher())
+    spooled = tmp_path / "video.mp4"
+    spooled.write_bytes(b"video")
+
+    def ingest(split):
+        monkeypatch.setattr(upload_app, "split_and_upload_frames", split)
+        upload_app.ingest_video(
+            "item", str(spooled), "video.mp4", 1, ["yolo"], [], "videos/item.mp4"
+        )
+
+    ingest.updates = updates
+    ingest.spooled = spooled
+    return ingest
+
+
+def test_publish_errors_are_raised(upload_app, monkeypatch):
+    monkeypatch.setattr(upload_app, "get_publisher", lambda: FailingPublisher())
+    with pytest.raises(ConnectionError):
+        upload_app.publish_to_rabbitmq("coordinator_queue", {"item_id": "item"})
+
+
+def test_batch_that_cannot_be_dispatched_fails_the_ingestion(ingestion):
+    def split(video_path, frame_second, video_id, on_batch=None, **kwargs):
+        on_batch(0, [{"frame": 0}])
+        return f"videos/{video_id}/frames/", [0.0], 1
+
+    with pytest.raises(ConnectionError):
+        ingestion(split)
+    status, fields = ingestion.updates[-1]
+    assert status == "failed"
+    assert "broker unreachable" in fields["ingestion_error"]
+    # No batch count is recorded for batches that were never dispatched
+    assert all(fields.get("frame_batches") is None for _, fields in ingestion.updates)
+    assert not ingestion.spooled.exists()
@@ -0,0 +1,114 @@
+import json
+import pika
+import pytest
+from common import messaging
+
+
+class BrokerChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.confirming = False
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def queue_declare(self, queue, durable=False):
+        self.broker.declared.append(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if self.broker.failures:
+            self.broker.failures -= 1
+            raise pika.exceptions.StreamLostError("connection reset")
+        self.broker.published.append((routing_key, json.loads(body)))
+
+
+class BrokerConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return BrokerChannel(self.broker)
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class Broker:
+    """Stands in for pika.BlockingConnection, recording what reaches the broker."""
+
+    def __init__(self):
+        self.connections = []
+        self.declared = []
+        self.published = []
+        # Number of publishes that fail with a lost connection
+        self.failures = 0
+
+    def __call__(self, parameters):
+        self.connections.append(BrokerConnection(self))
+        return self.connections[-1]
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = Broker()
+    monkeypatch.setattr(messaging.pika, "BlockingConnection", broker)
+    monkeypatch.setattr(messaging.time, "sleep", lambda seconds: None)
+    return broker
+
+
+@pytest.fixture
+def publisher(broker):
+    return messaging.RabbitMQPublisher(pika.ConnectionParameters(heartbeat=0))
+
+
+def test_connection_is_reused_and_queues_declared_once(broker, publisher):
+    publisher.publish("ocr_queue", {"item_id": 1})
+    publisher.publish("ocr_queue", {"item_id": 2})
+    publisher.publish("sentiment_queue", {"item_id": 3})
+    assert len(broker.connections) == 1
+    assert broker.declared == ["ocr_queue", "sentiment_queue"]
+    assert [message["item_id"] for _, message in broker.published] == [1, 2, 3]
+
+
+def test_exchange_messages_declare_no_queue(broker, publisher):
+    publisher.publish("standard.image.ocr", {"item_id": 1}, exchange="analysis_jobs")
+    assert broker.declared == []
+    assert broker.published == [("standard.image.ocr", {"item_id": 1})]
+
+
+def test_batch_resumes_after_reconnecting(broker, publisher):
+    publisher.publish("ocr_queue", {"item_id": 0})
+    broker.failures = 1
+    publisher.publish_batch(("ocr_queue", {"item_id": n}) for n in range(1, 4))
+    assert len(broker.connections) == 2
+    assert not broker.connections[0].is_open
+    assert [message["item_id"] for _, message in broker.published] == [0, 1, 2, 3]
+    # Declarations are not cached across connections
+    assert broker.declared == ["ocr_queue", "ocr_queue"]
+
+
+def test_publish_fails_after_the_retries(broker, publisher):
+    broker.failures = 3
+    with pytest.raises(pika.exceptions.StreamLostError):
+        publisher.publish("ocr_queue", {"item_id": 1})
+    assert len(broker.connections) == 3
+    assert broker.published == []
+
+
+@pytest.mark.parametrize("confirm", [True, False])
+def test_publisher_confirms(broker, confirm):
+    publisher = messaging.RabbitMQPublisher(
+        pika.ConnectionParameters(heartbeat=0), confirm=confirm
+    )
+    publisher.publish("ocr_queue", {"item_id": 1})
+    assert publisher.channel.confirming == confirm
+
+
+def test_publisher_is_shared(broker, monkeypatch):
+    monkeypatch.setattr(messaging, "_publisher", None)
+    assert messaging.get_publisher() is messaging.get_publisher()
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import io
+import threading
+import time
+import pytest
+from fastapi import UploadFile
+
+PART_SIZE = 10
+
+
+@pytest.fixture
+def stream(upload_app, s3, monkeypatch):
+    monkeypatch.setattr(upload_app, "s3", s3)
+    monkeypatch.setattr(upload_app, "UPLOAD_PART_SIZE", PART_SIZE)
+    monkeypatch.setattr(upload_app, "UPLOAD_MAX_INFLIGHT_PARTS", 2)
+
+    def stream(data, **kwargs):
+        file = UploadFile(io.BytesIO(data), filename="video.mp4")
+        return asyncio.run(upload_app.stream_upload_to_s3(file, "key", **kwargs))
+
+    return stream
+
+
+def test_large_files_are_uploaded_in_parts(stream, s3):
+    data = bytes(range(95))
+    assert stream(data) == len(data)
+    assert s3.objects["key"] == data
+    assert [part["PartNumber"] for part in s3.completed_parts] == list(range(1, 11))
+
+
+def test_small_files_are_put_in_one_request(stream, s3):
+    assert stream(b"small") == 5
+    assert s3.objects["key"] == b"small"
+    assert not hasattr(s3, "completed_parts")
+
+
+def test_chunks_are_spooled_and_hashed_in_order(stream, tmp_path):
+    data = bytes(range(95))
+    hasher = hashlib.sha256()
+    stream(data, spool_path=tmp_path / "spool", hasher=hasher)
+    assert (tmp_path / "spool").read_bytes() == data
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_failed_parts_abort_the_upload(stream, s3, monkeypatch):
+    def upload_part(Bucket, Key, UploadId, PartNumber, Body):
+        raise ConnectionError("S3 unavailable")
+
+    monkeypatch.setattr(s3, "upload_part", upload_part)
+    with pytest.raises(ConnectionError):
+        stream(bytes(95))
+    assert s3.aborted == ["key"]
+    assert "key" not in s3.objects and not s3.uploads
+
+
+def test_parts_in_flight_are_bounded(stream, s3, monkeypatch):
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+    upload_part = s3.upload_part
+
+    def slow_upload_part(**kwargs):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3, "upload_part", slow_upload_part)
+    stream(bytes(95))
+    assert most_running[0] == 2
@@ -0,0 +1,320 @@
+import json
+import signal
+import threading
+import time
+import pytest
+import pika
+from common import worker as worker_module
+from common.cancellation import JobCancelled
+from common.messaging import ATTEMPT_HEADER, DEAD_LETTER_QUEUE, MAX_DELIVERY_ATTEMPTS
+from common.worker import Worker
+
+
+@pytest.fixture
+def starts(monkeypatch):
+    """Starts the result service reports for each job body (first start by default)."""
+    counts = {}
+
+    def record_job_start(body):
+        counts[body] = counts.get(body, 0) + 1
+        return counts[body]
+
+    monkeypatch.setattr(worker_module, "record_job_start", record_job_start)
+    return counts
+
+
+def delivery(channel, body, tag=1, attempt=None, redelivered=False):
+    method = pika.spec.Basic.Deliver(delivery_tag=tag, redelivered=redelivered)
+    headers = {ATTEMPT_HEADER: attempt} if attempt else None
+    properties = pika.BasicProperties(headers=headers)
+    return channel, method, properties, json.dumps(body).encode()
+
+
+def run(worker, job, handler, on_give_up=None):
+    # As started by Worker._dispatch
+    worker.in_flight += 1
+    worker.running += 1
+    worker._run_job(*job, "yolo_queue", handler, on_give_up)
+
+
+def succeed(ch, method, properties, body):
+    pass
+
+
+def fail(ch, method, properties, body):
+    raise RuntimeError("model crashed")
+
+
+def test_acks_a_finished_job(channel, starts):
+    worker = Worker()
+    run(worker, delivery(channel, {"item_id": "a"}), succeed)
+    assert channel.acked == [1]
+    assert channel.published == []
+    assert worker.in_flight == 0
+    assert worker.running == 0
+
+
+def test_retries_a_failed_job_with_the_next_attempt(channel, starts):
+    worker = Worker()
+    run(worker, delivery(channel, {"item_id": "a"}), fail)
+    assert channel.acked == [1]
+    [(routing_key, _, headers)] = channel.published
+    assert routing_key == "yolo_queue"
+    assert headers[ATTEMPT_HEADER] == 2
+
+
+def test_dead_letters_after_the_last_attempt(channel, starts):
+    given_up = []
+    worker = Worker()
+    job = delivery(channel, {"item_id": "a"}, attempt=MAX_DELIVERY_ATTEMPTS)
+    starts[job[3]] = MAX_DELIVERY_ATTEMPTS - 1
+    run(worker, job, fail, on_give_up=lambda message, error: given_up.append(message))
+    [(routing_key, _, headers)] = channel.published
+    assert routing_key == DEAD_LETTER_QUEUE
+    assert headers["x-original-queue"] == "yolo_queue"
+    assert "model crashed" in headers["x-error"]
+    assert given_up == [{"item_id": "a"}]
+    assert channel.acked == [1]
+
+
+def test_cancelled_job_is_dropped_without_retry(channel, starts):
+    def cancelled(ch, method, properties, body):
+        raise JobCancelled("a")
+
+    worker = Worker()
+    run(worker, delivery(channel, {"item_id": "a"}), cancelled)
+    assert channel.acked == [1]
+    assert channel.published == []
+
+
+def test_redelivered_job_that_never_started_runs(channel, starts):
+    handled = []
+    worker = Worker()
+    job = delivery(channel, {"item_id": "a"}, redelivered=True)
+    run(worker, job, lambda *args: handled.append(args[3]))
+    assert handled == [job[3]]
+    assert channel.acked == [1]
+    assert channel.published == []
+
+
+def test_job_started_before_counts_as_an_attempt(channel, starts):
+    worker = Worker()
+    job = delivery(channel, {"item_id": "a"}, redelivered=True)
+    # Its worker died while running it
+    starts[job[3]] = 1
+    run(worker, job, fail)
+    [(_, _, headers)] = channel.published
+    assert headers[ATTEMPT_HEADER] == 3
+
+
+def test_job_that_kept_killing_its_worker_is_dead_lettered(channel, starts):
+    handled = []
+    worker = Worker()
+    job = delivery(channel, {"item_id": "a"}, redelivered=True)
+    starts[job[3]] = MAX_DELIVERY_ATTEMPTS
+    run(worker, job, lambda *args: handled.append(args))
+    assert handled == []
+    [(routing_key, _, _)] = channel.published
+    assert routing_key == DEAD_LETTER_QUEUE
+
+
+def test_runs_the_job_when_starts_cannot_be_recorded(channel, monkeypatch):
+    monkeypatch.setattr(worker_module, "record_job_start", lambda body: None)
+    handled = []
+    worker = Worker()
+    run(worker, delivery(channel, {"item_id": "a"}), lambda *args: handled.append(1))
+    assert handled == [1]
+    assert channel.acked == [1]
+
+
+def test_job_of_a_closed_channel_is_not_run(channel, starts):
+    handled = []
+    worker = Worker()
+    channel.close()
+    run(worker, delivery(channel, {"item_id": "a"}), lambda *args: handled.append(1))
+    assert handled == []
+    assert channel.acked == []
+    assert worker.in_flight == 0
+
+
+def test_reconnecting_drops_the_jobs_received_on_the_lost_connection(
+    channel, monkeypatch
+):
+    new_channel = channel
+    old_channel = type(channel)()
+    connection = new_channel.connection
+    connection.channel = lambda: new_channel
+    monkeypatch.setattr(pika, "BlockingConnection", lambda parameters: connection)
+
+    worker = Worker()
+    worker.add_consumer("yolo_queue", succeed)
+    on_message = worker._on_message("yolo_queue", succeed, None)
+    worker.executor.submit = lambda *args: None
+    on_message(*delivery(old_channel, {"item_id": "a"}))
+    assert worker.in_flight == 1
+
+    old_channel.close()
+    worker._connect()
+    assert worker.in_flight == 0
+    assert not worker.pending["yolo_queue"]
+
+
+@pytest.fixture
+def lanes(channel):
+    """A worker consuming a fast lane of weight 4 and a standard lane of weight 1."""
+    worker = Worker(concurrency=1)
+    worker.channel = channel
+    worker.add_consumer("yolo_fast_queue", succeed, weight=4)
+    worker.add_consumer("yolo_queue", succeed, weight=1)
+    worker.started = []
+    worker.executor.submit = lambda run_job, *job: worker.started.append(job)
+    return worker
+
+
+def receive(worker, queue_name, count, first_tag=1):
+    on_message = worker._on_message(queue_name, succeed, None)
+    for tag in range(first_tag, first_tag + count):
+        on_message(*delivery(worker.channel, {"queue": queue_name}, tag=tag))
+
+
+def finish(worker, job):
+    worker._job_done(job[0])
+
+
+def started_queues(worker):
+    return [json.loads(job[3])["queue"] for job in worker.started]
+
+
+def test_lanes_are_taken_by_weight(lanes):
+    queues = []
+    for round_number in range(5):
+        receive(lanes, "yolo_fast_queue", 4, first_tag=10 * round_number)
+        receive(lanes, "yolo_queue", 1, first_tag=10 * round_number + 5)
+        lanes._dispatch()
+        queues.extend(started_queues(lanes))
+        finish(lanes, lanes.started.pop())
+        # The jobs given back are received again once the thread is free
+    # Smooth weighted round-robin spreads the standard job among the fast ones
+    assert queues == ["yolo_fast_queue"] * 2 + ["yolo_queue"] + ["yolo_fast_queue"] * 2
+
+
+def test_busy_worker_gives_back_the_jobs_it_cannot_start(lanes, channel):
+    receive(lanes, "yolo_fast_queue", 4)
+    receive(lanes, "yolo_queue", 1, first_tag=5)
+    lanes._dispatch()
+    assert len(lanes.started) == 1
+    # The channel holds no more jobs than the worker can run...
+    assert channel.qos[-1] == (1, True)
+    # ...and the received jobs wait in their queue for a free replica
+    assert sorted(channel.requeued) == [2, 3, 4, 5]
+    assert lanes.in_flight == 1
+
+
+def test_channel_limit_is_lifted_once_a_thread_is_free(lanes, channel):
+    receive(lanes, "yolo_queue", 1)
+    lanes._dispatch()
+    assert channel.qos == [(1, True)]
+    finish(lanes, lanes.started[0])
+    lanes._dispatch()
+    assert channel.qos == [(1, True), (0, True)]
+    assert lanes.in_flight == 0
+
+
+def test_larger_prefetch_keeps_the_jobs_it_allows(channel):
+    worker = Worker(prefetch_count=3, concurrency=1)
+    worker.channel = channel
+    worker.add_consumer("coordinator_queue", succeed)
+    worker.executor.submit = lambda *args: None
+    receive(worker, "coordinator_queue", 5)
+    worker._dispatch()
+    # One running and two waiting within the prefetch count of the channel
+    assert channel.qos == [(3, True)]
+    assert sorted(channel.requeued) == [4, 5]
+    assert worker._pending_count() == 2
+
+
+def test_draining_gives_back_the_jobs_not_started(lanes, channel):
+    receive(lanes, "yolo_fast_queue", 2)
+    lanes._give_back(lanes._pending_count())
+    assert sorted(channel.requeued) == [1, 2]
+    assert lanes.in_flight == 0
+
+
+@pytest.fixture
+def served(channel):
+    """A worker whose acknowledgements wait for the test to serve the connection."""
+    channel.connection.deferred = True
+    worker = Worker(concurrency=2)
+    worker.channel = channel
+    worker.connection = channel.connection
+    worker.consumer_tags = ["consumer-yolo_queue"]
+    return worker
+
+
+def start(worker, handler, count=1):
+    worker.add_consumer("yolo_queue", handler)
+    on_message = worker._on_message("yolo_queue", handler, None)
+    for tag in range(1, count + 1):
+        on_message(*delivery(worker.channel, {"item_id": tag}, tag=tag))
+    worker._dispatch()
+
+
+def serve_until(connection, condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        connection.process_data_events(time_limit=0.05)
+    assert condition()
+
+
+def test_jobs_run_off_the_connection_thread(served, channel, starts):
+    release = threading.Event()
+    job_threads = []
+    ack_threads = []
+    basic_ack = channel.basic_ack
+
+    def handler(ch, method, properties, body):
+        job_threads.append(threading.current_thread())
+        release.wait(5)
+
+    def ack(delivery_tag):
+        ack_threads.append(threading.current_thread())
+        basic_ack(delivery_tag)
+
+    channel.basic_ack = ack
+    start(served, handler, count=2)
+    # The connection keeps being served (heartbeats) while the jobs run
+    serve_until(channel.connection, lambda: len(job_threads) == 2)
+    channel.connection.process_data_events(time_limit=0.1)
+    assert channel.acked == []
+
+    release.set()
+    serve_until(channel.connection, lambda: len(channel.acked) == 2)
+    assert threading.current_thread() not in job_threads
+    assert ack_threads == [threading.current_thread()] * 2
+    assert served.in_flight == 0 and served.running == 0
+
+
+def test_job_finishing_after_its_connection_closed_is_not_acked(
+    served, channel, starts
+):
+    release = threading.Event()
+    start(served, lambda *args: release.wait(5))
+    channel.connection.close()
+    release.set()
+    serve_until(channel.connection, lambda: served.in_flight == 0)
+    assert channel.acked == []
+    assert served.running == 0
+
+
+def test_drain_waits_for_the_running_jobs(served, channel, starts):
+    release = threading.Event()
+    start(served, lambda *args: release.wait(5), count=3)
+    served._request_drain(signal.SIGTERM, None)
+    threading.Timer(0.2, release.set).start()
+    served._drain()
+    assert channel.cancelled == ["consumer-yolo_queue"]
+    # Two jobs ran to completion, the third was given back
+    assert sorted(channel.acked) == [1, 2]
+    assert channel.requeued == [3]
+    assert served.in_flight == 0
+    assert not channel.connection.is_open
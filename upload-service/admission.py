@@ -0,0 +1,149 @@
+import os
+import math
+import time
+import logging
+import threading
+import requests
+from common.messaging import SERVICE_BINDINGS
+from common.pipeline import plan_stages
+from common.queue_stats import fetch_queue_stats, service_depth
+
+# What to do with an upload while the services it needs are overloaded:
+# "reject" (429 with Retry-After), "hold" (store it and dispatch it once the load
+# drops), "downgrade" (sample the frames of videos less often) or "off"
+ADMISSION_POLICY = os.getenv("ADMISSION_POLICY", "reject").lower()
+# A service is overloaded once its queued jobs would take longer than this to drain...
+ADMISSION_MAX_BACKLOG_SECONDS = float(os.getenv("ADMISSION_MAX_BACKLOG_SECONDS", 600))
+# ...or once this many jobs wait in its queues
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", 1000))
+# Estimated seconds a replica spends on one job of each service, e.g. "ocr=20,yolo=4"
+ADMISSION_JOB_SECONDS = os.getenv("ADMISSION_JOB_SECONDS", "")
+# Largest frame interval (seconds) a downgraded video is sampled with
+ADMISSION_MAX_FRAME_SECOND = int(os.getenv("ADMISSION_MAX_FRAME_SECOND", 30))
+# Seconds the queue depths are cached between two uploads
+ADMISSION_STATS_TTL = float(os.getenv("ADMISSION_STATS_TTL", 5))
+
+# Seconds per job when ADMISSION_JOB_SECONDS does not list the service (a job is an
+# image, a frame batch or a whole video for Whisper)
+DEFAULT_JOB_SECONDS = {
+    "yolo": 5,
+    "yolo_cls": 5,
+    "yolo_logo": 5,
+    "ocr": 15,
+    "whisper": 120,
+    "sentiment": 2,
+}
+
+# Services whose work shrinks when frames are sampled less often
+FRAME_SERVICES = {"yolo", "yolo_cls", "yolo_logo", "ocr"}
+
+ADMIT = "admit"
+REJECT = "reject"
+HOLD = "hold"
+DOWNGRADE = "downgrade"
+
+_stats_lock = threading.Lock()
+_stats_cache = {"queues": None, "fetched_at": 0.0}
+
+
+def parse_job_seconds(spec):
+    """Parse "service=seconds,..." on top of DEFAULT_JOB_SECONDS."""
+    job_seconds = dict(DEFAULT_JOB_SECONDS)
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        service, seconds = entry.split("=")
+        job_seconds[service.strip()] = float(seconds)
+    return job_seconds
+
+
+JOB_SECONDS = parse_job_seconds(ADMISSION_JOB_SECONDS)
+
+
+def get_queue_stats(max_age=ADMISSION_STATS_TTL):
+    """Queue stats of the broker, cached for max_age seconds (None if unavailable)."""
+    with _stats_lock:
+        if time.time() - _stats_cache["fetched_at"] < max_age:
+            return _stats_cache["queues"]
+        try:
+            _stats_cache["queues"] = fetch_queue_stats(timeout=2)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to read the queue depths: {str(e)}")
+            _stats_cache["queues"] = None
+        _stats_cache["fetched_at"] = time.time()
+        return _stats_cache["queues"]
+
+
+def estimate_backlog(services, item_type, queues):
+    """
+    Return {service: {"ready", "seconds"}} for the stages an upload would run: the jobs
+    waiting for the service and the seconds its replicas need to work through the
+    waiting and running jobs.
+    """
+    backlog = {}
+    for service in plan_stages(services, item_type):
+        if service not in SERVICE_BINDINGS:
+            continue
+        depth = service_depth(service, queues)
+        replicas = max(depth["replicas"], 1)
+        backlog[service] = {
+            "ready": depth["ready"],
+            "seconds": (depth["ready"] + depth["unacked"])
+            * JOB_SECONDS.get(service, 0)
+            / replicas,
+        }
+    return backlog
+
+
+def check_admission(services, item_type, frame_second=None, policy=ADMISSION_POLICY):
+    """
+    Decide what to do with an upload from the backlog of the services it needs.
+
+    Returns a dict with the "action" (admit, reject, hold or downgrade), the
+    "retry_after" seconds until the overloaded services are expected to have drained
+    below the limits and, for a downgrade, the new "frame_second". Uploads are admitted
+    when the queue depths cannot be read.
+    """
+    decision = {"action": ADMIT, "retry_after": 0, "frame_second": frame_second}
+    if policy not in (REJECT, HOLD, DOWNGRADE):
+        return decision
+    queues = get_queue_stats()
+    if queues is None:
+        return decision
+
+    backlog = estimate_backlog(services, item_type, queues)
+    excess = {}
+    for service, service_backlog in backlog.items():
+        seconds_per_job = service_backlog["seconds"] / max(service_backlog["ready"], 1)
+        over_time = service_backlog["seconds"] - ADMISSION_MAX_BACKLOG_SECONDS
+        over_depth = (
+            service_backlog["ready"] - ADMISSION_MAX_QUEUE_DEPTH
+        ) * seconds_per_job
+        if over_time > 0 or service_backlog["ready"] > ADMISSION_MAX_QUEUE_DEPTH:
+            excess[service] = max(over_time, over_depth, 1)
+    if not excess:
+        return decision
+
+    decision["retry_after"] = math.ceil(max(excess.values()))
+    decision["overloaded"] = sorted(excess)
+    decision["action"] = REJECT if policy == DOWNGRADE else policy
+
+    # Sampling fewer frames only helps when the frame services are the bottleneck
+    if (
+        policy == DOWNGRADE
+        and item_type == "video"
+        and frame_second
+        and FRAME_SERVICES.issuperset(excess)
+    ):
+        # Spread the frames so the new video adds as much work as it would at the limit
+        load = max(
+            max(
+                backlog[service]["seconds"] / ADMISSION_MAX_BACKLOG_SECONDS,
+                backlog[service]["ready"] / max(ADMISSION_MAX_QUEUE_DEPTH, 1),
+            )
+            for service in excess
+        )
+        downgraded = min(math.ceil(frame_second * load), ADMISSION_MAX_FRAME_SECOND)
+        if downgraded > frame_second:
+            decision.update({"action": DOWNGRADE, "frame_second": downgraded})
+    return decision
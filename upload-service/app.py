@@ -4,13 +4,30 @@ import cv2
 import uuid
 import logging
 from fastapi import FastAPI, UploadFile, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from botocore.client import Config
 from typing import List
-import pika  # Import for RabbitMQ interaction
-import json
+import asyncio
+import hashlib
+import subprocess
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import requests
 from moviepy import VideoFileClip
+from imageio_ffmpeg import get_ffmpeg_exe
+from frame_sampling import (
+    open_sampler,
+    log_sampling_stats,
+    FRAME_SAMPLING_MODE,
+    SAMPLING_MODES,
+)
+from admission import ADMISSION_POLICY, DOWNGRADE, HOLD, REJECT, check_admission
+from common.frame_shards import FrameShardWriter
+from common.messaging import get_publisher
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -20,89 +37,529 @@ load_dotenv()
 
 BUCKET_NAME = os.getenv("BUCKET_NAME", "data-extraction-file-storage-thesis")
 RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
+# Size of each S3 multipart part (S3 requires at least 5 MB for all but the last part)
+UPLOAD_PART_SIZE = max(int(os.getenv("UPLOAD_PART_SIZE_MB", 8)), 5) * 1024 * 1024
+# Maximum number of parts being uploaded concurrently for a single file
+UPLOAD_MAX_INFLIGHT_PARTS = int(os.getenv("UPLOAD_MAX_INFLIGHT_PARTS", 4))
+# Number of threads encoding and uploading frames concurrently
+FRAME_UPLOAD_WORKERS = int(os.getenv("FRAME_UPLOAD_WORKERS", 8))
+# Maximum number of decoded frames waiting to be encoded (bounds memory usage)
+FRAME_QUEUE_SIZE = int(os.getenv("FRAME_QUEUE_SIZE", 32))
+FRAME_JPEG_QUALITY = int(os.getenv("FRAME_JPEG_QUALITY", 95))
+# How frames are stored on S3: "shards" (packed shards + index) or "objects" (one per frame)
+FRAME_STORAGE = os.getenv("FRAME_STORAGE", "shards").lower()
+FRAMES_PER_SHARD = int(os.getenv("FRAMES_PER_SHARD", 64))
+# Model-ready renditions stored next to each frame (shard storage only), as a comma
+# separated list of name:long_side:color|gray:jpg|webp:quality,
+# e.g. "detect:640:color:jpg:90,ocr:1024:gray:webp:90"
+FRAME_RENDITIONS = os.getenv("FRAME_RENDITIONS", "")
+# Return 202 right after the video is stored and extract frames in the background
+ASYNC_INGESTION = os.getenv("ASYNC_INGESTION", "true").lower() == "true"
+# Maximum number of videos being ingested (probed and split into frames) at the same time
+INGEST_MAX_CONCURRENCY = int(os.getenv("INGEST_MAX_CONCURRENCY", 2))
+# Report ingestion progress to the result service every N extracted frames (0 disables it)
+FRAME_PROGRESS_INTERVAL = int(os.getenv("FRAME_PROGRESS_INTERVAL", 50))
+# Reuse the results of an earlier upload of the same file with the same settings
+DEDUPLICATE_UPLOADS = os.getenv("DEDUPLICATE_UPLOADS", "true").lower() == "true"
+# Audio track extracted for the speech pipeline: "flac", "opus" or "none"
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "flac").lower()
+# Dispatch each frame shard to the frame services as soon as it is uploaded
+PIPELINED_DISPATCH = os.getenv("PIPELINED_DISPATCH", "true").lower() == "true"
+# Seconds between two attempts to dispatch uploads held by admission control, and
+# held uploads dispatched per attempt (the queue depths only reflect them later)
+ADMISSION_RELEASE_INTERVAL = float(os.getenv("ADMISSION_RELEASE_INTERVAL", 10))
+ADMISSION_RELEASE_BATCH = int(os.getenv("ADMISSION_RELEASE_BATCH", 5))
+# Seconds an item may take to be analysed when the upload sets no deadline (0 for
+# none): once it passes, no stage is started and running stages save partial results
+ITEM_DEADLINE_SECONDS = int(os.getenv("ITEM_DEADLINE_SECONDS", 0))
+# Seconds between two checks with the result service of whether an item being ingested
+# was cancelled (the cancel request may have reached another replica)
+INGESTION_CANCEL_CHECK_INTERVAL = float(os.getenv("INGESTION_CANCEL_CHECK_INTERVAL", 5))
+
+# Services that analyse video frames (and can therefore process frame batches)
+FRAME_SERVICES = {"yolo", "yolo_cls", "yolo_logo", "ocr"}
+# Priorities a client can request for an item (the coordinator picks its lane)
+PRIORITIES = ("high", "normal", "low")
+
+# ffmpeg arguments and file extension for each audio format (16 kHz mono, as used by Whisper)
+AUDIO_CODECS = {
+    "flac": (["-c:a", "flac"], "flac", "audio/flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "24k"], "ogg", "audio/ogg"),
+}
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO)
 
-# Initialize S3 client
-s3 = boto3.client("s3")
+# Initialize S3 client (the connection pool must fit every in-flight part and frame upload)
+s3 = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=max(
+            10, UPLOAD_MAX_INFLIGHT_PARTS * 4 + FRAME_UPLOAD_WORKERS
+        )
+    ),
+)
 
+# Thread pool used to upload multipart parts without blocking the event loop
+part_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_MAX_INFLIGHT_PARTS * 4)
 
-# Initialize RabbitMQ connection
-def publish_to_rabbitmq(queue_name, message):
+# Thread pool running video ingestion (duration probing, frame extraction, dispatch)
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_CONCURRENCY)
+
+# Thread pool extracting audio tracks alongside frame extraction
+audio_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_CONCURRENCY)
+
+# Cancellation flag of every item this replica is ingesting (set to stop extraction)
+ingestion_cancel_events = {}
+# Last time the cancelled status of each item being ingested was checked
+ingestion_cancel_checks = {}
+
+
+class IngestionCancelled(Exception):
+    """Raised from the extraction callbacks to stop ingesting a cancelled item."""
+
+
+def fetch_ingestion_cancelled(item_id):
+    """Whether the result service recorded the item as cancelled."""
     try:
-        # Set the RabbitMQ credentials (user/password as defined in docker-compose)
-        credentials = pika.PlainCredentials("user", "password")
+        response = requests.get(f"{RESULT_SERVICE_URL}/items/{item_id}/ingestion")
+        response.raise_for_status()
+        return response.json().get("ingestion_status") == "cancelled"
+    except requests.exceptions.RequestException as e:
+        # Checked again later, extraction goes on meanwhile
+        logging.error(f"Failed to check if item {item_id} was cancelled: {str(e)}")
+        return False
 
-        # Establish a connection to RabbitMQ with credentials
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
-        )
-        channel = connection.channel()
 
-        # Declare a queue to ensure it exists
-        channel.queue_declare(queue=queue_name, durable=True)
+def check_ingestion_cancelled(item_id):
+    """
+    Raise IngestionCancelled once the item was cancelled: through this replica (its
+    event is set), or through any replica (the result service is asked at most every
+    INGESTION_CANCEL_CHECK_INTERVAL seconds).
+    """
+    cancel_event = ingestion_cancel_events.get(item_id)
+    if cancel_event is None:
+        return
+    now = time.monotonic()
+    if (
+        not cancel_event.is_set()
+        and now - ingestion_cancel_checks.get(item_id, now)
+        >= INGESTION_CANCEL_CHECK_INTERVAL
+    ):
+        ingestion_cancel_checks[item_id] = now
+        if fetch_ingestion_cancelled(item_id):
+            cancel_event.set()
+    if cancel_event.is_set():
+        raise IngestionCancelled(item_id)
 
-        # Publish the message to the specified queue
-        channel.basic_publish(
-            exchange="", routing_key=queue_name, body=json.dumps(message)
-        )
+
+# Publish a message through the shared, long-lived RabbitMQ publisher
+def publish_to_rabbitmq(queue_name, message):
+    try:
+        get_publisher().publish(queue_name, message)
 
         logging.info(
             f"Message published to RabbitMQ queue '{queue_name}' with content: {message}"
         )
 
     except Exception as e:
+        # Raised so the item is recorded as failed instead of waiting for a lost job
         logging.error(f"Failed to publish message to RabbitMQ. Error: {str(e)}")
+        raise
+
+
+def upload_part_to_s3(s3_key, upload_id, part_number, chunk):
+    """Upload a single multipart part and return its completion descriptor."""
+    response = s3.upload_part(
+        Bucket=BUCKET_NAME,
+        Key=s3_key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=chunk,
+    )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+async def stream_upload_to_s3(
+    file: UploadFile, s3_key, extra_args=None, spool_path=None, hasher=None
+):
+    """
+    Stream an uploaded file to S3 using a concurrent multipart upload.
+
+    The file is read in UPLOAD_PART_SIZE chunks and at most UPLOAD_MAX_INFLIGHT_PARTS
+    parts are uploaded at the same time, so memory usage is bounded by the part window
+    instead of the file size. When spool_path is given the chunks are also written to
+    that local file (e.g. for frame extraction), and when hasher is given (a hashlib
+    object) it is updated with every chunk.
+
+    :return: Total number of bytes uploaded.
+    """
+    extra_args = extra_args or {}
+    loop = asyncio.get_running_loop()
+    spool_file = open(spool_path, "wb") if spool_path else None
+    upload_id = None
+    part_tasks = []
+    total_bytes = 0
+
+    # Blocking calls (S3 requests, spool writes, hashing) run on the executor so the
+    # event loop keeps serving other requests
+    def run_blocking(function, *args, **kwargs):
+        return loop.run_in_executor(
+            part_upload_executor, lambda: function(*args, **kwargs)
+        )
+
+    def consume_chunk(chunk):
+        if spool_file:
+            spool_file.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+
+    try:
+        chunk = await file.read(UPLOAD_PART_SIZE)
+        next_chunk = await file.read(UPLOAD_PART_SIZE) if chunk else b""
+
+        # Small files fit in a single request, no need for a multipart upload
+        if not next_chunk:
+            await run_blocking(consume_chunk, chunk)
+            await loop.run_in_executor(
+                part_upload_executor,
+                lambda: s3.put_object(
+                    Bucket=BUCKET_NAME, Key=s3_key, Body=chunk, **extra_args
+                ),
+            )
+            return len(chunk)
+
+        upload_id = (
+            await run_blocking(
+                s3.create_multipart_upload,
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                **extra_args,
+            )
+        )["UploadId"]
+        in_flight = set()
+        parts = []
+        part_number = 1
+
+        while chunk:
+            # Wait for a slot in the in-flight window before reading more data
+            if len(in_flight) >= UPLOAD_MAX_INFLIGHT_PARTS:
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                parts.extend(task.result() for task in done)
+
+            # Chunks are spooled and hashed in order, one at a time
+            await run_blocking(consume_chunk, chunk)
+            part_tasks.append(
+                loop.run_in_executor(
+                    part_upload_executor,
+                    upload_part_to_s3,
+                    s3_key,
+                    upload_id,
+                    part_number,
+                    chunk,
+                )
+            )
+            in_flight.add(part_tasks[-1])
+            total_bytes += len(chunk)
+            part_number += 1
+            chunk, next_chunk = next_chunk, (
+                await file.read(UPLOAD_PART_SIZE) if next_chunk else b""
+            )
+
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            parts.extend(task.result() for task in done)
+
+        parts.sort(key=lambda part: part["PartNumber"])
+        await run_blocking(
+            s3.complete_multipart_upload,
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        logging.info(
+            f"Multipart upload of '{s3_key}' completed: {len(parts)} parts, {total_bytes} bytes."
+        )
+        return total_bytes
+
+    except Exception:
+        if upload_id:
+            # Parts still uploading would be stored after the abort, wait for them
+            await asyncio.gather(*part_tasks, return_exceptions=True)
+            await run_blocking(
+                s3.abort_multipart_upload,
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                UploadId=upload_id,
+            )
+            logging.error(f"Multipart upload of '{s3_key}' aborted.")
+        raise
     finally:
-        connection.close()
+        if spool_file:
+            await run_blocking(spool_file.close)
+
+
+def parse_renditions(spec):
+    """Parse FRAME_RENDITIONS into a list of rendition settings."""
+    renditions = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, long_side, color, image_format, quality = item.split(":")
+        if color not in ("color", "gray") or image_format not in ("jpg", "webp"):
+            raise ValueError(f"Invalid frame rendition '{item}'")
+        renditions.append(
+            {
+                "name": name,
+                "long_side": int(long_side),
+                "gray": color == "gray",
+                "format": image_format,
+                "quality": int(quality),
+            }
+        )
+    return renditions
+
+
+RENDITIONS = parse_renditions(FRAME_RENDITIONS)
+
+
+def encode_rendition(frame, rendition):
+    """Downscale (never upscale) and encode a frame for a specific consumer model."""
+    height, width = frame.shape[:2]
+    scale = rendition["long_side"] / max(height, width)
+    if scale < 1:
+        frame = cv2.resize(
+            frame,
+            (round(width * scale), round(height * scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+    if rendition["gray"]:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    if rendition["format"] == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, rendition["quality"]]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, rendition["quality"]]
+    success, buffer = cv2.imencode(f".{rendition['format']}", frame, params)
+    if not success:
+        raise ValueError(f"Failed to encode rendition '{rendition['name']}'")
+    return buffer.tobytes()
+
+
+def encode_and_upload_frames(frame_queue, frames_dir, shard_writer, errors):
+    """
+    Worker: JPEG-encode frames from the queue in memory and upload them to S3, either
+    packed into shards through shard_writer or as one object per frame.
+    """
+    while True:
+        item = frame_queue.get()
+        try:
+            if item is None:
+                return
+            # Keep draining after a failure so the producer never blocks on a full queue
+            if errors:
+                continue
+            frame_count, timestamp, frame = item
+            success, buffer = cv2.imencode(
+                ".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, FRAME_JPEG_QUALITY]
+            )
+            if not success:
+                raise ValueError(f"Failed to encode frame {frame_count}")
+            if shard_writer is not None:
+                renditions = {
+                    rendition["name"]: encode_rendition(frame, rendition)
+                    for rendition in RENDITIONS
+                }
+                # The original size lets results on renditions be scaled back
+                shard_writer.add(
+                    frame_count,
+                    buffer.tobytes(),
+                    renditions=renditions,
+                    timestamp=timestamp,
+                    width=frame.shape[1],
+                    height=frame.shape[0],
+                )
+                continue
+            s3_frame_key = f"{frames_dir}frame_{frame_count}.jpg"
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=s3_frame_key,
+                Body=buffer.tobytes(),
+                ContentType="image/jpeg",
+            )
+            logging.info(f"Uploaded frame {frame_count} to S3 at '{s3_frame_key}'.")
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frame_queue.task_done()
 
 
 # Function to split and upload video frames
-def split_and_upload_frames(video_path, frame_second, video_id):
+def split_and_upload_frames(
+    video_path,
+    frame_second,
+    video_id,
+    progress_callback=None,
+    sampling_mode=None,
+    on_batch=None,
+):
+    """
+    Decode sampled frames on the calling thread and hand them to a pool of workers
+    that encode and upload them concurrently through a bounded queue.
+
+    progress_callback, if given, is called with the number of frames extracted so far
+    every FRAME_PROGRESS_INTERVAL frames. on_batch, if given, is called with
+    (batch_number, index entries) each time a frame shard has been uploaded.
+
+    :return: The frames directory, the timestamp (in seconds) of every stored frame and
+        the number of frame batches (None when frames are stored as single objects).
+    """
     frames_dir = f"videos/{video_id}/frames/"
+    video_capture = None
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    errors = []
+    frame_timestamps = []
+    shard_writer = (
+        FrameShardWriter(
+            s3, BUCKET_NAME, frames_dir, FRAMES_PER_SHARD, on_shard=on_batch
+        )
+        if FRAME_STORAGE == "shards"
+        else None
+    )
+    workers = [
+        threading.Thread(
+            target=encode_and_upload_frames,
+            args=(frame_queue, frames_dir, shard_writer, errors),
+            daemon=True,
+        )
+        for _ in range(FRAME_UPLOAD_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+
     try:
-        video_capture = cv2.VideoCapture(video_path)
-        fps = int(video_capture.get(cv2.CAP_PROP_FPS))
-        frame_interval = fps * frame_second
-        frame_count = 0
+        video_capture, frame_interval, frames, stats = open_sampler(
+            video_path, frame_second, sampling_mode
+        )
 
         logging.info(
-            f"Starting to split video '{video_id}' into frames every {frame_second} seconds."
+            f"Starting to split video '{video_id}' into frames every {frame_second} seconds "
+            f"in '{stats['mode']}' mode using the '{stats['strategy']}' strategy "
+            f"and {FRAME_UPLOAD_WORKERS} upload workers."
         )
 
-        while True:
-            success, frame = video_capture.read()
-            if not success:
+        for frame_count, frame in frames:
+            if errors:
                 break
-            if frame_count % frame_interval == 0:
-                frame_filename = f"/tmp/frame{frame_count}.jpg"
-                cv2.imwrite(frame_filename, frame)
-                s3_frame_key = f"{frames_dir}frame_{frame_count}.jpg"
-                s3.upload_file(frame_filename, BUCKET_NAME, s3_frame_key)
-                os.remove(frame_filename)
-                logging.info(f"Uploaded frame {frame_count} to S3 at '{s3_frame_key}'.")
-            frame_count += 1
-
-        logging.info(f"Completed frame splitting for video '{video_id}'.")
-        return frames_dir  # Return the frames directory path
+            # Real timestamp of the frame, sampling may not be uniform
+            timestamp = round(frame_count / stats["fps"], 3) if stats["fps"] else 0
+            frame_queue.put((frame_count, timestamp, frame))  # Blocks while full
+            frame_timestamps.append(timestamp)
+            if (
+                progress_callback
+                and FRAME_PROGRESS_INTERVAL > 0
+                and len(frame_timestamps) % FRAME_PROGRESS_INTERVAL == 0
+            ):
+                progress_callback(len(frame_timestamps))
+
+        log_sampling_stats(video_id, stats)
     except Exception as e:
+        errors.append(e)
+    finally:
+        for _ in workers:
+            frame_queue.put(None)
+        for worker in workers:
+            worker.join()
+        if video_capture is not None:
+            video_capture.release()
+
+    if shard_writer is not None and not errors:
+        try:
+            shard_writer.close()
+        except Exception as e:
+            errors.append(e)
+
+    if errors:
         logging.error(
-            f"Failed to split and upload frames for video '{video_id}'. Error: {str(e)}"
+            f"Failed to split and upload frames for video '{video_id}'. Error: {str(errors[0])}"
         )
-        raise
+        raise errors[0]
+
+    logging.info(
+        f"Completed frame splitting for video '{video_id}': {len(frame_timestamps)} frames stored."
+    )
+    frame_batches = shard_writer.shard_count if shard_writer is not None else None
+    return frames_dir, frame_timestamps, frame_batches
+
+
+def extract_and_upload_audio(video_path, video_id):
+    """
+    Extract a 16 kHz mono audio track from the video with ffmpeg and upload it to S3.
+
+    :return: The S3 key of the audio file, or None if the video has no audio track.
+    """
+    codec_args, extension, content_type = AUDIO_CODECS[AUDIO_FORMAT]
+    audio_path = f"/tmp/{video_id}_audio.{extension}"
+    s3_audio_key = f"videos/{video_id}/audio.{extension}"
+
+    try:
+        command = [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-i", video_path]
+        command += ["-vn", "-ac", "1", "-ar", "16000", *codec_args, audio_path]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0 or not os.path.exists(audio_path):
+            # Videos without an audio stream make ffmpeg fail with "does not contain any stream"
+            logging.warning(
+                f"No audio extracted for video '{video_id}': {completed.stderr.strip()}"
+            )
+            return None
+
+        s3.upload_file(
+            audio_path,
+            BUCKET_NAME,
+            s3_audio_key,
+            ExtraArgs={"ContentType": content_type},
+        )
+        logging.info(
+            f"Audio for video '{video_id}' uploaded to S3 at '{s3_audio_key}' "
+            f"({os.path.getsize(audio_path)} bytes)."
+        )
+        return s3_audio_key
     finally:
-        video_capture.release()
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+
+
+def publish_frame_batch(
+    item_id, services, languages, frames_dir, batch, entries, **extra_fields
+):
+    """Notify the coordinator that a batch (shard) of frames is ready for analysis."""
+    publish_to_rabbitmq(
+        "coordinator_queue",
+        {
+            "event": "frame_batch",
+            "item_id": item_id,
+            "services": services,
+            "languages": languages,
+            "frames_path": frames_dir,
+            "batch": batch,
+            "frames": entries,
+            **extra_fields,
+        },
+    )
 
 
 # Function to notify the coordinator via RabbitMQ
-def notify_services_via_rabbitmq(item_id, services, item_type, paths, languages):
+def notify_services_via_rabbitmq(
+    item_id, services, item_type, paths, languages, **extra_fields
+):
     message = {
         "item_id": item_id,
         "services": services,
         "item_type": item_type,
         "paths": paths,
         "languages": languages,
+        **extra_fields,
     }
 
     logging.info(f"Sending message to RabbitMQ to notify services: {message}")
@@ -111,7 +568,19 @@ def notify_services_via_rabbitmq(item_id, services, item_type, paths, languages)
     publish_to_rabbitmq("coordinator_queue", message)
 
 
-def save_upload(item_id, services, frame_second, s3_file_key, video_length, languages):
+def save_upload(
+    item_id,
+    services,
+    frame_second,
+    s3_file_key,
+    video_length,
+    languages,
+    ingestion_status="completed",
+    content_hash=None,
+    reused_from=None,
+    sampling_mode="interval",
+    held_request=None,
+):
     frame_second = frame_second if frame_second is not None else 0
     video_length = video_length if video_length is not None else 0
     languages = languages if languages is not None else []
@@ -123,6 +592,11 @@ def save_upload(item_id, services, frame_second, s3_file_key, video_length, lang
         "s3_file_key": s3_file_key,
         "video_length": video_length,
         "languages": languages,
+        "ingestion_status": ingestion_status,
+        "content_hash": content_hash,
+        "reused_from": reused_from,
+        "sampling_mode": sampling_mode,
+        "held_request": held_request,
     }
 
     logging.info(f"results data: {result_data}")
@@ -135,98 +609,623 @@ def save_upload(item_id, services, frame_second, s3_file_key, video_length, lang
         logging.error(f"Failed to save upload details to result service: {str(e)}")
 
 
+def find_duplicate_upload(
+    content_hash, services, frame_second, languages, sampling_mode="interval"
+):
+    """Ask the result service for an earlier item with the same content and settings."""
+    lookup_data = {
+        "content_hash": content_hash,
+        "services": services,
+        "languages": languages,
+        "frame_second": frame_second if frame_second is not None else 0,
+        "sampling_mode": sampling_mode,
+    }
+
+    try:
+        response = requests.post(
+            f"{RESULT_SERVICE_URL}/upload/lookup", json=lookup_data
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        # Deduplication is an optimisation, process the upload normally
+        logging.error(f"Failed to look up duplicate uploads: {str(e)}")
+        return None
+
+
+def reuse_duplicate_upload(
+    item_id,
+    duplicate,
+    s3_key,
+    services,
+    frame_second,
+    languages,
+    content_hash,
+    sampling_mode="interval",
+):
+    """Create the item as a reference to the results of an identical earlier upload."""
+    # The original upload is already stored, drop the copy we just streamed
+    s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+    save_upload(
+        item_id,
+        services,
+        frame_second,
+        duplicate["s3_file_key"],
+        duplicate.get("video_length"),
+        languages,
+        content_hash=content_hash,
+        reused_from=duplicate["item_id"],
+        sampling_mode=sampling_mode,
+    )
+    logging.info(
+        f"Item {item_id} is a duplicate of item {duplicate['item_id']}, reusing its results."
+    )
+    return {
+        "item_id": item_id,
+        "reused_from": duplicate["item_id"],
+        "message": f"Identical file already processed, reusing results of item {duplicate['item_id']}.",
+    }
+
+
+def update_ingestion(item_id, ingestion_status, **fields):
+    """Report the ingestion status (and e.g. video_length, frames_extracted) of an item."""
+    ingestion_data = {
+        "item_id": item_id,
+        "ingestion_status": ingestion_status,
+        **fields,
+    }
+
+    try:
+        response = requests.post(
+            f"{RESULT_SERVICE_URL}/upload/ingestion", json=ingestion_data
+        )
+        response.raise_for_status()
+        logging.info(f"Ingestion status of item {item_id} set to '{ingestion_status}'.")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to save ingestion status to result service: {str(e)}")
+
+
+def ingest_video(
+    item_id,
+    file_path,
+    filename,
+    frame_second,
+    services,
+    languages,
+    s3_video_key,
+    sampling_mode=None,
+    priority=None,
+    deadline=None,
+):
+    """Probe, split and dispatch a video that is already stored on S3 and spooled locally."""
+    ingestion_cancel_events[item_id] = threading.Event()
+    ingestion_cancel_checks[item_id] = time.monotonic()
+    try:
+        # Get the video length using VideoFileClip
+        video = VideoFileClip(file_path)
+        video_length = video.duration  # Get video length in seconds
+        video.close()
+        update_ingestion(item_id, "extracting", video_length=video_length)
+
+        # The coordinator picks the lane of the item from its estimated work
+        estimated_frames = int(video_length // frame_second) + 1
+
+        # Extract the audio for Whisper while frames are being extracted
+        audio_future = None
+        if "whisper" in services and AUDIO_FORMAT in AUDIO_CODECS:
+            audio_future = audio_executor.submit(
+                extract_and_upload_audio, file_path, item_id
+            )
+
+        # Frame services start on each batch while the rest of the video is extracted
+        pipelined = (
+            PIPELINED_DISPATCH
+            and FRAME_STORAGE == "shards"
+            and bool(FRAME_SERVICES.intersection(services))
+        )
+
+        def on_batch(batch, entries):
+            check_ingestion_cancelled(item_id)
+            publish_frame_batch(
+                item_id,
+                services,
+                languages,
+                f"videos/{item_id}/frames/",
+                batch,
+                entries,
+                estimated_frames=estimated_frames,
+                priority=priority,
+                deadline=deadline,
+            )
+
+        def on_progress(frames):
+            check_ingestion_cancelled(item_id)
+            update_ingestion(item_id, "extracting", frames_extracted=frames)
+
+        # Split and upload frames for YOLO
+        frames_dir, frame_timestamps, frame_batches = split_and_upload_frames(
+            file_path,
+            frame_second,
+            item_id,
+            progress_callback=on_progress,
+            sampling_mode=sampling_mode,
+            on_batch=on_batch if pipelined else None,
+        )
+        # Store the frame index so results can be aligned with non-uniform timestamps,
+        # and the batch count so the result service knows when batch results are complete
+        update_ingestion(
+            item_id,
+            "extracting",
+            frames_extracted=len(frame_timestamps),
+            frame_timestamps=frame_timestamps,
+            frame_batches=frame_batches if pipelined else None,
+        )
+
+        check_ingestion_cancelled(item_id)
+
+        # Add the paths to the message
+        paths = {"video_path": s3_video_key, "frames_path": frames_dir}
+
+        if audio_future is not None:
+            try:
+                audio_key = audio_future.result()
+                if audio_key:
+                    paths["audio_path"] = audio_key
+            except Exception as e:
+                # Whisper falls back to the full video
+                logging.error(f"Failed to extract audio for item {item_id}: {str(e)}")
+
+        # Notify the services via RabbitMQ (for pipelined items this is the
+        # "extraction complete" marker, frame services already got their batches)
+        notify_services_via_rabbitmq(
+            item_id,
+            services,
+            "video",
+            paths,
+            languages,
+            event="extraction_complete",
+            pipelined=pipelined,
+            frame_batches=frame_batches,
+            estimated_frames=len(frame_timestamps),
+            priority=priority,
+            deadline=deadline,
+        )
+        update_ingestion(item_id, "completed")
+
+        logging.info(
+            f"Video '{filename}' processed, frames uploaded, and services triggered via coordinator."
+        )
+    except IngestionCancelled:
+        # The result service already recorded the cancellation
+        logging.info(f"Item {item_id} was cancelled, stopped ingesting '{filename}'.")
+    except Exception as e:
+        logging.error(f"Error ingesting video '{filename}'. Error: {str(e)}")
+        update_ingestion(item_id, "failed", ingestion_error=str(e))
+        raise
+    finally:
+        ingestion_cancel_events.pop(item_id, None)
+        ingestion_cancel_checks.pop(item_id, None)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logging.info(f"Temporary file '{file_path}' deleted.")
+
+
+def hold_upload(
+    item_id,
+    item_type,
+    filename,
+    s3_key,
+    services,
+    frame_second,
+    languages,
+    content_hash,
+    sampling_mode,
+    priority,
+    deadline=None,
+):
+    """
+    Record a stored upload as held: it is dispatched by release_held_uploads once the
+    services it needs have drained (the state lives in the result service, so held
+    uploads survive a restart).
+    """
+    save_upload(
+        item_id,
+        services,
+        frame_second,
+        s3_key,
+        None,
+        languages,
+        ingestion_status="held",
+        content_hash=content_hash,
+        sampling_mode=sampling_mode,
+        held_request={
+            "item_type": item_type,
+            "filename": filename,
+            "priority": priority,
+            "deadline": deadline,
+        },
+    )
+    logging.info(f"Services of item {item_id} are overloaded, holding the upload.")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "item_id": item_id,
+            "ingestion_status": "held",
+            "message": f"'{filename}' uploaded, processing starts once the services have capacity.",
+        },
+    )
+
+
+def dispatch_held_upload(item):
+    """Ingest (videos) or dispatch (images) a held upload claimed for release."""
+    item_id = item["item_id"]
+    request = item["held_request"]
+    try:
+        if request["item_type"] == "video":
+            file_path = f"/tmp/{item_id}_{request['filename']}"
+            s3.download_file(BUCKET_NAME, item["s3_file_key"], file_path)
+            ingest_executor.submit(
+                ingest_video,
+                item_id,
+                file_path,
+                request["filename"],
+                item["frame_second"],
+                item["services"],
+                item["languages"],
+                item["s3_file_key"],
+                item.get("sampling_mode"),
+                request.get("priority"),
+                request.get("deadline"),
+            )
+        else:
+            notify_services_via_rabbitmq(
+                item_id,
+                item["services"],
+                "image",
+                {"image_path": item["s3_file_key"]},
+                item["languages"],
+                estimated_frames=1,
+                priority=request.get("priority"),
+                deadline=request.get("deadline"),
+            )
+            update_ingestion(item_id, "completed")
+        logging.info(f"Released held item {item_id}.")
+    except Exception as e:
+        logging.error(f"Failed to release held item {item_id}: {str(e)}")
+        update_ingestion(item_id, "failed", ingestion_error=str(e))
+
+
+def release_next_held_upload():
+    """
+    Dispatch the oldest held upload if admission control now lets it in. Returns True
+    if another held upload may be released right away.
+    """
+    response = requests.get(f"{RESULT_SERVICE_URL}/upload/held")
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    item = response.json()
+
+    decision = check_admission(
+        item["services"], item["held_request"]["item_type"], item["frame_second"]
+    )
+    if decision["action"] != "admit":
+        return False
+
+    # Claim the item, so only one upload service replica dispatches it
+    response = requests.post(
+        f"{RESULT_SERVICE_URL}/upload/release", json={"item_id": item["item_id"]}
+    )
+    if response.status_code == 409:
+        return True
+    response.raise_for_status()
+    dispatch_held_upload(item)
+    return True
+
+
+def release_held_uploads():
+    """Background loop releasing held uploads, oldest first, as the load drops."""
+    while True:
+        time.sleep(ADMISSION_RELEASE_INTERVAL)
+        try:
+            for _ in range(ADMISSION_RELEASE_BATCH):
+                if not release_next_held_upload():
+                    break
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to release held uploads: {str(e)}")
+
+
+@app.on_event("startup")
+def start_admission_release():
+    if ADMISSION_POLICY == HOLD:
+        threading.Thread(target=release_held_uploads, daemon=True).start()
+
+
 @app.post("/upload")
 async def upload_file(
     file: UploadFile,
     frame_second: int = Form(None),
     services: List[str] = Form(...),
     languages: List[str] = Form(...),
+    sampling_mode: str = Form(None),
+    priority: str = Form(None),
+    deadline_seconds: int = Form(None),
 ):
     item_id = str(uuid.uuid4())  # Generate unique ID for both videos and images
-    file_path = f"/tmp/{file.filename}"
-    s3_file_key = None
-    video_length = None  # To store video length
+    # Prefix with the item_id so concurrent uploads of the same filename don't collide
+    file_path = f"/tmp/{item_id}_{file.filename}"
+    sampling_mode = (sampling_mode or FRAME_SAMPLING_MODE).lower()
+    if sampling_mode not in SAMPLING_MODES:
+        return {"error": f"sampling_mode must be one of {', '.join(SAMPLING_MODES)}."}
+    if priority is not None and priority not in PRIORITIES:
+        return {"error": f"priority must be one of {', '.join(PRIORITIES)}."}
+    item_type = "video" if file.filename.endswith((".mp4", ".mov")) else "image"
+    if item_type == "video" and frame_second is not None and frame_second <= 0:
+        return {"error": "frame_second must be a positive number of seconds."}
+    # The deadline is absolute, time spent held or ingesting counts towards it
+    if deadline_seconds is None:
+        deadline_seconds = ITEM_DEADLINE_SECONDS
+    deadline = time.time() + deadline_seconds if deadline_seconds > 0 else None
 
-    try:
-        # Save the uploaded file locally
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-        logging.info(f"File '{file.filename}' saved locally at '{file_path}'.")
+    # Admission control: keep the load sustainable when the services fall behind.
+    # Calls to the other services block, so they run on the thread pool
+    admission = await run_in_threadpool(
+        check_admission, services, item_type, frame_second
+    )
+    if admission["action"] == REJECT:
+        logging.info(
+            f"Rejected '{file.filename}', overloaded services: {admission['overloaded']}"
+        )
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(admission["retry_after"])},
+            content={
+                "error": f"Services {', '.join(admission['overloaded'])} are overloaded, retry later.",
+                "retry_after": admission["retry_after"],
+            },
+        )
+    if admission["action"] == DOWNGRADE:
+        logging.info(
+            f"Services {admission['overloaded']} are overloaded, sampling '{file.filename}'"
+            f" every {admission['frame_second']}s instead of every {frame_second}s"
+        )
+        frame_second = admission["frame_second"]
+    held = admission["action"] == HOLD
 
+    try:
         paths = {}
 
-        if file.filename.endswith((".mp4", ".mov")):
+        if item_type == "video":
             if frame_second is None:
                 logging.error(
                     "Frame second is required for video files but was not provided."
                 )
                 return {"error": "frame_second is required for video files."}
 
-            # Get the video length using VideoFileClip
-            video = VideoFileClip(file_path)
-            video_length = video.duration  # Get video length in seconds
-            video.close()
-
-            # Upload full video for Whisper
+            # Stream the full video to S3 for Whisper, spooling a local copy for frame extraction
             s3_video_key = f"videos/{item_id}/{file.filename}"
-            s3.upload_file(
-                file_path,
-                BUCKET_NAME,
-                s3_video_key,
-                ExtraArgs={
-                    "ContentType": "image/jpeg",  # or the correct content type for your file
-                    "ACL": "public-read",  # Set the file to be publicly readable
-                },
+            hasher = hashlib.sha256()
+            try:
+                await stream_upload_to_s3(
+                    file,
+                    s3_video_key,
+                    extra_args={
+                        "ContentType": file.content_type or "video/mp4",
+                        "ACL": "public-read",  # Set the file to be publicly readable
+                    },
+                    spool_path=file_path,
+                    hasher=hasher,
+                )
+            except Exception:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                raise
+            logging.info(
+                f"Video '{file.filename}' uploaded to S3 at '{s3_video_key}' and spooled to '{file_path}'."
             )
-            logging.info(f"Video '{file.filename}' uploaded to S3 at '{s3_video_key}'.")
 
-            # Split and upload frames for YOLO
-            frames_dir = split_and_upload_frames(file_path, frame_second, item_id)
+            content_hash = hasher.hexdigest()
+            duplicate = (
+                await run_in_threadpool(
+                    find_duplicate_upload,
+                    content_hash,
+                    services,
+                    frame_second,
+                    languages,
+                    sampling_mode,
+                )
+                if DEDUPLICATE_UPLOADS
+                else None
+            )
+            if duplicate:
+                os.remove(file_path)
+                return await run_in_threadpool(
+                    reuse_duplicate_upload,
+                    item_id,
+                    duplicate,
+                    s3_video_key,
+                    services,
+                    frame_second,
+                    languages,
+                    content_hash,
+                    sampling_mode,
+                )
 
-            # Add the paths to the message
-            paths["video_path"] = s3_video_key
-            paths["frames_path"] = frames_dir
-            s3_file_key = s3_video_key
+            if held:
+                os.remove(file_path)
+                return await run_in_threadpool(
+                    hold_upload,
+                    item_id,
+                    "video",
+                    file.filename,
+                    s3_video_key,
+                    services,
+                    frame_second,
+                    languages,
+                    content_hash,
+                    sampling_mode,
+                    priority,
+                    deadline,
+                )
 
-            # Notify the services via RabbitMQ
-            notify_services_via_rabbitmq(item_id, services, "video", paths, languages)
+            # Record the item before extraction so the dashboard can show its progress
+            await run_in_threadpool(
+                save_upload,
+                item_id,
+                services,
+                frame_second,
+                s3_video_key,
+                None,
+                languages,
+                ingestion_status="ingesting",
+                content_hash=content_hash,
+                sampling_mode=sampling_mode,
+            )
 
-            logging.info(
-                f"Video '{file.filename}' processed, frames uploaded, and services triggered via coordinator."
+            # Probing, frame extraction and dispatch run in the bounded ingestion pool
+            future = ingest_executor.submit(
+                ingest_video,
+                item_id,
+                file_path,
+                file.filename,
+                frame_second,
+                services,
+                languages,
+                s3_video_key,
+                sampling_mode,
+                priority,
+                deadline,
             )
+
+            if ASYNC_INGESTION:
+                return JSONResponse(
+                    status_code=202,
+                    content={
+                        "item_id": item_id,
+                        "ingestion_status": "ingesting",
+                        "frame_second": frame_second,
+                        "message": f"Video '{file.filename}' uploaded, frame extraction started.",
+                    },
+                )
+
+            await asyncio.wrap_future(future)
             return {
-                "message": f"Video '{file.filename}' processed, frames uploaded, and services triggered via coordinator."
+                "item_id": item_id,
+                "message": f"Video '{file.filename}' processed, frames uploaded, and services triggered via coordinator.",
             }
 
         else:
-            # Upload the image
+            # Stream the image to S3, no local copy is needed
             s3_image_key = f"images/{item_id}/{file.filename}"
-            s3.upload_file(file_path, BUCKET_NAME, s3_image_key)
+            hasher = hashlib.sha256()
+            await stream_upload_to_s3(file, s3_image_key, hasher=hasher)
             logging.info(f"Image '{file.filename}' uploaded to S3 at '{s3_image_key}'.")
 
+            content_hash = hasher.hexdigest()
+            duplicate = (
+                await run_in_threadpool(
+                    find_duplicate_upload,
+                    content_hash,
+                    services,
+                    frame_second,
+                    languages,
+                )
+                if DEDUPLICATE_UPLOADS
+                else None
+            )
+            if duplicate:
+                return await run_in_threadpool(
+                    reuse_duplicate_upload,
+                    item_id,
+                    duplicate,
+                    s3_image_key,
+                    services,
+                    frame_second,
+                    languages,
+                    content_hash,
+                )
+
+            if held:
+                return await run_in_threadpool(
+                    hold_upload,
+                    item_id,
+                    "image",
+                    file.filename,
+                    s3_image_key,
+                    services,
+                    frame_second,
+                    languages,
+                    content_hash,
+                    "interval",
+                    priority,
+                    deadline,
+                )
+
+            await run_in_threadpool(
+                save_upload,
+                item_id,
+                services,
+                frame_second,
+                s3_image_key,
+                None,
+                languages,
+                content_hash=content_hash,
+            )
+
             # Add the image path to the message
             paths["image_path"] = s3_image_key
-            s3_file_key = s3_image_key
 
             # Notify the services via RabbitMQ
-            notify_services_via_rabbitmq(item_id, services, "image", paths, languages)
+            try:
+                await run_in_threadpool(
+                    notify_services_via_rabbitmq,
+                    item_id,
+                    services,
+                    "image",
+                    paths,
+                    languages,
+                    estimated_frames=1,
+                    priority=priority,
+                    deadline=deadline,
+                )
+            except Exception as e:
+                await run_in_threadpool(
+                    update_ingestion, item_id, "failed", ingestion_error=str(e)
+                )
+                raise
 
             logging.info(
                 f"Image '{file.filename}' uploaded and services triggered via coordinator."
             )
             return {
-                "message": f"Image '{file.filename}' uploaded and services triggered via coordinator."
+                "item_id": item_id,
+                "message": f"Image '{file.filename}' uploaded and services triggered via coordinator.",
             }
 
     except Exception as e:
         logging.error(f"Error processing file '{file.filename}'. Error: {str(e)}")
         return {"error": str(e)}
 
-    finally:
-        # Pass the video_length to save_upload (if it's a video)
-        save_upload(
-            item_id, services, frame_second, s3_file_key, video_length, languages
-        )
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logging.info(f"Temporary file '{file_path}' deleted.")
+
+@app.post("/upload/{item_id}/cancel")
+def cancel_upload(item_id: str):
+    """
+    Cancel an item: the result service records it and has the coordinator stop its
+    analysis, and frame extraction stops if this replica is still ingesting it.
+    """
+    try:
+        response = requests.post(f"{RESULT_SERVICE_URL}/items/{item_id}/cancel")
+        if response.status_code == 404:
+            return JSONResponse(status_code=404, content={"error": "Item not found."})
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to cancel item {item_id}: {str(e)}")
+        return JSONResponse(status_code=502, content={"error": str(e)})
+
+    cancel_event = ingestion_cancel_events.get(item_id)
+    if cancel_event is not None:
+        cancel_event.set()
+    logging.info(f"Item {item_id} cancelled.")
+    return response.json()
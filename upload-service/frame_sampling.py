@@ -0,0 +1,209 @@
+import os
+import time
+import logging
+import cv2
+import numpy as np
+
+# Frame sampling mode: "interval" (one frame every frame_second) or "adaptive"
+# (candidates every frame_second, kept only on scene changes)
+FRAME_SAMPLING_MODE = os.getenv("FRAME_SAMPLING_MODE", "interval").lower()
+SAMPLING_MODES = ("interval", "adaptive")
+# Minimum change score (0-1) between a candidate and the last kept frame to keep it
+FRAME_SCENE_THRESHOLD = float(os.getenv("FRAME_SCENE_THRESHOLD", 0.15))
+# In adaptive mode a frame is always kept if none was kept for this many seconds
+FRAME_ADAPTIVE_MAX_GAP_SECONDS = float(os.getenv("FRAME_ADAPTIVE_MAX_GAP_SECONDS", 30))
+
+# Frame decoding strategy: "auto", "seek", "grab" or "read"
+FRAME_SAMPLING_STRATEGY = os.getenv("FRAME_SAMPLING_STRATEGY", "auto").lower()
+# Assumed keyframe (GOP) interval in seconds for inter-frame codecs
+FRAME_SEEK_GOP_SECONDS = float(os.getenv("FRAME_SEEK_GOP_SECONDS", 2))
+
+# Codecs where every frame is a keyframe, so seeking never decodes extra frames
+INTRA_ONLY_CODECS = {"mjpg", "mjpa", "mjpb", "jpeg", "apch", "apcn", "apcs", "apco", "ap4h"}
+
+
+def get_codec(video_capture):
+    """Return the lowercase FOURCC of the video stream (e.g. 'avc1', 'hvc1', 'mjpg')."""
+    fourcc = int(video_capture.get(cv2.CAP_PROP_FOURCC))
+    return "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip("\x00 ").lower()
+
+
+def choose_sampling_strategy(video_path, codec, fps, frame_interval):
+    """
+    Pick the cheapest way to sample one frame every frame_interval frames.
+
+    - "seek": jump with CAP_PROP_POS_MSEC. The decoder restarts at the previous keyframe,
+      so each sample costs about half a GOP of decoding. Best for intra-only codecs and
+      for intervals much longer than the keyframe interval.
+    - "grab": grab() every frame and retrieve() only the sampled ones. Skipped frames are
+      still decoded but never converted/copied, and there is no seek overhead. Best for
+      short intervals.
+    """
+    if FRAME_SAMPLING_STRATEGY in ("seek", "grab", "read"):
+        return FRAME_SAMPLING_STRATEGY
+
+    if frame_interval <= 1 or fps <= 0:
+        return "grab"
+
+    # Only containers with an index support cheap random access
+    if not video_path.lower().endswith((".mp4", ".mov", ".m4v", ".mkv")):
+        return "grab"
+
+    if codec in INTRA_ONLY_CODECS:
+        return "seek"
+
+    # Seeking pays ~GOP/2 decodes per sample, grabbing pays frame_interval decodes
+    gop_frames = max(fps * FRAME_SEEK_GOP_SECONDS, 1)
+    return "seek" if frame_interval > gop_frames else "grab"
+
+
+def sample_video_frames(video_capture, frame_interval, strategy, stats):
+    """
+    Yield (frame_number, frame) for every frame_interval-th frame of the video.
+
+    Frame numbers are identical for every strategy. stats is updated in place with
+    the number of frames decoded and retrieved (for "seek" the decoder also decodes
+    from the previous keyframe, which OpenCV doesn't expose, so seeks are counted too).
+    """
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    if strategy == "seek" and fps <= 0:
+        # Seek positions are computed from the frame rate, continue sequentially
+        logging.warning("The video reports no frame rate, sampling with 'grab' instead.")
+        stats["strategy"] = "grab"
+        strategy = "grab"
+    if strategy == "seek":
+        total_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_number = 0
+        while total_frames <= 0 or frame_number < total_frames:
+            if not video_capture.set(cv2.CAP_PROP_POS_MSEC, frame_number * 1000 / fps):
+                # The backend can't seek in this file, continue sequentially
+                logging.warning(
+                    f"Seeking failed at frame {frame_number}, falling back to 'grab'."
+                )
+                stats["strategy"] = "seek+grab"
+                yield from _grab_frames(
+                    video_capture, frame_interval, stats, start=frame_number
+                )
+                return
+            stats["seeks"] += 1
+            success, frame = video_capture.read()
+            stats["decoded"] += 1
+            if not success:
+                break
+            stats["retrieved"] += 1
+            yield frame_number, frame
+            frame_number += frame_interval
+    elif strategy == "read":
+        frame_number = 0
+        while True:
+            success, frame = video_capture.read()
+            if not success:
+                break
+            stats["decoded"] += 1
+            if frame_number % frame_interval == 0:
+                stats["retrieved"] += 1
+                yield frame_number, frame
+            frame_number += 1
+    else:
+        yield from _grab_frames(video_capture, frame_interval, stats)
+
+
+def _grab_frames(video_capture, frame_interval, stats, start=0):
+    """Grab every frame from the current position and retrieve only sampled ones."""
+    frame_number = start
+    while video_capture.grab():
+        stats["decoded"] += 1
+        if frame_number % frame_interval == 0:
+            success, frame = video_capture.retrieve()
+            if success:
+                stats["retrieved"] += 1
+                yield frame_number, frame
+        frame_number += 1
+
+
+def frame_signature(frame):
+    """Cheap signature of a frame: a 32x32 grayscale thumbnail and its 64-bit dHash."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    hash_source = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    dhash = hash_source[:, 1:] > hash_source[:, :-1]
+    return thumbnail.astype(np.int16), dhash
+
+
+def change_score(signature, reference):
+    """
+    Score in [0, 1] of how different two frames are: the larger of the normalised
+    dHash Hamming distance and the mean absolute thumbnail difference.
+    """
+    thumbnail, dhash = signature
+    reference_thumbnail, reference_dhash = reference
+    hash_distance = np.count_nonzero(dhash != reference_dhash) / dhash.size
+    pixel_distance = np.abs(thumbnail - reference_thumbnail).mean() / 255
+    return max(hash_distance, pixel_distance)
+
+
+def select_scene_changes(frames, fps, stats):
+    """
+    Filter candidate frames, keeping only those that differ from the last kept frame by
+    at least FRAME_SCENE_THRESHOLD, plus one every FRAME_ADAPTIVE_MAX_GAP_SECONDS.
+    """
+    max_gap_frames = FRAME_ADAPTIVE_MAX_GAP_SECONDS * fps
+    last_kept_signature = None
+    last_kept_frame = 0
+
+    for frame_number, frame in frames:
+        stats["candidates"] += 1
+        signature = frame_signature(frame)
+        if (
+            last_kept_signature is not None
+            and frame_number - last_kept_frame < max_gap_frames
+            and change_score(signature, last_kept_signature) < FRAME_SCENE_THRESHOLD
+        ):
+            continue
+        last_kept_signature = signature
+        last_kept_frame = frame_number
+        yield frame_number, frame
+
+
+def open_sampler(video_path, frame_second, mode=None):
+    """
+    Open a video and return (video_capture, frame_interval, frames generator, stats).
+
+    In "adaptive" mode every frame_second-th candidate goes through scene change
+    detection. The caller must release the capture. stats contains the chosen strategy
+    and is filled with decode counts while the generator is consumed.
+    """
+    mode = (mode or FRAME_SAMPLING_MODE).lower()
+    video_capture = cv2.VideoCapture(video_path)
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    frame_interval = max(int(fps) * frame_second, 1)
+    codec = get_codec(video_capture)
+    strategy = choose_sampling_strategy(video_path, codec, fps, frame_interval)
+    stats = {
+        "mode": mode,
+        "strategy": strategy,
+        "codec": codec,
+        "fps": fps,
+        "frame_interval": frame_interval,
+        "total_frames": int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+        "seeks": 0,
+        "decoded": 0,
+        "retrieved": 0,
+        "candidates": 0,
+        "started_at": time.monotonic(),
+    }
+    frames = sample_video_frames(video_capture, frame_interval, strategy, stats)
+    if mode == "adaptive":
+        frames = select_scene_changes(frames, fps, stats)
+    return video_capture, frame_interval, frames, stats
+
+
+def log_sampling_stats(video_id, stats):
+    """Log the sampling strategy and decode counts for a video."""
+    elapsed = time.monotonic() - stats["started_at"]
+    logging.info(
+        f"Frame sampling for video '{video_id}': mode={stats['mode']}, strategy={stats['strategy']}, "
+        f"codec={stats['codec']}, fps={stats['fps']:.2f}, interval={stats['frame_interval']} frames, "
+        f"total_frames={stats['total_frames']}, seeks={stats['seeks']}, decoded={stats['decoded']}, "
+        f"retrieved={stats['retrieved']}, candidates={stats['candidates']}, elapsed={elapsed:.2f}s"
+    )
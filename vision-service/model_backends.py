@@ -0,0 +1,182 @@
+"""
+Inference backends of the vision models.
+
+Every model runs with PyTorch ("pytorch"), ONNX Runtime ("onnx") or OpenVINO
+("openvino"). The .pt weights are exported to the format of the backend the first
+time it is used and the export is cached in VISION_MODEL_CACHE. Exports can also be
+made ahead, e.g. at build time:
+
+    python model_backends.py --backends onnx,openvino
+
+"onnx-int8" runs the INT8 model made and validated by quantize_models.py, as long as
+it kept VISION_INT8_MIN_ACCURACY of the FP32 accuracy (FP32 ONNX otherwise).
+"""
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from ultralytics import YOLO
+from common.messaging import VISION_SERVICES
+
+YOLO_MODEL = os.getenv("YOLO_MODEL", "yolov8n.pt")
+YOLO_CLS_MODEL = os.getenv("YOLO_CLS_MODEL", "yolov8x-cls.pt")
+# Custom logo detection weights, downloaded next to the service at build time
+YOLO_LOGO_MODEL = os.getenv(
+    "YOLO_LOGO_MODEL", os.path.join(os.path.dirname(__file__), "yolov8x_logo_v2.pt")
+)
+# Inference backend of the models: "pytorch", "onnx" or "openvino"
+VISION_BACKEND = os.getenv("VISION_BACKEND", "pytorch").lower()
+# Backends of single models overriding VISION_BACKEND, e.g. "yolo=onnx,yolo_logo=openvino"
+VISION_BACKENDS = os.getenv("VISION_BACKENDS", "")
+# Accuracy an INT8 model must keep on the holdout set, relative to the FP32 model
+# (mAP@0.5 or top-1), to be loaded
+VISION_INT8_MIN_ACCURACY = float(os.getenv("VISION_INT8_MIN_ACCURACY", 0.97))
+# Directory the exported and quantized models are cached in
+VISION_MODEL_CACHE = os.getenv(
+    "VISION_MODEL_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"),
+)
+
+MODEL_WEIGHTS = {
+    "yolo": YOLO_MODEL,
+    "yolo_cls": YOLO_CLS_MODEL,
+    "yolo_logo": YOLO_LOGO_MODEL,
+}
+# Exported models do not always record their task
+MODEL_TASKS = {"yolo": "detect", "yolo_cls": "classify", "yolo_logo": "detect"}
+
+# Backend -> (ultralytics export format, suffix of the exported file or directory)
+EXPORT_FORMATS = {
+    "onnx": ("onnx", ".onnx"),
+    "openvino": ("openvino", "_openvino_model"),
+}
+# Backend of the INT8 models, which run on ONNX Runtime
+QUANTIZED_BACKEND = "onnx-int8"
+BACKENDS = ("pytorch", *EXPORT_FORMATS, QUANTIZED_BACKEND)
+
+
+def parse_backends(spec, default=VISION_BACKEND):
+    """Parse "service=backend,..." into the backend of every vision model."""
+    backends = {service: default for service in VISION_SERVICES}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        service, backend = entry.split("=")
+        backends[service.strip()] = backend.strip().lower()
+    for service, backend in backends.items():
+        if service not in VISION_SERVICES or backend not in BACKENDS:
+            raise ValueError(
+                f"Invalid vision backend {service}={backend}, expected one of {BACKENDS}"
+            )
+    return backends
+
+
+MODEL_BACKENDS = parse_backends(VISION_BACKENDS)
+
+
+def export_model(weights, backend):
+    """
+    Export .pt weights to the format of a backend and return the path of the export,
+    which is cached in VISION_MODEL_CACHE (named after the weights) and reused.
+    """
+    export_format, suffix = EXPORT_FORMATS[backend]
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    cached = os.path.join(VISION_MODEL_CACHE, f"{stem}{suffix}")
+    if os.path.exists(cached):
+        return cached
+
+    os.makedirs(VISION_MODEL_CACHE, exist_ok=True)
+    logging.info(f"Exporting {weights} for {backend}...")
+    # Export from a private copy of the weights (downloaded first if they are a
+    # released model name), so replicas starting together never share files
+    with tempfile.TemporaryDirectory(dir=VISION_MODEL_CACHE) as export_dir:
+        weights_copy = os.path.join(export_dir, os.path.basename(weights))
+        shutil.copy(YOLO(weights).ckpt_path, weights_copy)
+        # Dynamic shapes, so frames can be run in batches of any size
+        exported = YOLO(weights_copy).export(format=export_format, dynamic=True)
+        try:
+            os.replace(exported, cached)
+        except OSError:
+            # Another replica cached the same export first
+            if not os.path.exists(cached):
+                raise
+    logging.info(f"Exported {weights} for {backend} to {cached}")
+    return cached
+
+
+def quantized_model_paths(weights):
+    """Paths of the INT8 model of .pt weights and of its validation report."""
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    path = os.path.join(VISION_MODEL_CACHE, f"{stem}_int8")
+    return f"{path}.onnx", f"{path}.json"
+
+
+def load_quantized_model(service, min_accuracy=VISION_INT8_MIN_ACCURACY):
+    """
+    Load the INT8 model of a vision service if its validation report shows it kept
+    min_accuracy of the FP32 accuracy, otherwise return None.
+    """
+    model_path, report_path = quantized_model_paths(MODEL_WEIGHTS[service])
+    try:
+        with open(report_path) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        logging.warning(
+            f"No validated INT8 model of {service}, run quantize_models.py first."
+        )
+        return None
+    if report["relative_accuracy"] < min_accuracy or not os.path.exists(model_path):
+        logging.warning(
+            f"INT8 model of {service} not loaded: it kept "
+            f"{report['relative_accuracy']:.1%} of the FP32 {report['metric']}, "
+            f"{min_accuracy:.1%} required."
+        )
+        return None
+    logging.info(
+        f"Loading INT8 model of {service} ({report['relative_accuracy']:.1%} of the "
+        f"FP32 {report['metric']})"
+    )
+    return YOLO(model_path, task=MODEL_TASKS[service])
+
+
+def load_model(service, backend=None):
+    """Load the model of a vision service with its backend (MODEL_BACKENDS by default)."""
+    backend = backend or MODEL_BACKENDS[service]
+    weights = MODEL_WEIGHTS[service]
+    if backend == QUANTIZED_BACKEND:
+        model = load_quantized_model(service)
+        if model is not None:
+            return model
+        # The FP32 model on the same runtime
+        backend = "onnx"
+    if backend == "pytorch":
+        return YOLO(weights)
+    return YOLO(export_model(weights, backend), task=MODEL_TASKS[service])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export the vision models ahead.")
+    parser.add_argument(
+        "--backends",
+        default=",".join(EXPORT_FORMATS),
+        help="Comma separated backends to export the models for",
+    )
+    parser.add_argument(
+        "--models",
+        default=",".join(VISION_SERVICES),
+        help="Comma separated vision models to export",
+    )
+    args = parser.parse_args()
+    for backend in args.backends.split(","):
+        if backend not in EXPORT_FORMATS:
+            continue
+        for service in args.models.split(","):
+            export_model(MODEL_WEIGHTS[service], backend)
+
+
+if __name__ == "__main__":
+    main()
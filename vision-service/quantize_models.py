@@ -0,0 +1,405 @@
+"""
+INT8 quantization of the vision models.
+
+For each model the FP32 ONNX export is quantized statically with ONNX Runtime,
+calibrated on a sample of frames, then validated on a holdout set against the FP32
+(PyTorch) model: mAP@0.5 for the detection models and top-1 for the classifier.
+Without a labelled dataset (--data) the predictions of the FP32 model on the holdout
+frames are the ground truth, so the metric is the accuracy kept by the INT8 model.
+
+The INT8 model and its validation report are stored in VISION_MODEL_CACHE; the
+"onnx-int8" backend only loads models whose report passes VISION_INT8_MIN_ACCURACY.
+Frames are local image directories or frame directories of processed items in S3,
+e.g. from the vision container:
+
+    python quantize_models.py --models yolo_cls,yolo_logo \\
+        --calibration videos/<video id>/frames/ --holdout videos/<video id>/frames/
+"""
+
+import os
+import ast
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import boto3
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from ultralytics import YOLO
+from common.frame_shards import load_frame_index
+from common.frame_source import fetch_frames
+from common.messaging import VISION_SERVICES
+from model_backends import (
+    MODEL_TASKS,
+    MODEL_WEIGHTS,
+    VISION_INT8_MIN_ACCURACY,
+    VISION_MODEL_CACHE,
+    export_model,
+    load_model,
+    quantized_model_paths,
+)
+
+BUCKET_NAME = os.getenv("BUCKET_NAME", "data-extraction-file-storage-thesis")
+# Frame rendition the vision worker runs on, so the models are calibrated on the same
+FRAME_RENDITION = os.getenv("FRAME_RENDITION", "detect")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+# Confidence of the boxes the mAP is computed over (like ultralytics validation)
+VALIDATION_CONFIDENCE = 0.001
+MAP_IOU = 0.5
+
+
+def sample_frames(sources, limit):
+    """
+    Yield up to limit decoded BGR frames, spread evenly over the frames of each
+    source: a local image directory, or a frames directory in BUCKET_NAME.
+    """
+    per_source = max(limit // len(sources), 1)
+    s3 = None
+    for source in sources:
+        if os.path.isdir(source):
+            names = sorted(
+                name
+                for name in os.listdir(source)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            for name in names[:: max(len(names) // per_source, 1)][:per_source]:
+                image = cv2.imread(os.path.join(source, name))
+                if image is not None:
+                    yield image
+            continue
+
+        s3 = s3 or boto3.client("s3")
+        index = load_frame_index(s3, BUCKET_NAME, source)
+        entries = None
+        if index is not None:
+            entries = index["frames"]
+            entries = entries[:: max(len(entries) // per_source, 1)][:per_source]
+        frames = fetch_frames(
+            s3, BUCKET_NAME, source, entries, FRAME_RENDITION, cv2.IMREAD_COLOR
+        )
+        for count, (_, frame) in enumerate(frames):
+            if count == per_source:
+                break
+            yield frame
+        frames.close()
+
+
+def preprocess(image, imgsz, task):
+    """
+    Input tensor of a BGR image the way ultralytics prepares it: letterboxed for
+    detection, resized and center-cropped for classification; RGB scaled to [0, 1].
+    """
+    height, width = image.shape[:2]
+    if task == "classify":
+        scale = max(imgsz[0] / height, imgsz[1] / width)
+        resized = cv2.resize(image, (round(width * scale), round(height * scale)))
+        top = (resized.shape[0] - imgsz[0]) // 2
+        left = (resized.shape[1] - imgsz[1]) // 2
+        canvas = resized[top : top + imgsz[0], left : left + imgsz[1]]
+    else:
+        scale = min(imgsz[0] / height, imgsz[1] / width)
+        resized = cv2.resize(image, (round(width * scale), round(height * scale)))
+        canvas = np.full((imgsz[0], imgsz[1], 3), 114, dtype=np.uint8)
+        top = (imgsz[0] - resized.shape[0]) // 2
+        left = (imgsz[1] - resized.shape[1]) // 2
+        canvas[top : top + resized.shape[0], left : left + resized.shape[1]] = resized
+    tensor = canvas[:, :, ::-1].transpose(2, 0, 1)[np.newaxis]
+    return np.ascontiguousarray(tensor, dtype=np.float32) / 255
+
+
+class FrameCalibrationReader(CalibrationDataReader):
+    """Feeds sampled frames to the calibration of ONNX Runtime, one at a time."""
+
+    def __init__(self, input_name, frames, imgsz, task):
+        self.inputs = ({input_name: preprocess(frame, imgsz, task)} for frame in frames)
+        self.count = 0
+
+    def get_next(self):
+        data = next(self.inputs, None)
+        if data is not None:
+            self.count += 1
+        return data
+
+
+def head_nodes(model):
+    """
+    Nodes of the head of a model (its last module) other than convolutions: they mix
+    box coordinates and class scores in the same tensors, which one INT8 scale cannot
+    represent, so they stay in FP32.
+    """
+    # Node names start with the module they were exported from, e.g. "/model.22/..."
+    modules = [
+        int(node.name.split("/")[1].split(".")[1])
+        for node in model.graph.node
+        if node.name.startswith("/model.")
+    ]
+    if not modules:
+        return []
+    head = f"/model.{max(modules)}/"
+    return [
+        node.name
+        for node in model.graph.node
+        if node.name.startswith(head) and node.op_type != "Conv"
+    ]
+
+
+def quantize_model(service, calibration, calibration_images, output_path):
+    """Quantize the FP32 ONNX model of a service into output_path (static INT8)."""
+    fp32_path = export_model(MODEL_WEIGHTS[service], "onnx")
+    fp32_model = onnx.load(fp32_path)
+    metadata = {prop.key: prop.value for prop in fp32_model.metadata_props}
+    imgsz = ast.literal_eval(metadata["imgsz"])
+    task = MODEL_TASKS[service]
+
+    with tempfile.TemporaryDirectory(dir=VISION_MODEL_CACHE) as work_dir:
+        # Shape inference and graph optimizations recommended before quantizing
+        prepared_path = os.path.join(work_dir, "prepared.onnx")
+        quant_pre_process(fp32_path, prepared_path)
+
+        reader = FrameCalibrationReader(
+            fp32_model.graph.input[0].name,
+            sample_frames(calibration, calibration_images),
+            imgsz,
+            task,
+        )
+        logging.info(f"Calibrating {service} on up to {calibration_images} frames...")
+        quantize_static(
+            prepared_path,
+            output_path,
+            reader,
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=head_nodes(fp32_model),
+        )
+    if not reader.count:
+        raise ValueError(f"No calibration frames found in {calibration}")
+
+    # ultralytics reads the class names, image size and stride from the metadata
+    int8_model = onnx.load(output_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, output_path)
+    logging.info(f"Quantized {service} on {reader.count} frames")
+    return reader.count, imgsz
+
+
+def box_iou(box, boxes):
+    """IoU of a box (x1, y1, x2, y2) with each of the given boxes."""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def average_precision(hits, confidences, positives):
+    """Area under the (interpolated) precision-recall curve of ranked predictions."""
+    order = np.argsort(-confidences)
+    true_positives = np.cumsum(hits[order])
+    false_positives = np.cumsum(1 - hits[order])
+    recall = np.concatenate(([0.0], true_positives / positives, [1.0]))
+    precision = np.concatenate(
+        ([1.0], true_positives / (true_positives + false_positives), [0.0])
+    )
+    precision = np.flip(np.maximum.accumulate(np.flip(precision)))
+    changes = np.where(recall[1:] != recall[:-1])[0]
+    return float(
+        np.sum((recall[changes + 1] - recall[changes]) * precision[changes + 1])
+    )
+
+
+def detection_map(references, predictions):
+    """
+    mAP@0.5 of the predictions against the reference boxes of each frame (given as
+    (boxes, classes, confidences) arrays), over the classes of the references.
+    """
+    class_hits = {}
+    class_positives = {}
+    for (ref_boxes, ref_classes, _), (boxes, classes, confs) in zip(
+        references, predictions
+    ):
+        for cls in ref_classes:
+            class_positives[cls] = class_positives.get(cls, 0) + 1
+        matched = np.zeros(len(ref_boxes), dtype=bool)
+        for index in np.argsort(-confs):
+            candidates = ~matched & (ref_classes == classes[index])
+            hit = 0.0
+            if candidates.any():
+                ious = np.where(candidates, box_iou(boxes[index], ref_boxes), 0)
+                best = int(ious.argmax())
+                if ious[best] >= MAP_IOU:
+                    matched[best] = True
+                    hit = 1.0
+            class_hits.setdefault(classes[index], []).append((hit, confs[index]))
+
+    if not class_positives:
+        # Nothing to find: perfect unless the predictions found something
+        return 0.0 if class_hits else 1.0
+    precisions = []
+    for cls, positives in class_positives.items():
+        hits = np.array(class_hits.get(cls, []), dtype=np.float64).reshape(-1, 2)
+        precisions.append(average_precision(hits[:, 0], hits[:, 1], positives))
+    return float(np.mean(precisions))
+
+
+def boxes_of(prediction):
+    return (
+        prediction.boxes.xyxy.cpu().numpy(),
+        prediction.boxes.cls.cpu().numpy(),
+        prediction.boxes.conf.cpu().numpy(),
+    )
+
+
+def validate_on_frames(service, fp32, int8, holdout, holdout_images):
+    """Accuracy of the INT8 model on holdout frames with the FP32 predictions as truth."""
+    references = []
+    predictions = []
+    for frame in sample_frames(holdout, holdout_images):
+        reference = fp32.predict(source=frame, verbose=False)[0]
+        if MODEL_TASKS[service] == "classify":
+            prediction = int8.predict(source=frame, verbose=False)[0]
+            references.append(reference.probs.top1)
+            predictions.append(prediction.probs.top1)
+        else:
+            prediction = int8.predict(
+                source=frame, conf=VALIDATION_CONFIDENCE, verbose=False
+            )[0]
+            references.append(boxes_of(reference))
+            predictions.append(boxes_of(prediction))
+    if not references:
+        raise ValueError(f"No holdout frames found in {holdout}")
+
+    if MODEL_TASKS[service] == "classify":
+        agreement = np.mean(np.array(references) == np.array(predictions))
+        return "top1", 1.0, float(agreement), len(references)
+    return "map50", 1.0, detection_map(references, predictions), len(references)
+
+
+def validate_on_dataset(service, fp32, int8, data, imgsz):
+    """mAP@0.5 or top-1 of the FP32 and INT8 models on a labelled ultralytics dataset."""
+    metrics = [
+        model.val(data=data, imgsz=imgsz[0], verbose=False) for model in (fp32, int8)
+    ]
+    if MODEL_TASKS[service] == "classify":
+        return "top1", metrics[0].top1, metrics[1].top1, None
+    return "map50", metrics[0].box.map50, metrics[1].box.map50, None
+
+
+def quantize_and_validate(service, args):
+    """Quantize the model of a service, validate it and store it with its report."""
+    model_path, report_path = quantized_model_paths(MODEL_WEIGHTS[service])
+    os.makedirs(VISION_MODEL_CACHE, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=VISION_MODEL_CACHE) as work_dir:
+        candidate_path = os.path.join(work_dir, os.path.basename(model_path))
+        calibrated, imgsz = quantize_model(
+            service, args.calibration, args.calibration_images, candidate_path
+        )
+
+        fp32 = load_model(service, "pytorch")
+        int8 = YOLO(candidate_path, task=MODEL_TASKS[service])
+        if args.data:
+            metric, fp32_accuracy, int8_accuracy, validated = validate_on_dataset(
+                service, fp32, int8, args.data, imgsz
+            )
+        else:
+            metric, fp32_accuracy, int8_accuracy, validated = validate_on_frames(
+                service, fp32, int8, args.holdout, args.holdout_images
+            )
+
+        report = {
+            "service": service,
+            "weights": MODEL_WEIGHTS[service],
+            "metric": metric,
+            "fp32_accuracy": fp32_accuracy,
+            "int8_accuracy": int8_accuracy,
+            "relative_accuracy": int8_accuracy / max(fp32_accuracy, 1e-9),
+            "calibration_frames": calibrated,
+            "holdout_frames": validated,
+            "holdout": args.data or args.holdout,
+            "validated_at": time.time(),
+        }
+        # The previous report never describes the new model, even for a moment
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        os.replace(candidate_path, model_path)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Quantize the vision models to INT8.")
+    parser.add_argument(
+        "--models",
+        default=",".join(VISION_SERVICES),
+        help="Comma separated vision models to quantize",
+    )
+    parser.add_argument(
+        "--calibration",
+        nargs="+",
+        required=True,
+        help="Image directories or S3 frame directories to calibrate on",
+    )
+    parser.add_argument(
+        "--calibration-images",
+        type=int,
+        default=200,
+        help="Frames sampled for the calibration",
+    )
+    parser.add_argument(
+        "--holdout",
+        nargs="+",
+        help="Image directories or S3 frame directories to validate on",
+    )
+    parser.add_argument(
+        "--holdout-images",
+        type=int,
+        default=500,
+        help="Frames sampled for the validation",
+    )
+    parser.add_argument(
+        "--data",
+        help="Labelled ultralytics dataset to validate on instead of --holdout",
+    )
+    args = parser.parse_args()
+    if not args.holdout and not args.data:
+        parser.error("Give the holdout set to validate on with --holdout or --data")
+
+    failed = []
+    for service in args.models.split(","):
+        report = quantize_and_validate(service, args)
+        passed = report["relative_accuracy"] >= VISION_INT8_MIN_ACCURACY
+        print(
+            f"{service:<10} {report['metric']} FP32 {report['fp32_accuracy']:.4f}  "
+            f"INT8 {report['int8_accuracy']:.4f}  "
+            f"({report['relative_accuracy']:.1%} kept, "
+            f"{VISION_INT8_MIN_ACCURACY:.1%} required: "
+            f"{'passed' if passed else 'failed'})"
+        )
+        if not passed:
+            failed.append(service)
+    if failed:
+        sys.exit(f"INT8 models below the accuracy threshold: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import boto3
+import logging
+import cv2
+from dotenv import load_dotenv
+import requests
+from common.frame_shards import load_frame_index
+from common.frame_source import decode_image, fetch_frames
+from common.cancellation import JobCancelled, stop_reason
+from common.messaging import VISION_SERVICES, VISION_SHARED_QUEUE
+from common.pipeline import CANCELLED, COMPLETED, PARTIAL
+from common.worker import run_service_worker
+from model_backends import MODEL_BACKENDS, load_model
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Models loaded by this worker: every vision model to run the ones a job requests on
+# frames decoded once (VISION_SHARED_QUEUE), or a single one for isolated replicas
+VISION_MODELS = [
+    name.strip()
+    for name in os.getenv("VISION_MODELS", ",".join(VISION_SERVICES)).split(",")
+    if name.strip()
+]
+BUCKET_NAME = os.getenv("BUCKET_NAME", "data-extraction-file-storage-thesis")
+RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
+# Frame rendition generated at ingestion to use instead of the full-resolution frames
+FRAME_RENDITION = os.getenv("FRAME_RENDITION", "detect")
+# Frames decoded and run through the models together: memory grows with the batch,
+# not with the video
+VISION_BATCH_SIZE = max(int(os.getenv("VISION_BATCH_SIZE", 8)), 1)
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO)
+
+unknown_models = set(VISION_MODELS) - set(VISION_SERVICES)
+if unknown_models:
+    raise ValueError(
+        f"Unknown VISION_MODELS {sorted(unknown_models)}, expected {VISION_SERVICES}"
+    )
+
+# Initialize an S3 client
+s3 = boto3.client("s3")
+
+# The models are loaded side by side, once per process, each with its backend
+# (PyTorch, or ONNX Runtime / OpenVINO exports cached on first use)
+models = {service: load_model(service) for service in VISION_MODELS}
+logging.info(
+    "Loaded vision models: "
+    + ", ".join(f"{service} ({MODEL_BACKENDS[service]})" for service in VISION_MODELS)
+)
+
+
+def extract_detections(result):
+    """Boxes detected in a frame (yolo and yolo_logo results) for MongoDB storage."""
+    return [
+        {
+            "box": box.xyxy.tolist()[0],  # Bounding box (x1, y1, x2, y2)
+            "confidence": float(box.conf[0]),
+            "class": int(box.cls[0]),
+            "label": result.names[int(box.cls[0])],  # e.g. 'person', 'car'
+        }
+        for box in result.boxes
+    ]
+
+
+def extract_classification(result):
+    """Top-1 and top-5 classes of a frame (yolo_cls results) for MongoDB storage."""
+    probs = result.probs  # The Probs object containing classification probabilities
+    return {
+        "top1_class_idx": probs.top1,
+        "top1_class_name": result.names[probs.top1],
+        "top1_confidence": float(probs.top1conf),
+        "top5_classes_indices": probs.top5,
+        "top5_class_names": [result.names[i] for i in probs.top5],
+        "top5_confidences": [float(conf) for conf in probs.top5conf],
+    }
+
+
+# Service -> conversion of a prediction to the stored result of a frame
+EXTRACTORS = {
+    "yolo": extract_detections,
+    "yolo_cls": extract_classification,
+    "yolo_logo": extract_detections,
+}
+
+
+def current_rss_mb():
+    """Resident memory of the process in MB (0 where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def scale_detections(detections, scale):
+    """Map boxes found on a rendition back to original-frame pixels, in place."""
+    if scale is None:
+        return
+    scale_x, scale_y = scale
+    for detection in detections:
+        x1, y1, x2, y2 = detection["box"]
+        detection["box"] = [x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y]
+
+
+def frame_scale(frame, original_size):
+    """(x, y) factors from a decoded frame to its original size, None if unknown."""
+    if not original_size or None in original_size:
+        return None
+    height, width = frame.shape[:2]
+    return original_size[0] / width, original_size[1] / height
+
+
+def predict_batch(frames, scales, services, results):
+    """
+    Run the models on a batch of decoded frames, appending to results. Boxes are
+    scaled back to the original frames with the (x, y) scale of each frame.
+    """
+    for service in services:
+        # Predictions are streamed and converted to their stored form one by one, so
+        # their copies of the frames are released right away
+        predictions = models[service].predict(source=frames, stream=True, verbose=False)
+        for prediction, scale in zip(predictions, scales):
+            stored = EXTRACTORS[service](prediction)
+            if EXTRACTORS[service] is extract_detections:
+                scale_detections(stored, scale)
+            results[service].append(stored)
+
+
+def run_models(frames, services, job=None, original_sizes=None):
+    """
+    Run the requested models on frames given as (frame number, decoded BGR image), in
+    batches of VISION_BATCH_SIZE. Each frame is decoded once and shared by the models
+    (each model still resizes it to its own input size); the frames of a batch are
+    dropped once it ran. original_sizes maps frame numbers to the (width, height) of
+    frames decoded from a smaller rendition, so boxes are stored in original pixels.
+
+    Returns ({service: [result of each frame]}, status): processing stops between
+    frames once the item of the job is cancelled or its deadline passes (status
+    CANCELLED or PARTIAL).
+    """
+    results = {service: [] for service in services}
+    status = COMPLETED
+    batch = []
+    scales = []
+    original_sizes = original_sizes or {}
+    processed = 0
+    started_at = time.time()
+    peak_rss = current_rss_mb()
+    for frame_number, frame in frames:
+        status = stop_reason(job) or COMPLETED
+        if status != COMPLETED:
+            logging.info(f"Stopping after {processed} frames: {status}")
+            break
+        batch.append(frame)
+        scales.append(frame_scale(frame, original_sizes.get(frame_number)))
+        if len(batch) == VISION_BATCH_SIZE:
+            predict_batch(batch, scales, services, results)
+            processed += len(batch)
+            batch = []
+            scales = []
+            peak_rss = max(peak_rss, current_rss_mb())
+    if batch and status == COMPLETED:
+        predict_batch(batch, scales, services, results)
+        processed += len(batch)
+        peak_rss = max(peak_rss, current_rss_mb())
+
+    elapsed = time.time() - started_at
+    logging.info(
+        f"Ran {', '.join(services)} on {processed} frames in {elapsed:.1f}s "
+        f"({processed / max(elapsed, 1e-6):.1f} frames/s, peak RSS {peak_rss:.0f} MB)."
+    )
+    return results, status
+
+
+def process_image(image_key, services):
+    """Process a single image with the requested models."""
+    logging.info(f"Downloading {image_key} from S3...")
+    data = s3.get_object(Bucket=BUCKET_NAME, Key=image_key)["Body"].read()
+    results, _ = run_models([(0, decode_image(data))], services)
+    logging.info(f"Image {image_key} processed. Results: {results}")
+    return results
+
+
+def process_frames(frames_dir_key, services, batch_frames=None, job=None):
+    """
+    Process the frames of a video (in frame order) with the requested models. When
+    batch_frames (the index entries of a frame batch) is given only those frames are
+    processed. Returns (results, status) like run_models.
+    """
+    entries = batch_frames or None
+    if entries is None:
+        # Index entries hold the original frame sizes (legacy directories have none)
+        index = load_frame_index(s3, BUCKET_NAME, frames_dir_key)
+        entries = index["frames"] if index is not None else None
+    original_sizes = {
+        entry["frame"]: (entry.get("width"), entry.get("height"))
+        for entry in entries or []
+    }
+
+    # The next frames are downloaded and decoded in memory while the models run
+    frames = fetch_frames(
+        s3, BUCKET_NAME, frames_dir_key, entries, FRAME_RENDITION, cv2.IMREAD_COLOR
+    )
+    results, status = run_models(frames, services, job, original_sizes)
+    frames.close()
+    logging.info(f"Frame processing completed for directory: {frames_dir_key}.")
+    return results, status
+
+
+def send_results_to_result_service(
+    item_id, service, result, status, batch=None, frames=None
+):
+    """Send the results of one model to the result service."""
+    result_data = {
+        "item_id": item_id,
+        "service": service,
+        "result": result,
+        "status": status,
+    }
+    endpoint = "results/save"
+
+    # Results of a frame batch are merged by the result service
+    if batch is not None:
+        result_data.update({"batch": batch, "frames": frames})
+        endpoint = "results/batch"
+
+    try:
+        response = requests.post(f"{RESULT_SERVICE_URL}/{endpoint}", json=result_data)
+        response.raise_for_status()  # Raise an error for bad responses (4xx or 5xx)
+        logging.info(
+            f"{service} results for item {item_id} saved to result service. Response: {response.json()}"
+        )
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to save results to result service: {str(e)}")
+        raise
+
+
+def get_batch_frame_numbers(batch_frames):
+    """Frame numbers of a frame batch message, in the order they are processed."""
+    if not batch_frames:
+        return None
+    return [entry["frame"] for entry in batch_frames]
+
+
+def job_services(message):
+    """Models to run for a job."""
+    if not VISION_SHARED_QUEUE:
+        # Single-model replica: its queues only receive jobs of its model
+        return VISION_MODELS
+    services = [service for service in message.get("services", []) if service in models]
+    if not services:
+        raise ValueError(f"No vision service requested in the message: {message}")
+    return services
+
+
+def process_message(ch, method, properties, body):
+    """
+    Process messages received from the RabbitMQ queue. Errors are raised so the job
+    is retried, the results are only recorded as failed once the retries run out.
+    """
+    message = json.loads(body)
+    item_id = message["item_id"]
+    frames_path = message.get("frames_path")
+    image_path = message.get("image_path")
+    batch = message.get("batch")
+    batch_frames = message.get("frames")
+    services = job_services(message)
+
+    logging.info(f"Received {', '.join(services)} message for item {item_id}.")
+
+    # Jobs of cancelled items are dropped, jobs past their deadline save no result
+    status = stop_reason(message)
+    if status == CANCELLED:
+        raise JobCancelled(item_id)
+    if status == PARTIAL:
+        results = {service: [] for service in services}
+    elif frames_path:
+        # Process the frames for a video
+        results, status = process_frames(frames_path, services, batch_frames, message)
+        if status == CANCELLED:
+            raise JobCancelled(item_id)
+    elif image_path:
+        # Process a single image
+        results, status = process_image(image_path, services), COMPLETED
+    else:
+        raise ValueError(f"No valid path found in the message: {message}")
+
+    # Send the results (of the processed frames) of each model to the result service,
+    # with every frame of the batch so frames left unprocessed keep their position
+    frame_numbers = get_batch_frame_numbers(batch_frames)
+    for service in services:
+        send_results_to_result_service(
+            item_id, service, results[service], status, batch, frame_numbers
+        )
+
+
+def report_failure(message, error):
+    """Record a job that was moved to the dead-letter queue as failed."""
+    batch_frames = message.get("frames")
+    for service in job_services(message):
+        send_results_to_result_service(
+            message["item_id"],
+            service,
+            [],
+            "failed",
+            message.get("batch"),
+            get_batch_frame_numbers(batch_frames),
+        )
+
+
+def start_vision_service():
+    """Start the vision service and listen to the RabbitMQ queues of its models."""
+    if VISION_SHARED_QUEUE:
+        # The shared queue carries the jobs of every vision model
+        missing = set(VISION_SERVICES) - set(VISION_MODELS)
+        if missing:
+            raise ValueError(
+                f"The shared vision queue needs every model, VISION_MODELS lacks {sorted(missing)}"
+            )
+        service = "vision"
+    elif len(VISION_MODELS) == 1:
+        service = VISION_MODELS[0]
+    else:
+        raise ValueError(
+            "Set VISION_MODELS to a single model, or VISION_SHARED_QUEUE=true to run several"
+        )
+
+    run_service_worker(service, process_message, on_give_up=report_failure)
+
+
+# Run the vision service
+if __name__ == "__main__":
+    start_vision_service()
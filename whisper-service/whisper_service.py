@@ -1,12 +1,15 @@
 import os
-import pika
 import boto3
 import whisper
 import logging
 import json
-import time
+import subprocess
+import numpy as np
 from dotenv import load_dotenv
 import requests
+from common.cancellation import JobCancelled, stop_reason
+from common.pipeline import CANCELLED, COMPLETED, PARTIAL
+from common.worker import run_service_worker
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -14,110 +17,182 @@ logging.basicConfig(level=logging.INFO)
 # Load environment variables from .env file
 load_dotenv()
 
-RABBITMQ_DEFAULT_USER = os.getenv("RABBITMQ_DEFAULT_USER", "user")
-RABBITMQ_DEFAULT_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "password")
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "data-extraction-file-storage-thesis")
 RESULT_SERVICE_URL = os.getenv("RESULT_SERVICE_URL", "http://result-service:5007")
+# Audio is transcribed in chunks of this many seconds, so a cancellation or a deadline
+# is noticed between chunks (0 transcribes the whole file at once)
+WHISPER_CHUNK_SECONDS = int(os.getenv("WHISPER_CHUNK_SECONDS", 600))
 
 # Initialize S3 client
 s3 = boto3.client("s3")
 
 # Whisper model (base model, adjust as needed)
 whisper_model = whisper.load_model(WHISPER_MODEL)
-credentials = pika.PlainCredentials(RABBITMQ_DEFAULT_USER, RABBITMQ_DEFAULT_PASS)
 
 
-# Publish Whisper completion back to the coordinator
-def publish_whisper_completion(item_id, result):
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
-        )
-        channel = connection.channel()
-        channel.queue_declare(queue="whisper_complete_queue", durable=True)
-        message = {"item_id": item_id, "whisper_result": result}
-        channel.basic_publish(
-            exchange="", routing_key="whisper_complete_queue", body=json.dumps(message)
-        )
-        logging.info(f"Published Whisper completion message to coordinator: {message}")
-    except Exception as e:
-        logging.error(f"Failed to publish Whisper completion. Error: {str(e)}")
-    finally:
-        connection.close()
-
-
-# Function to download video from S3
+# Function to download a video or audio file from S3
 def download_video_from_s3(video_key):
     try:
-        local_video_path = f"/tmp/{video_key.split('/')[-1]}"
+        local_video_path = f"/tmp/{video_key.replace('/', '_')}"
         logging.info(
-            f"Downloading video from S3: bucket='{BUCKET_NAME}', key='{video_key}'"
+            f"Downloading media from S3: bucket='{BUCKET_NAME}', key='{video_key}'"
         )
 
-        # Download the video from S3
+        # Download the media from S3
         s3.download_file(BUCKET_NAME, video_key, local_video_path)
 
-        logging.info(f"Video downloaded to local path: {local_video_path}")
+        logging.info(f"Media downloaded to local path: {local_video_path}")
         return local_video_path
     except Exception as e:
-        logging.error(f"Failed to download video from S3. Error: {str(e)}")
+        logging.error(f"Failed to download media from S3. Error: {str(e)}")
         raise
 
 
+def load_audio_chunk(media_path, offset, duration):
+    """
+    Decode duration seconds of audio starting at offset as 16 kHz mono samples (like
+    whisper.load_audio, without decoding the whole file).
+    """
+    command = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        "-ss",
+        str(offset),
+        "-t",
+        str(duration),
+        "-i",
+        media_path,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(whisper.audio.SAMPLE_RATE),
+        "-",
+    ]
+    output = subprocess.run(command, capture_output=True, check=True).stdout
+    return np.frombuffer(output, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def transcribe_in_chunks(media_path, language=None, job=None):
+    """
+    Transcribe a media file chunk by chunk, shifting the segment timestamps by the
+    offset of their chunk. Returns (segments, status): transcription stops between
+    chunks once the item of the job is cancelled or its deadline passes.
+    """
+    segments = []
+    offset = 0
+    while True:
+        audio = load_audio_chunk(media_path, offset, WHISPER_CHUNK_SECONDS)
+        if not len(audio):
+            return segments, COMPLETED
+        status = stop_reason(job)
+        if status:
+            logging.info(f"Stopping transcription at {offset}s: {status}")
+            return segments, status
+
+        options = {"fp16": False, "verbose": True}
+        if language:
+            options["language"] = language
+        result = whisper_model.transcribe(audio, **options)
+        # The language detected on the first chunk is kept for the following ones
+        language = language or result.get("language")
+        for segment in result["segments"]:
+            segment.update(
+                {
+                    "id": len(segments),
+                    "start": segment["start"] + offset,
+                    "end": segment["end"] + offset,
+                }
+            )
+            segments.append(segment)
+        offset += WHISPER_CHUNK_SECONDS
+
+
 # Function to transcribe video using Whisper
-def process_whisper(video_key: str, languages):
+def process_whisper(video_key: str, languages, audio_key: str = None, job=None):
+    """
+    Transcribe a video with Whisper. When the upload service extracted a compact audio
+    track (audio_key) it is used instead of downloading the full video.
+
+    Returns (segments, status), see transcribe_in_chunks.
+    """
+    media_key = audio_key or video_key
+    media_path = None
     try:
         result = []
-        # Step 1: Download the video from S3
+        # Step 1: Download the audio (or the full video) from S3
         logging.info(f"Starting transcription for video with key: {video_key}")
-        video_path = download_video_from_s3(video_key)
+        media_path = download_video_from_s3(media_key)
+
+        if WHISPER_CHUNK_SECONDS > 0:
+            language = languages[0] if languages else None
+            logging.info(f"Transcribing {media_key} in {WHISPER_CHUNK_SECONDS}s chunks")
+            segments, status = transcribe_in_chunks(media_path, language, job)
+            logging.info(f"Transcription {status} for video: {video_key}.")
+            return segments, status
 
         if languages:
-            logging.info(f"Transcribing video using language {languages[0]}")
+            logging.info(f"Transcribing {media_key} using language {languages[0]}")
             result = whisper_model.transcribe(
-                video_path, language=languages[0], fp16=False, verbose=True
+                media_path, language=languages[0], fp16=False, verbose=True
             )
         else:
-            # Step 2: Transcribe the video using Whisper
-            logging.info(f"Transcribing video using Whisper for video: {video_path}")
-            result = whisper_model.transcribe(video_path, fp16=False, verbose=True)
+            # Step 2: Transcribe the media using Whisper
+            logging.info(f"Transcribing using Whisper for media: {media_path}")
+            result = whisper_model.transcribe(media_path, fp16=False, verbose=True)
 
         # Step 3: Log and return the transcription result
         segments = result["segments"]
         logging.info(f"Transcription completed for video: {video_key}.")
-        return segments
+        return segments, COMPLETED
 
     except Exception as e:
+        # Raised so the job is retried, and recorded as failed once retries run out
         logging.error(
             f"Error during transcription for video {video_key}. Error: {str(e)}"
         )
-        return {"error": str(e)}
+        raise
+    finally:
+        if media_path and os.path.exists(media_path):
+            os.remove(media_path)
 
 
 # Function to process the message received from RabbitMQ
 def process_message(ch, method, properties, body):
-    try:
-        # Parse the message from the RabbitMQ queue
-        message = json.loads(body)
-        video_key = message.get("video_path")
-        item_id = message.get("item_id")
-        languages = message.get("languages")
+    # Parse the message from the RabbitMQ queue (errors are raised so the job is retried)
+    message = json.loads(body)
+    video_key = message.get("video_path")
+    audio_key = message.get("audio_path")
+    item_id = message.get("item_id")
+    languages = message.get("languages")
+
+    if video_key:
+        logging.info(f"Received message to process video: {video_key}")
+        # Jobs of cancelled items are dropped, jobs past their deadline save no result
+        status = stop_reason(message)
+        if status == CANCELLED:
+            raise JobCancelled(item_id)
         results = []
-
-        if video_key:
-            logging.info(f"Received message to process video: {video_key}")
+        if status != PARTIAL:
             # Process the video using Whisper
-            results = process_whisper(video_key, languages)
-            send_results_to_result_service(item_id, results, "completed")
+            results, status = process_whisper(video_key, languages, audio_key, message)
+            if status == CANCELLED:
+                raise JobCancelled(item_id)
+        # The result service reports the completion to the coordinator
+        send_results_to_result_service(item_id, results, status)
+    else:
+        raise ValueError(f"No video_key found in the message: {message}")
 
-            # Publish completion to coordinator
-            publish_whisper_completion(item_id, results)
-        else:
-            raise ValueError(f"No video_key found in the message: {message}")
-    except Exception as e:
-        send_results_to_result_service(item_id, results, "failed")
-        logging.error(f"Error processing RabbitMQ message. Error: {str(e)}")
+
+def report_failure(message, error):
+    """Record a job that was moved to the dead-letter queue as failed."""
+    send_results_to_result_service(message.get("item_id"), [], "failed")
 
 
 def send_results_to_result_service(item_id, results, status):
@@ -136,36 +211,12 @@ def send_results_to_result_service(item_id, results, status):
         )
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to save results to result service: {str(e)}")
+        raise
 
 
 # Start the Whisper service to consume messages from RabbitMQ
 def start_whisper_service():
-    while True:
-        try:
-            logging.info("Attempting to connect to RabbitMQ...")
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters("rabbitmq", 5672, "/", credentials)
-            )
-            logging.info("Connected to RabbitMQ")
-
-            channel = connection.channel()
-
-            # Declare the whisper queue to ensure it exists
-            channel.queue_declare(queue="whisper_queue", durable=True)
-
-            logging.info("Waiting for messages in whisper_queue...")
-            channel.basic_consume(
-                queue="whisper_queue",
-                on_message_callback=process_message,
-                auto_ack=True,
-            )
-            channel.start_consuming()
-
-        except pika.exceptions.AMQPConnectionError as e:
-            logging.error(
-                f"Connection to RabbitMQ failed, retrying in 5 seconds: {str(e)}"
-            )
-            time.sleep(5)
+    run_service_worker("whisper", process_message, on_give_up=report_failure)
 
 
 # Run the Whisper service